@@ -1,7 +1,13 @@
 #!/usr/bin/env python3
 
 import argparse
+import array
+import bisect
 import io
+import itertools
+import json
+import mmap
+import os
 import sys
 
 
@@ -14,6 +20,23 @@ def get_args() -> argparse.Namespace:
 		metavar="table",
 		help="2-column accession to taxonomy map list, with the 1st column as "
 			"accession and the 2nd column as taxonomy (required)")
+	ap.add_argument("--index", "-x", type=str,
+		metavar="prefix",
+		help="compiled index of the accession to taxonomy map; built once if "
+			"missing or older than the map, and reused by later calls "
+			"[<accs-tax-map>.idx]")
+	ap.add_argument("--missing", "-m", type=str, default="error",
+		choices=["error", "skip", "label"],
+		help="policy for hit accessions not in the map: 'error' aborts, 'skip' "
+			"omits them from the output, 'label' writes them with "
+			"--missing-label as taxonomy [error]")
+	ap.add_argument("--missing-label", type=str, default="NA",
+		metavar="str",
+		help="taxonomy written for missing accessions with --missing label "
+			"[NA]")
+	ap.add_argument("--batch-size", type=int, default=65536,
+		metavar="int",
+		help="number of hit accessions looked up at a time [65536]")
 	ap.add_argument("--delimiter", "-d", type=str, default="\t",
 		metavar="char",
 		help="delimiter in tabular input and output [tab]")
@@ -25,6 +48,10 @@ def get_args() -> argparse.Namespace:
 	args = ap.parse_args()
 	if args.output == "-":
 		args.output = sys.stdout
+	if args.index is None:
+		args.index = args.accs_tax_map + ".idx"
+	if args.batch_size < 1:
+		ap.error("--batch-size must be positive")
 
 	return args
 
@@ -59,27 +86,166 @@ def load_accs_tax_map(f, delimiter="\t") -> dict:
 	return ret
 
 
-def map_taxonomy_to_hit_accs(ifile, ofile, *, accs_tax_map: dict,
+class AccsTaxIndex(object):
+	"""
+	compiled accession to taxonomy map, built once from the map table:
+	<prefix>.tsv has the lines 'accession<tab>cleaned taxonomy' sorted by
+	accession, <prefix>.offsets the uint64 start offset of each line, and
+	<prefix>.json the size and mtime of the source table and the delimiter it
+	was parsed with; both data files are
+	opened through mmap and searched by bisection, so that lookups need
+	neither parsing the table nor building a dict
+	"""
+	def __init__(self, prefix: str, *ka, **kw):
+		super().__init__(*ka, **kw)
+		self.prefix = prefix
+		self._fps = [open(self.data_file, "rb"), open(self.offsets_file, "rb")]
+		self._data = self._mmap(self._fps[0])
+		self._offsets_mm = self._mmap(self._fps[1])
+		self._offsets = memoryview(self._offsets_mm).cast("Q") \
+			if len(self._offsets_mm) else memoryview(array.array("Q"))
+		return
+
+	@staticmethod
+	def _mmap(fp):
+		# empty files cannot be mapped
+		if not os.fstat(fp.fileno()).st_size:
+			return b""
+		return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+	@property
+	def data_file(self) -> str:
+		return self.prefix + ".tsv"
+
+	@property
+	def offsets_file(self) -> str:
+		return self.prefix + ".offsets"
+
+	@staticmethod
+	def _source_stats(table: str, delimiter="\t") -> list:
+		st = os.stat(table)
+		return [os.path.realpath(table), st.st_size, st.st_mtime_ns, delimiter]
+
+	@classmethod
+	def is_valid(cls, prefix: str, table: str, delimiter="\t") -> bool:
+		try:
+			with open(prefix + ".json", "r") as fp:
+				return json.load(fp) == cls._source_stats(table, delimiter)
+		except (OSError, ValueError):
+			return False
+
+	@classmethod
+	def build(cls, table: str, prefix: str, delimiter="\t") -> None:
+		# the last entry of an accession wins, as when loaded into a dict
+		acc_tax = load_accs_tax_map(table, delimiter=delimiter)
+		offsets = array.array("Q")
+		tmp_data, tmp_offsets = prefix + ".tsv.tmp", prefix + ".offsets.tmp"
+		with open(tmp_data, "wb") as fp:
+			for acc in sorted(acc_tax, key=lambda x: x.encode("utf-8")):
+				offsets.append(fp.tell())
+				fp.write(("%s\t%s\n" % (acc, acc_tax[acc])).encode("utf-8"))
+		with open(tmp_offsets, "wb") as fp:
+			offsets.tofile(fp)
+		# write to temporary files then rename, so that readers never see a
+		# partially written index; the stats file is the last to appear
+		os.replace(tmp_data, prefix + ".tsv")
+		os.replace(tmp_offsets, prefix + ".offsets")
+		with open(prefix + ".json.tmp", "w") as fp:
+			json.dump(cls._source_stats(table, delimiter), fp)
+		os.replace(prefix + ".json.tmp", prefix + ".json")
+		return
+
+	@classmethod
+	def open_or_build(cls, table: str, prefix: str, delimiter="\t"):
+		if not cls.is_valid(prefix, table, delimiter=delimiter):
+			cls.build(table, prefix, delimiter=delimiter)
+		return cls(prefix)
+
+	def close(self) -> None:
+		self._offsets.release()
+		for mm in (self._data, self._offsets_mm):
+			if isinstance(mm, mmap.mmap):
+				mm.close()
+		for fp in self._fps:
+			fp.close()
+		return
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *ka):
+		self.close()
+		return
+
+	def __len__(self) -> int:
+		return len(self._offsets)
+
+	def __getitem__(self, i: int) -> bytes:
+		# accession of the i-th line, used by bisect
+		start = self._offsets[i]
+		return self._data[start:self._data.find(b"\t", start)]
+
+	def _taxon(self, i: int) -> str:
+		start = self._data.find(b"\t", self._offsets[i]) + 1
+		return self._data[start:self._data.find(b"\n", start)].decode("utf-8")
+
+	def lookup_many(self, accs: list) -> dict:
+		"""
+		return: dict mapping each of <accs> found in the index to its taxonomy;
+			accessions are looked up in sorted order, so that each bisection
+			starts where the previous one ended
+		"""
+		ret = dict()
+		lo = 0
+		for acc in sorted(set(accs), key=lambda x: x.encode("utf-8")):
+			key = acc.encode("utf-8")
+			lo = bisect.bisect_left(self, key, lo)
+			if (lo < len(self)) and (self[lo] == key):
+				ret[acc] = self._taxon(lo)
+		return ret
+
+
+def map_taxonomy_to_hit_accs(ifile, ofile, *, accs_tax_index: AccsTaxIndex,
+		missing="error", missing_label="NA", batch_size=65536,
 		delimiter="\t") -> None:
-	with get_fp(ifile, "r") as ifp:
-		hit_accs = ifp.read().splitlines()
-
-	with get_fp(ofile, "w") as ofp:
-		for accs in hit_accs:
-			print(delimiter.join([accs, accs_tax_map[accs]]), file=ofp)
+	with get_fp(ifile, "r") as ifp, get_fp(ofile, "w") as ofp:
+		accs_iter = (i.rstrip("\r\n") for i in ifp)
+		while True:
+			batch = list(itertools.islice(accs_iter, batch_size))
+			if not batch:
+				break
+			acc_tax = accs_tax_index.lookup_many(batch)
+			lines = list()
+			for accs in batch:
+				tax = acc_tax.get(accs)
+				if tax is None:
+					if missing == "error":
+						raise KeyError("hit accession '%s' is not in the "
+							"accession to taxonomy map" % accs)
+					elif missing == "skip":
+						continue
+					tax = missing_label
+				lines.append(delimiter.join([accs, tax]) + "\n")
+			ofp.writelines(lines)
 
 	return
 
 
 def main():
 	args = get_args()
-	accs_tax_map = load_accs_tax_map(args.accs_tax_map,
-		delimiter=args.delimiter
-	)
-	map_taxonomy_to_hit_accs(args.hit_accs, args.output,
-		accs_tax_map=accs_tax_map,
-		delimiter=args.delimiter
-	)
+	with AccsTaxIndex.open_or_build(args.accs_tax_map, args.index,
+			delimiter=args.delimiter) as accs_tax_index:
+		try:
+			map_taxonomy_to_hit_accs(args.hit_accs, args.output,
+				accs_tax_index=accs_tax_index,
+				missing=args.missing,
+				missing_label=args.missing_label,
+				batch_size=args.batch_size,
+				delimiter=args.delimiter
+			)
+		except KeyError as e:
+			print("error: %s; see --missing" % e.args[0], file=sys.stderr)
+			sys.exit(1)
 	return
 
 
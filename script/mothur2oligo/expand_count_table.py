@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import stat
+import sys
+
+from mothur_io import iter_fasta, CountTable
+from rename_fasta_headers import open_output, new_header_name, ProgressMeter
+
+
+def get_args() -> argparse.Namespace:
+	ap = argparse.ArgumentParser(description="expand aligned unique sequences "
+		"into renamed redundant reads using the mothur count_table, replacing "
+		"mothur deunique.seqs and the header renaming")
+	ap.add_argument("fasta", type=str,
+		help="input aligned unique fasta, e.g. *.pick.mafft.fasta")
+	ap.add_argument("count_table", type=str,
+		help="mothur count_table of the unique sequences, e.g. "
+			"*.pick.count_table")
+	ap.add_argument("--output", "-o", type=str, default="-",
+		metavar="fasta",
+		help="output redundant fasta with '<sample>_<read>' headers [stdout]")
+	ap.add_argument("--fifo", action="store_true",
+		help="create --output as a named pipe (if not already) and stream into "
+			"it, so that the redundant fasta is never stored on disk; the pipe "
+			"can be read only once, thus each consumer needs its own run [no]")
+	ap.add_argument("--gzip", "-z", action="store_true",
+		help="gzip compress the output; implied if output ends with '.gz' "
+			"[no]")
+	ap.add_argument("--buffer-size", type=int, default=4,
+		metavar="MB",
+		help="output buffer size in megabytes [4]")
+	ap.add_argument("--progress", type=int, default=1000000,
+		metavar="int",
+		help="report progress to stderr every this number of reads, 0 means "
+			"only report the final summary [1000000]")
+	ap.add_argument("--quiet", "-q", action="store_true",
+		help="do not report progress or summary [no]")
+
+	# parse and refine args
+	args = ap.parse_args()
+	if args.fifo and (args.output == "-"):
+		ap.error("--fifo requires -o/--output")
+	if args.output.endswith(".gz"):
+		args.gzip = True
+	if args.output == "-":
+		args.output = sys.stdout.buffer
+
+	return args
+
+
+def iter_expanded_reads(fasta_iter, count_table: CountTable) -> iter:
+	"""
+	yield (sample, header, sequence) for every redundant read, expanding each
+	unique sequence by its per-sample counts, looked up in <count_table> one
+	row at a time
+	"""
+	samples = [i.encode() for i in count_table.samples]
+	for name, seq in fasta_iter:
+		row = count_table.get_row(name.decode())
+		if row is None:
+			raise ValueError("sequence '%s' is not found in count_table"
+				% name.decode())
+		k = 0
+		for i, count in zip(*row):
+			sample = samples[i]
+			for _ in range(count):
+				k += 1
+				yield sample, new_header_name(name + b"_%u" % k, sample), seq
+	return
+
+
+def expand_count_table(ifasta, count_table: CountTable, ofasta, *,
+		progress=None) -> int:
+	n = 0
+	write = ofasta.write
+	for _, header, seq in iter_expanded_reads(iter_fasta(ifasta),
+			count_table):
+		record = b">" + header + b"\n" + seq + b"\n"
+		write(record)
+		n += 1
+		if progress is not None:
+			progress.update(nbytes=len(record))
+	return n
+
+
+def make_fifo(path: str) -> bool:
+	"""
+	create a named pipe at <path>, return True if newly created
+	"""
+	if os.path.exists(path):
+		if not stat.S_ISFIFO(os.stat(path).st_mode):
+			raise IOError("'%s' exists and is not a named pipe" % path)
+		return False
+	os.mkfifo(path)
+	return True
+
+
+def main():
+	args = get_args()
+	progress = ProgressMeter(interval=args.progress, unit="reads",
+		enabled=not args.quiet)
+	fifo_created = make_fifo(args.output) if args.fifo else False
+	try:
+		# opening a named pipe blocks until a reader is attached
+		with CountTable(args.count_table) as count_table, \
+				open_output(args.output, gzip_output=args.gzip,
+					buffer_size=args.buffer_size << 20) as ofp, \
+				open(args.fasta, "rb") as ifp:
+			expand_count_table(ifp, count_table, ofp, progress=progress)
+	finally:
+		if fifo_created:
+			os.unlink(args.output)
+	progress.report(prefix="done")
+	return
+
+
+if __name__ == "__main__":
+	main()
@@ -18,30 +18,58 @@ else
 	processors=$SLURM_CPUS_PER_TASK
 fi
 
-# Set the taxon you want to select, separate taxonomic levels with ";" 
-# Do not touch inner and outer quotes
-taxon="'$(cat extract_taxon)'"
+# The taxon to select is read from the file extract_taxon, separate taxonomic
+# levels with ";"; bootstrap values like "(100)" are allowed
 
-# Call mothur commands for getting taxon-specific seqs
-$mothur "#set.current(processors=$processors); get.lineage(taxonomy=${in_prefix}.taxonomy, taxon=$taxon, count=${in_prefix}.count_table);
-	list.seqs(count=current);
-	get.seqs(accnos=current, fasta=${in_prefix}.fasta)"
+# How to produce the redundant fasta for oligotyping:
+#   auto:   no redundant fasta is written if the oligotyping scripts use the
+#           default weighted/native engines, which read the unique sequences
+#           and count_table directly; otherwise the same as expand
+#   expand: expand the unique sequences by count_table on the fly, without
+#           writing out the mothur deunique.seqs output
+#   mothur: run mothur deunique.seqs, then rename the headers
+deunique="auto"
+if [[ $deunique == "auto" ]]; then
+	if grep -qs '^engine="oligotyping"' \
+			../oligotyping/script/entropy_analysis.sh \
+			../oligotyping/script/oligotyping.sh; then
+		deunique="expand"
+	else
+		deunique="none"
+	fi
+fi
+
+# Get taxon-specific seqs, the taxonomy index is built once next to the mothur
+# output and reused by all taxa
+python3 ./script/taxonomy_index.py \
+	--taxon-file extract_taxon \
+	--taxonomy ${in_prefix}.taxonomy \
+	--fasta ${in_prefix}.fasta \
+	--count-table ${in_prefix}.count_table \
+	-o ${in_prefix}.pick || exit 1
 
 # re-align using mafft
 $mafft --thread $processors \
 	${in_prefix}.pick.fasta > ${in_prefix}.pick.mafft.fasta
 
-# Call mothur commands for generating deuniqued sequences
-$mothur "#set.current(processors=$processors); deunique.seqs(fasta=${in_prefix}.pick.mafft.fasta, count=${in_prefix}.pick.count_table);"
-
-# Replace all "_" in fasta header with a ":"
-sed 's/_/:/g' ${in_prefix}.pick.redundant.groups > intermediate1
-# Make a file which maps sample names to sequence headers
-paste ${in_prefix}.pick.redundant.groups intermediate1 | awk 'BEGIN{FS="\t"}{print $1"\t"$2"_"$3}' > intermediate2
-
-# Perl script to rename the headers of the fasta to include the sample name at the beginning followed by a "_"
-perl ./script/renamer.pl ${in_prefix}.pick.mafft.redundant.fasta intermediate2 
-ln -sfT ${in_prefix}.pick.mafft.redundant.fasta_headers-replaced.fasta final.fasta
+if [[ $deunique == "none" ]]; then
+	echo "weighted/native engines, final.fasta is not needed" >&2
+elif [[ $deunique == "expand" ]]; then
+	# Expand counts and rename the headers to include the sample name at the
+	# beginning followed by a "_" in one go
+	python3 ./script/expand_count_table.py \
+		-o final.fasta \
+		${in_prefix}.pick.mafft.fasta \
+		${in_prefix}.pick.count_table
+else
+	# Call mothur commands for generating deuniqued sequences
+	$mothur "#set.current(processors=$processors); deunique.seqs(fasta=${in_prefix}.pick.mafft.fasta, count=${in_prefix}.pick.count_table);"
 
-# clean up
-rm -f intermediate1 intermediate2
+	# Rename the headers of the fasta to include the sample name at the
+	# beginning followed by a "_", streaming the deuniqued fasta and groups
+	# file in one pass
+	python3 ./script/rename_fasta_headers.py \
+		-o final.fasta \
+		${in_prefix}.pick.mafft.redundant.fasta \
+		${in_prefix}.pick.redundant.groups
+fi
@@ -0,0 +1,137 @@
+"""
+shared readers of fasta and mothur count_table, used by both the mothur2oligo
+and the oligotyping scripts; script/oligotyping/mothur_io.py links here
+"""
+
+
+def iter_fasta(fp) -> iter:
+	"""
+	yield (name, sequence) as bytes from a binary fasta stream, multi-line
+	sequences are joined
+	"""
+	name, seq = None, list()
+	for line in fp:
+		if line.startswith(b">"):
+			if name is not None:
+				yield name, b"".join(seq)
+			name, seq = line[1:].rstrip(b"\r\n"), list()
+		else:
+			seq.append(line.rstrip(b"\r\n"))
+	if name is not None:
+		yield name, b"".join(seq)
+	return
+
+
+class CountTable(object):
+	"""
+	mothur count_table, in either the full or the compressed format, read as a
+	stream; only the header is parsed when opened, each row is parsed when
+	read, either in file order by iteration or by sequence name through an
+	index of line offsets, built on the first lookup; no row is kept in
+	memory
+	"""
+	def __init__(self, path: str, *ka, delimiter="\t", **kw):
+		super().__init__(*ka, **kw)
+		self.path = path
+		self.delimiter = delimiter
+		self.samples = None
+		self.compressed = False
+		self._offsets = None
+		self._fp = open(path, "rb")
+		self._read_header()
+		return
+
+	def _read_header(self) -> None:
+		compressed_samples = None
+		while True:
+			line = self._fp.readline()
+			if not line:
+				raise ValueError("count_table '%s' is empty" % self.path)
+			line = line.decode().rstrip("\r\n")
+			if not line:
+				continue
+			if line.startswith("#"):
+				# compressed format sample index line, e.g. '#1,F3D0	2,F3D1'
+				if not line.startswith("#Compressed"):
+					compressed_samples = [i.split(",", 1)[1]
+						for i in line[1:].split(self.delimiter)]
+				continue
+			# header line
+			break
+		self.compressed = compressed_samples is not None
+		self.samples = compressed_samples if self.compressed \
+			else line.split(self.delimiter)[2:]
+		if not self.samples:
+			raise ValueError("count_table '%s' has no group columns, sample "
+				"names are required" % self.path)
+		self._data_start = self._fp.tell()
+		return
+
+	def close(self) -> None:
+		self._fp.close()
+		return
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *ka):
+		self.close()
+		return
+
+	@property
+	def n_samples(self) -> int:
+		return len(self.samples)
+
+	def parse_row(self, line: bytes) -> (str, list, list):
+		"""
+		return: sequence name, and the sample indices and counts of its
+			non-zero counts
+		"""
+		fields = line.decode().rstrip("\r\n").split(self.delimiter)
+		indices, counts = list(), list()
+		if self.compressed:
+			for i in fields[2:]:
+				s, c = i.split(",")
+				indices.append(int(s) - 1)
+				counts.append(int(c))
+		else:
+			for i, c in enumerate(fields[2:]):
+				if c != "0":
+					indices.append(i)
+					counts.append(int(c))
+		return fields[0], indices, counts
+
+	def __iter__(self) -> iter:
+		"""
+		yield (sequence name, sample indices, counts) of each row in file order
+		"""
+		self._fp.seek(self._data_start)
+		for line in self._fp:
+			if line.strip():
+				yield self.parse_row(line)
+		return
+
+	def _build_offsets(self) -> None:
+		self._offsets = dict()
+		self._fp.seek(self._data_start)
+		pos = self._data_start
+		for line in self._fp:
+			if line.strip():
+				self._offsets[line.split(self.delimiter.encode(), 1)[0]
+					.decode()] = pos
+			pos += len(line)
+		return
+
+	def get_row(self, name: str) -> (list, list):
+		"""
+		return: sample indices and counts of sequence <name>, or None if not
+			in the count_table
+		"""
+		if self._offsets is None:
+			self._build_offsets()
+		pos = self._offsets.get(name)
+		if pos is None:
+			return None
+		self._fp.seek(pos)
+		_, indices, counts = self.parse_row(self._fp.readline())
+		return indices, counts
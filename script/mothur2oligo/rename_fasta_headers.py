@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+import argparse
+import gzip
+import io
+import sys
+import time
+
+
+def get_args() -> argparse.Namespace:
+	ap = argparse.ArgumentParser(description="rename headers of the mothur "
+		"deuniqued fasta into '<sample>_<read>' format for oligotyping, in a "
+		"single streaming pass")
+	ap.add_argument("fasta", type=str,
+		help="input redundant (deuniqued) fasta, e.g. "
+			"*.pick.mafft.redundant.fasta")
+	ap.add_argument("groups", type=str,
+		help="2-column read to sample map, e.g. *.pick.redundant.groups")
+	ap.add_argument("--output", "-o", type=str, default="-",
+		metavar="fasta",
+		help="output fasta with renamed headers [stdout]")
+	ap.add_argument("--gzip", "-z", action="store_true",
+		help="gzip compress the output; implied if output ends with '.gz' "
+			"[no]")
+	ap.add_argument("--compress-level", type=int, default=6,
+		metavar="int",
+		help="gzip compression level, only used with -z/--gzip [6]")
+	ap.add_argument("--buffer-size", type=int, default=4,
+		metavar="MB",
+		help="I/O buffer size in megabytes [4]")
+	ap.add_argument("--progress", type=int, default=1000000,
+		metavar="int",
+		help="report progress to stderr every this number of records, 0 means "
+			"only report the final summary [1000000]")
+	ap.add_argument("--quiet", "-q", action="store_true",
+		help="do not report progress or summary [no]")
+
+	# parse and refine args
+	args = ap.parse_args()
+	if args.output.endswith(".gz"):
+		args.gzip = True
+	if args.output == "-":
+		args.output = sys.stdout.buffer
+
+	return args
+
+
+def get_fp(f, *ka, factory=open, **kw):
+	if isinstance(f, io.IOBase):
+		ret = f
+	elif isinstance(f, str):
+		ret = factory(f, *ka, **kw)
+	else:
+		raise TypeError("first argument of get_fp() must be str or io.IOBase, "
+			"got '%s'" % type(f).__name__)
+	return ret
+
+
+def open_output(f, *, gzip_output=False, compress_level=6,
+		buffer_size=4 << 20) -> io.IOBase:
+	"""
+	open binary output for writing, <f> can be a path or an opened binary
+	stream; when <gzip_output> is set the stream is wrapped by a gzip writer
+	"""
+	fp = get_fp(f, "wb", buffering=buffer_size)
+	if gzip_output:
+		fp = gzip.GzipFile(fileobj=fp, mode="wb", compresslevel=compress_level)
+	return fp
+
+
+class ProgressMeter(object):
+	"""
+	report number of processed records and throughput to a text stream
+	"""
+	def __init__(self, *ka, interval: int = 1000000, file=sys.stderr,
+			unit="records", enabled=True, **kw):
+		super().__init__(*ka, **kw)
+		self.interval = interval
+		self.file = file
+		self.unit = unit
+		self.enabled = enabled
+		self.n = 0
+		self.nbytes = 0
+		self._next_report = interval if interval > 0 else None
+		self._start = time.monotonic()
+		return
+
+	@property
+	def elapsed(self) -> float:
+		return time.monotonic() - self._start
+
+	def update(self, n: int = 1, nbytes: int = 0) -> None:
+		self.n += n
+		self.nbytes += nbytes
+		if (self._next_report is not None) and (self.n >= self._next_report):
+			self._next_report += self.interval
+			self.report()
+		return
+
+	def report(self, prefix="progress") -> None:
+		if not self.enabled:
+			return
+		elapsed = self.elapsed or 1e-9
+		print("%s: %u %s, %.1f MB written, %.1f s elapsed, %.0f %s/s, "
+			"%.1f MB/s" % (prefix, self.n, self.unit, self.nbytes / 1e6,
+				elapsed, self.n / elapsed, self.unit, self.nbytes / 1e6 / elapsed),
+			file=self.file)
+		return
+
+
+class GroupsLookup(object):
+	"""
+	stream the read-to-sample map alongside the fasta; mothur writes both in
+	the same order, so in the normal case each query is answered by the next
+	line and no mapping is held in memory; out-of-order entries are buffered
+	until they are requested
+	"""
+	def __init__(self, fp, *ka, delimiter=b"\t", **kw):
+		super().__init__(*ka, **kw)
+		self._fp = fp
+		self._pending = dict()
+		self.delimiter = delimiter
+		return
+
+	def get(self, name: bytes):
+		if name in self._pending:
+			return self._pending.pop(name)
+		for line in self._fp:
+			fields = line.rstrip(b"\r\n").split(self.delimiter)
+			if len(fields) < 2:
+				continue
+			if fields[0] == name:
+				return fields[1]
+			self._pending[fields[0]] = fields[1]
+		return None
+
+
+def new_header_name(name: bytes, group: bytes) -> bytes:
+	# oligotyping takes everything before the last "_" as the sample name, thus
+	# "_" in the read name are replaced with ":"
+	return group + b"_" + name.replace(b"_", b":")
+
+
+def rename_fasta_headers(ifasta, groups, ofasta, *, progress=None) -> tuple:
+	"""
+	rename headers in <ifasta> by the read-to-sample map in <groups> and write
+	to <ofasta>; headers without a map entry are copied unchanged
+
+	return: number of renamed and unmatched headers
+	"""
+	n_renamed, n_unmatched = 0, 0
+	with get_fp(groups, "rb") as gfp, get_fp(ifasta, "rb") as ifp:
+		lookup = GroupsLookup(gfp)
+		write = ofasta.write
+		for line in ifp:
+			if line.startswith(b">"):
+				name = line[1:].rstrip(b"\r\n")
+				group = lookup.get(name)
+				if group is None:
+					n_unmatched += 1
+				else:
+					line = b">" + new_header_name(name, group) + b"\n"
+					n_renamed += 1
+				if progress is not None:
+					progress.update()
+			write(line)
+			if progress is not None:
+				progress.nbytes += len(line)
+	return n_renamed, n_unmatched
+
+
+def main():
+	args = get_args()
+	progress = ProgressMeter(interval=args.progress, enabled=not args.quiet)
+	buffer_size = args.buffer_size << 20
+	with open_output(args.output, gzip_output=args.gzip,
+			compress_level=args.compress_level, buffer_size=buffer_size) as ofp:
+		n_renamed, n_unmatched = rename_fasta_headers(
+			get_fp(args.fasta, "rb", buffering=buffer_size),
+			get_fp(args.groups, "rb", buffering=buffer_size),
+			ofp, progress=progress,
+		)
+	progress.report(prefix="done")
+	if n_unmatched and not args.quiet:
+		print("warning: %u headers not found in '%s' were kept unchanged"
+			% (n_unmatched, args.groups), file=sys.stderr)
+	return
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+
+import argparse
+import array
+import json
+import os
+import pickle
+import re
+import sys
+
+
+def get_args() -> argparse.Namespace:
+	ap = argparse.ArgumentParser(description="select sequences of a taxon "
+		"from the mothur output via a prefix-trie taxonomy index, replacing "
+		"mothur get.lineage/list.seqs/get.seqs")
+	ag = ap.add_mutually_exclusive_group(required=True)
+	ag.add_argument("--taxon", "-t", type=str,
+		metavar="str",
+		help="';'-separated taxonomy to select, bootstrap values like '(100)' "
+			"are allowed and ignored")
+	ag.add_argument("--taxon-file", "-T", type=str,
+		metavar="file",
+		help="read the taxonomy to select from this file, e.g. extract_taxon")
+	ap.add_argument("--taxonomy", type=str, required=True,
+		metavar="taxonomy",
+		help="mothur taxonomy file (required)")
+	ap.add_argument("--fasta", type=str, required=True,
+		metavar="fasta",
+		help="mothur fasta file (required)")
+	ap.add_argument("--count-table", type=str, required=True,
+		metavar="count_table",
+		help="mothur count_table file (required)")
+	ap.add_argument("--output-prefix", "-o", type=str, required=True,
+		metavar="prefix",
+		help="output prefix, writes <prefix>.{taxonomy,fasta,count_table} "
+			"(required)")
+	ap.add_argument("--index", type=str,
+		metavar="file",
+		help="index file, built once and rebuilt if any input changes; if it "
+			"cannot be written, e.g. in a read-only directory, the index is "
+			"only used in memory [<taxonomy real path>.trie_index]")
+
+	# parse and refine args
+	args = ap.parse_args()
+	if args.taxon_file is not None:
+		with open(args.taxon_file, "r") as fp:
+			args.taxon = fp.read().strip()
+	if args.index is None:
+		args.index = os.path.realpath(args.taxonomy) + ".trie_index"
+
+	return args
+
+
+def split_taxonomy(s: str) -> list:
+	"""
+	split a ';'-separated taxonomy into ranks, removing bootstrap values, e.g.
+	'Bacteria(100);Proteobacteria(98);' becomes ['Bacteria', 'Proteobacteria']
+	"""
+	return [re.sub(r"\(\d+(\.\d+)?\)$", "", i.strip())
+		for i in s.strip().rstrip(";").split(";") if i.strip()]
+
+
+def _source_stats(*paths) -> str:
+	stats = list()
+	for p in paths:
+		st = os.stat(p)
+		stats.append([os.path.realpath(p), st.st_size, st.st_mtime_ns])
+	return json.dumps(stats)
+
+
+def _scan_fasta_offsets(fasta: str) -> dict:
+	"""
+	return: dict mapping each sequence name to the (start, end) byte offsets of
+		its record
+	"""
+	ret = dict()
+	name, start, pos = None, 0, 0
+	with open(fasta, "rb") as fp:
+		for line in fp:
+			if line.startswith(b">"):
+				if name is not None:
+					ret[name] = (start, pos)
+				name, start = line[1:].split()[0].decode(), pos
+			pos += len(line)
+	if name is not None:
+		ret[name] = (start, pos)
+	return ret
+
+
+def _scan_count_table_offsets(count_table: str) -> (bytes, dict):
+	"""
+	return: header lines as bytes, and a dict mapping each sequence name to the
+		(start, end) byte offsets of its line
+	"""
+	header, ret, pos = list(), dict(), 0
+	with open(count_table, "rb") as fp:
+		for line in fp:
+			if (not ret) and (line.startswith(b"#")
+					or line.startswith(b"Representative_Sequence")):
+				header.append(line)
+			else:
+				ret[line.split(b"\t", 1)[0].rstrip().decode()] = \
+					(pos, pos + len(line))
+			pos += len(line)
+	return b"".join(header), ret
+
+
+class TaxonomyIndex(object):
+	"""
+	prefix trie over taxonomy ranks; sequences are stored in trie depth-first
+	order, so that every node maps to a contiguous range of sequence IDs; byte
+	offsets of each sequence in the fasta, count_table and taxonomy are also
+	kept for direct extraction without scanning these files
+	"""
+	def __init__(self, *ka, **kw):
+		super().__init__(*ka, **kw)
+		# node: [children dict, start, end]
+		self.root = [dict(), 0, 0]
+		self.ids = list()
+		self.offsets = dict()
+		self.headers = dict()
+		self.sources = None
+		return
+
+	@classmethod
+	def build(cls, taxonomy: str, fasta: str, count_table: str):
+		new = cls()
+		new.sources = _source_stats(taxonomy, fasta, count_table)
+		# taxonomy, sorted by ranks to get the depth-first order
+		entries = list()
+		pos = 0
+		with open(taxonomy, "rb") as fp:
+			for line in fp:
+				fields = line.decode().rstrip("\r\n").split("\t")
+				if len(fields) >= 2:
+					entries.append((split_taxonomy(fields[-1]), fields[0],
+						(pos, pos + len(line))))
+				pos += len(line)
+		entries.sort(key=lambda x: x[0])
+		for i, (ranks, sid, _) in enumerate(entries):
+			node = new.root
+			node[2] = i + 1
+			for r in ranks:
+				if r not in node[0]:
+					node[0][r] = [dict(), i, i + 1]
+				node = node[0][r]
+				node[2] = i + 1
+			new.ids.append(sid)
+
+		# byte offsets in each file, in the same order as ids
+		fasta_offsets = _scan_fasta_offsets(fasta)
+		ct_header, ct_offsets = _scan_count_table_offsets(count_table)
+		new.headers["count_table"] = ct_header
+		new.offsets["taxonomy"] = cls._offset_array([i[2] for i in entries])
+		new.offsets["fasta"] = cls._offset_array(
+			[fasta_offsets.get(i, (0, 0)) for i in new.ids])
+		new.offsets["count_table"] = cls._offset_array(
+			[ct_offsets.get(i, (0, 0)) for i in new.ids])
+		return new
+
+	@staticmethod
+	def _offset_array(pairs: list) -> array.array:
+		ret = array.array("Q")
+		for s, e in pairs:
+			ret.append(s)
+			ret.append(e)
+		return ret
+
+	def save(self, path: str) -> None:
+		state = dict(root=self.root, ids=self.ids, offsets=self.offsets,
+			headers=self.headers, sources=self.sources)
+		tmp = path + ".tmp"
+		with open(tmp, "wb") as fp:
+			pickle.dump(state, fp, protocol=pickle.HIGHEST_PROTOCOL)
+		os.replace(tmp, path)
+		return
+
+	@classmethod
+	def load(cls, path: str):
+		with open(path, "rb") as fp:
+			state = pickle.load(fp)
+		new = cls()
+		for k, v in state.items():
+			setattr(new, k, v)
+		return new
+
+	@classmethod
+	def load_or_build(cls, path: str, taxonomy: str, fasta: str,
+			count_table: str):
+		if os.path.isfile(path):
+			new = cls.load(path)
+			if new.sources == _source_stats(taxonomy, fasta, count_table):
+				return new
+		new = cls.build(taxonomy, fasta, count_table)
+		# the index file is optional, e.g. in read-only directories
+		try:
+			new.save(path)
+		except OSError as e:
+			print("taxonomy index not saved: %s" % e, file=sys.stderr)
+		return new
+
+	def _iter_nodes(self, node=None) -> iter:
+		node = self.root if node is None else node
+		for name, child in node[0].items():
+			yield name, child
+			yield from self._iter_nodes(child)
+		return
+
+	def find(self, taxon: str) -> list:
+		"""
+		find sequence ID ranges of <taxon>; as mothur get.lineage, the taxon
+		matches from the root if possible, otherwise it is matched as a
+		consecutive path starting at any rank
+
+		return: sorted list of non-overlapping (start, end) ranges
+		"""
+		ranks = split_taxonomy(taxon)
+		if not ranks:
+			raise ValueError("empty taxon")
+
+		def walk(node, ranks):
+			for r in ranks:
+				node = node[0].get(r)
+				if node is None:
+					return None
+			return node
+
+		node = walk(self.root, ranks)
+		if node is not None:
+			return [(node[1], node[2])]
+		ranges = list()
+		for name, n in self._iter_nodes():
+			if name == ranks[0]:
+				node = walk(n, ranks[1:])
+				if node is not None:
+					ranges.append((node[1], node[2]))
+		# merge nested ranges
+		ret = list()
+		for s, e in sorted(ranges):
+			if ret and (s < ret[-1][1]):
+				ret[-1] = (ret[-1][0], max(e, ret[-1][1]))
+			else:
+				ret.append((s, e))
+		return ret
+
+	def select(self, taxon: str) -> list:
+		"""
+		return: indices into self.ids of sequences of <taxon>
+		"""
+		return [i for s, e in self.find(taxon) for i in range(s, e)]
+
+	def missing(self, seq_idx: list, key: str) -> list:
+		"""
+		return: indices of <seq_idx> without a record in the <key> file, e.g.
+			sequences of the taxonomy missing from a mismatched fasta
+		"""
+		offsets = self.offsets[key]
+		return [i for i in seq_idx if offsets[2 * i + 1] <= offsets[2 * i]]
+
+	def extract(self, seq_idx: list, key: str, src: str, dst: str, *,
+			header: bytes = b"") -> None:
+		"""
+		copy records of <seq_idx> from <src> to <dst> by their byte offsets,
+		read in file order
+		"""
+		offsets = self.offsets[key]
+		spans = sorted((offsets[2 * i], offsets[2 * i + 1]) for i in seq_idx)
+		with open(src, "rb") as ifp, open(dst, "wb") as ofp:
+			ofp.write(header)
+			for s, e in spans:
+				if e > s:
+					ifp.seek(s)
+					ofp.write(ifp.read(e - s))
+		return
+
+
+def main():
+	args = get_args()
+	index = TaxonomyIndex.load_or_build(args.index, args.taxonomy, args.fasta,
+		args.count_table)
+	seq_idx = index.select(args.taxon)
+	if not seq_idx:
+		print("no sequence found for taxon '%s'" % args.taxon, file=sys.stderr)
+		sys.exit(1)
+	# a mismatched set of inputs would silently drop sequences
+	n_missing = 0
+	for key, fname in [("fasta", args.fasta),
+			("count_table", args.count_table)]:
+		missing = index.missing(seq_idx, key)
+		if missing:
+			print("%u of %u selected sequences are not in %s '%s', e.g. '%s'"
+				% (len(missing), len(seq_idx), key, fname,
+					index.ids[missing[0]]), file=sys.stderr)
+			n_missing += len(missing)
+	if n_missing:
+		sys.exit(1)
+	index.extract(seq_idx, "taxonomy", args.taxonomy,
+		args.output_prefix + ".taxonomy")
+	index.extract(seq_idx, "fasta", args.fasta, args.output_prefix + ".fasta")
+	index.extract(seq_idx, "count_table", args.count_table,
+		args.output_prefix + ".count_table",
+		header=index.headers["count_table"])
+	print("selected %u sequences" % len(seq_idx), file=sys.stderr)
+	return
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+
+import argparse
+import concurrent.futures
+import io
+import os
+import re
+import shutil
+import subprocess
+import sys
+
+# the taxonomy parser and index of mothur2oligo, so that taxa are selected by
+# the same rule as script/taxonomy_index.py in a single taxon directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+	"mothur2oligo"))
+from taxonomy_index import split_taxonomy, TaxonomyIndex
+
+
+def get_args() -> argparse.Namespace:
+	ap = argparse.ArgumentParser(description="set up and run the oligotyping "
+		"analysis of multiple taxa at once, partitioning the mothur output in a "
+		"single pass instead of one oligo.prototype copy per taxon")
+	ap.add_argument("taxa", type=str,
+		help="list of taxa, one per line as '<taxonomy>' or "
+			"'<name><tab><taxonomy>'; the taxonomy is a ';'-separated path, "
+			"matched from the root if possible, otherwise starting at any rank "
+			"as mothur get.lineage; bootstrap values like '(100)' are allowed "
+			"and ignored; the analysis of each taxon is placed in "
+			"oligo.<name>, <name> is the lowercased last rank if omitted")
+	ap.add_argument("--fasta", type=str,
+		default="mothur/mothur.output/final.fasta",
+		metavar="fasta",
+		help="mothur output fasta [mothur/mothur.output/final.fasta]")
+	ap.add_argument("--taxonomy", type=str,
+		default="mothur/mothur.output/final.taxonomy",
+		metavar="taxonomy",
+		help="mothur output taxonomy [mothur/mothur.output/final.taxonomy]")
+	ap.add_argument("--count-table", type=str,
+		default="mothur/mothur.output/final.count_table",
+		metavar="count_table",
+		help="mothur output count_table "
+			"[mothur/mothur.output/final.count_table]")
+	ap.add_argument("--index", type=str,
+		metavar="file",
+		help="taxonomy index file of script/taxonomy_index.py, built once and "
+			"rebuilt if any input changes [<taxonomy real path>.trie_index]")
+	ap.add_argument("--prototype", type=str, default="oligo.prototype",
+		metavar="dir",
+		help="analysis template directory, copied as oligo.<name> next to it "
+			"[oligo.prototype]")
+	ap.add_argument("--jobs", "-j", type=int, default=1,
+		metavar="int",
+		help="number of taxa processed concurrently [1]")
+	ap.add_argument("--threads", "-T", type=int, default=1,
+		metavar="int",
+		help="number of threads used by each taxon, e.g. by mafft [1]")
+	ap.add_argument("--mafft", type=str, default="mafft",
+		metavar="path",
+		help="mafft executable [mafft]")
+	ap.add_argument("--write-final-fasta", action="store_true",
+		help="always write the redundant mothur2oligo/final.fasta; it is "
+			"written anyway for taxa whose entropy_analysis.sh or "
+			"oligotyping.sh are set to use the external oligotyping engine "
+			"[no]")
+	ap.add_argument("--partition-only", action="store_true",
+		help="only set up the taxon directories and partition the sequences, "
+			"do not run the downstream stages [no]")
+
+	# parse and refine args
+	args = ap.parse_args()
+	if args.jobs < 1:
+		ap.error("-j/--jobs must be positive")
+	if args.threads < 1:
+		ap.error("-T/--threads must be positive")
+	if args.index is None:
+		args.index = os.path.realpath(args.taxonomy) + ".trie_index"
+
+	return args
+
+
+def get_fp(f, *ka, factory=open, **kw):
+	if isinstance(f, io.IOBase):
+		ret = f
+	elif isinstance(f, str):
+		ret = factory(f, *ka, **kw)
+	else:
+		raise TypeError("first argument of get_fp() must be str or io.IOBase, "
+			"got '%s'" % type(f).__name__)
+	return ret
+
+
+class BatchTaxon(object):
+	def __init__(self, name: str, taxonomy: str, *ka, **kw):
+		super().__init__(*ka, **kw)
+		ranks = split_taxonomy(taxonomy)
+		if not ranks:
+			raise ValueError("empty taxonomy of taxon '%s'" % name)
+		self.name = name
+		# without bootstrap values, the trailing ';' is always kept
+		self.taxonomy = (";").join(ranks) + ";"
+		return
+
+	@property
+	def dirname(self) -> str:
+		return "oligo." + self.name
+
+	@classmethod
+	def from_line(cls, line: str):
+		fields = line.rstrip("\r\n").split("\t")
+		if len(fields) >= 2:
+			name, taxonomy = fields[0], fields[1]
+		else:
+			taxonomy = fields[0]
+			ranks = split_taxonomy(taxonomy)
+			name = ranks[-1].lower() if ranks else ""
+		return cls(name, taxonomy)
+
+
+def load_taxa_list(f) -> list:
+	ret = list()
+	with get_fp(f, "r") as fp:
+		for line in fp:
+			if line.strip() and not line.startswith("#"):
+				ret.append(BatchTaxon.from_line(line))
+	names = [i.name for i in ret]
+	if len(set(names)) != len(names):
+		raise ValueError("taxon names in '%s' are not unique" % f)
+	return ret
+
+
+def setup_taxon_dir(taxon: BatchTaxon, prototype: str) -> str:
+	"""
+	copy <prototype> as oligo.<name> next to it, keeping symlinks
+	"""
+	path = os.path.join(os.path.dirname(os.path.abspath(prototype)),
+		taxon.dirname)
+	if not os.path.isdir(path):
+		shutil.copytree(prototype, path, symlinks=True)
+	with open(os.path.join(path, "mothur2oligo", "extract_taxon"), "w") as fp:
+		print(taxon.taxonomy, file=fp)
+	return path
+
+
+def select_taxon_seqs(index: TaxonomyIndex, taxa: list) -> dict:
+	"""
+	select the sequences of every taxon through the taxonomy index
+
+	return: dict mapping each sequence name to the list of indices of taxa it
+		belongs to; sequences not in any taxon are omitted
+	"""
+	ret = dict()
+	for i, t in enumerate(taxa):
+		for j in index.select(t.taxonomy):
+			ret.setdefault(index.ids[j], list()).append(i)
+	return ret
+
+
+def partition_mothur_output(fasta: str, count_table: str, seq_taxa: dict,
+		out_dirs: list, prefix="mothur.output.seqs.pick") -> list:
+	"""
+	write the fasta and count_table subset of each taxon to
+	<out_dir>/mothur2oligo/<prefix>.{fasta,count_table}, reading each mothur
+	output file only once
+
+	return: number of sequences written to each taxon
+	"""
+	n_seqs = [0] * len(out_dirs)
+	# count_table
+	ofps = [open(os.path.join(d, "mothur2oligo", prefix + ".count_table"), "w")
+		for d in out_dirs]
+	try:
+		with open(count_table, "r") as fp:
+			for line in fp:
+				if line.startswith("#") or line.startswith("Representative"):
+					# header lines go to all taxa
+					for o in ofps:
+						o.write(line)
+					continue
+				for i in seq_taxa.get(line.split("\t", 1)[0], ()):
+					ofps[i].write(line)
+	finally:
+		for o in ofps:
+			o.close()
+	# fasta
+	ofps = [open(os.path.join(d, "mothur2oligo", prefix + ".fasta"), "w")
+		for d in out_dirs]
+	try:
+		with open(fasta, "r") as fp:
+			targets = ()
+			for line in fp:
+				if line.startswith(">"):
+					targets = seq_taxa.get(line[1:].split()[0], ())
+					for i in targets:
+						n_seqs[i] += 1
+				for i in targets:
+					ofps[i].write(line)
+	finally:
+		for o in ofps:
+			o.close()
+	return n_seqs
+
+
+# engines of the oligotyping stage scripts that read the unique sequences and
+# count_table, instead of the redundant final.fasta
+NATIVE_ENGINES = {
+	"entropy_analysis.sh": "weighted",
+	"oligotyping.sh": "native",
+}
+
+
+def needs_final_fasta(taxon_dir: str) -> bool:
+	"""
+	read the engine="..." setting of each oligotyping stage script of a taxon
+	directory
+
+	return: if any stage uses the external oligotyping engine, which reads the
+		redundant final.fasta
+	"""
+	ret = False
+	for script, native in NATIVE_ENGINES.items():
+		fname = os.path.join(taxon_dir, "oligotyping", "script", script)
+		with open(fname, "r") as fp:
+			m = re.search(r"^engine=[\"']?(\w+)", fp.read(), re.MULTILINE)
+		if m is None:
+			raise ValueError("no engine setting found in '%s'" % fname)
+		if m.group(1) == "oligotyping":
+			ret = True
+		elif m.group(1) != native:
+			raise ValueError("unknown engine '%s' in '%s'" % (m.group(1),
+				fname))
+	return ret
+
+
+def run_taxon_stages(taxon_dir: str, *, mafft="mafft", threads=1,
+		write_final_fasta=False) -> (str, int):
+	"""
+	run the per-taxon stages after partitioning: realign with mafft, then
+	entropy_analysis.sh and oligotyping.sh; output of all stages is logged in
+	<taxon_dir>/batch.log
+
+	return: taxon_dir and the return code of the first failing stage, or 0
+	"""
+	m2o_dir = os.path.join(taxon_dir, "mothur2oligo")
+	oligo_dir = os.path.join(taxon_dir, "oligotyping")
+	prefix = "mothur.output.seqs.pick"
+	env = dict(os.environ, SLURM_CPUS_PER_TASK=str(threads))
+	stages = [
+		(m2o_dir, [mafft, "--thread", str(threads), prefix + ".fasta"],
+			prefix + ".mafft.fasta"),
+	]
+	if write_final_fasta:
+		stages.append((m2o_dir, ["python3", "script/expand_count_table.py",
+			"-q", "-o", "final.fasta", prefix + ".mafft.fasta",
+			prefix + ".count_table"], None))
+	stages.append((oligo_dir, ["bash", "script/entropy_analysis.sh"], None))
+	stages.append((oligo_dir, ["bash", "script/oligotyping.sh"], None))
+
+	with open(os.path.join(taxon_dir, "batch.log"), "w") as log:
+		for cwd, cmd, stdout_file in stages:
+			print("running: %s (in %s)" % (" ".join(cmd), cwd), file=log,
+				flush=True)
+			if stdout_file is None:
+				ret = subprocess.run(cmd, cwd=cwd, env=env, stdout=log,
+					stderr=subprocess.STDOUT).returncode
+			else:
+				with open(os.path.join(cwd, stdout_file), "w") as out:
+					ret = subprocess.run(cmd, cwd=cwd, env=env, stdout=out,
+						stderr=log).returncode
+			if ret:
+				print("stage failed with return code %d" % ret, file=log)
+				return taxon_dir, ret
+	return taxon_dir, 0
+
+
+def main():
+	args = get_args()
+	taxa = load_taxa_list(args.taxa)
+	taxon_dirs = [setup_taxon_dir(t, args.prototype) for t in taxa]
+
+	# partition
+	index = TaxonomyIndex.load_or_build(args.index, args.taxonomy, args.fasta,
+		args.count_table)
+	seq_taxa = select_taxon_seqs(index, taxa)
+	n_seqs = partition_mothur_output(args.fasta, args.count_table, seq_taxa,
+		taxon_dirs)
+	for t, n in zip(taxa, n_seqs):
+		print("%s: %u unique sequences" % (t.dirname, n), file=sys.stderr)
+	if args.partition_only:
+		return
+
+	# downstream stages, the redundant final.fasta is written for taxa set to
+	# the external engine; engine settings are checked before any stage runs
+	try:
+		write_final_fasta = [args.write_final_fasta or needs_final_fasta(d)
+			for d in taxon_dirs]
+	except (OSError, ValueError) as e:
+		print("error: %s" % e, file=sys.stderr)
+		sys.exit(1)
+	n_failed = 0
+	with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as pool:
+		futures = [pool.submit(run_taxon_stages, d, mafft=args.mafft,
+				threads=args.threads, write_final_fasta=w)
+			for d, n, w in zip(taxon_dirs, n_seqs, write_final_fasta) if n]
+		for f in concurrent.futures.as_completed(futures):
+			taxon_dir, ret = f.result()
+			if ret:
+				n_failed += 1
+				print("%s: failed, see %s" % (taxon_dir,
+					os.path.join(taxon_dir, "batch.log")), file=sys.stderr)
+			else:
+				print("%s: done" % taxon_dir, file=sys.stderr)
+	if n_failed:
+		sys.exit(1)
+	return
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+
+import argparse
+import io
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+
+
+def get_args() -> argparse.Namespace:
+	ap = argparse.ArgumentParser(description="persistent accession to "
+		"taxonomy cache of blastdbcmd lookups")
+	ap.add_argument("--cache", "-C", type=str,
+		default=default_cache_path(),
+		metavar="sqlite",
+		help="cache database file [$BLAST_TAX_CACHE, or "
+			"~/.cache/oligotyping/acc_tax.<db name>.sqlite]")
+	sp = ap.add_subparsers(dest="mode", required=True)
+	p = sp.add_parser("resolve", help="write the blastdbcmd taxonomy line of "
+		"each accession, querying blastdbcmd only for accessions not in the "
+		"cache; tool and database paths are read from the same environment "
+		"variables as worker.oligo_fasta_blastn.sh")
+	p.add_argument("--input", "-i", type=str, default="-",
+		metavar="txt",
+		help="single-column hit accession list [stdin]")
+	p.add_argument("--output", "-o", type=str, default="-",
+		metavar="txt",
+		help="output in blastdbcmd -outfmt '%%a\\t%%T\\t%%S' format, one line "
+			"per input accession [stdout]")
+	p = sp.add_parser("import", help="add existing blastdbcmd outputs to the "
+		"cache")
+	p.add_argument("files", type=str, nargs="+",
+		help="blastdbcmd output files in '%%a\\t%%T\\t%%S' format")
+	sp.add_parser("stats", help="show number of cached accessions")
+
+	# parse and refine args
+	args = ap.parse_args()
+	if getattr(args, "input", None) == "-":
+		args.input = sys.stdin
+	if getattr(args, "output", None) == "-":
+		args.output = sys.stdout
+
+	return args
+
+
+def get_fp(f, *ka, factory=open, **kw):
+	if isinstance(f, io.IOBase):
+		ret = f
+	elif isinstance(f, str):
+		ret = factory(f, *ka, **kw)
+	else:
+		raise TypeError("first argument of get_fp() must be str or io.IOBase, "
+			"got '%s'" % type(f).__name__)
+	return ret
+
+
+def default_cache_path() -> str:
+	path = os.environ.get("BLAST_TAX_CACHE")
+	if path:
+		return path
+	db = os.environ.get("BLAST_DB", "nt")
+	return os.path.join(os.path.expanduser("~"), ".cache", "oligotyping",
+		"acc_tax.%s.sqlite" % os.path.basename(db.rstrip("/")))
+
+
+def strip_accession_version(acc: str) -> str:
+	return acc.split(".", 1)[0]
+
+
+def parse_blastdbcmd_line(line: str) -> tuple:
+	"""
+	parse a blastdbcmd '%a\\t%T\\t%S' output line
+
+	return: (key accession without version, accession, taxid, scientific name)
+	"""
+	fields = line.rstrip("\r\n").split("\t")
+	fields += [""] * (3 - len(fields))
+	return (strip_accession_version(fields[0]), fields[0], fields[1],
+		fields[2])
+
+
+class AccTaxCache(object):
+	"""
+	sqlite-backed map of accession (without version) to the blastdbcmd
+	accession, taxid and scientific name; accessions blastdbcmd did not find
+	are kept as negative entries with a NULL accession, so that they are not
+	queried again; safe to share between concurrent workers
+	"""
+	batch_size = 500
+
+	def __init__(self, path: str, *ka, **kw):
+		super().__init__(*ka, **kw)
+		self.path = path
+		if os.path.dirname(path):
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+		self.conn = sqlite3.connect(path, timeout=600)
+		with self.conn:
+			self.conn.execute("CREATE TABLE IF NOT EXISTS acc_tax ("
+				"key TEXT PRIMARY KEY, acc TEXT, taxid TEXT, name TEXT) "
+				"WITHOUT ROWID")
+		self.n_lookups = 0
+		self.n_hits = 0
+		self.n_fetched = 0
+		self.n_not_found = 0
+		return
+
+	def close(self) -> None:
+		self.conn.close()
+		return
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *ka):
+		self.close()
+		return
+
+	def __len__(self) -> int:
+		return self.conn.execute("SELECT COUNT(*) FROM acc_tax "
+			"WHERE acc IS NOT NULL").fetchone()[0]
+
+	def _get_many(self, keys) -> dict:
+		"""
+		return: dict mapping each cached key to (acc, taxid, name), all None if
+			the key is a negative entry
+		"""
+		keys = list(keys)
+		ret = dict()
+		for i in range(0, len(keys), self.batch_size):
+			batch = keys[i:i + self.batch_size]
+			cur = self.conn.execute("SELECT key, acc, taxid, name FROM acc_tax "
+				"WHERE key IN (%s)" % (",").join("?" * len(batch)), batch)
+			for k, acc, taxid, name in cur:
+				ret[k] = (acc, taxid, name)
+		return ret
+
+	def get_many(self, keys) -> dict:
+		"""
+		return: dict mapping each found key to (acc, taxid, name)
+		"""
+		return {k: v for k, v in self._get_many(keys).items()
+			if v[0] is not None}
+
+	def put_many(self, rows) -> None:
+		"""
+		rows: iterable of (key, acc, taxid, name)
+		"""
+		with self.conn:
+			self.conn.executemany("INSERT OR REPLACE INTO acc_tax "
+				"VALUES (?, ?, ?, ?)", rows)
+		return
+
+	def resolve(self, accs, fetch) -> dict:
+		"""
+		look up taxonomy of <accs>, calling <fetch> once with the deduplicated
+		list of accessions not in the cache; <fetch> returns blastdbcmd output
+		lines, which are added to the cache; accessions not in its output are
+		cached as negative entries
+
+		return: dict mapping key (accession without version) to
+			(acc, taxid, name)
+		"""
+		accs = list(accs)
+		keys = dict.fromkeys(strip_accession_version(i) for i in accs)
+		cached = self._get_many(keys)
+		ret = {k: v for k, v in cached.items() if v[0] is not None}
+		missing = [k for k in keys if k not in cached]
+		self.n_lookups += len(keys)
+		self.n_hits += len(keys) - len(missing)
+		if missing:
+			rows = [parse_blastdbcmd_line(i) for i in fetch(missing) if i.strip()]
+			self.put_many(rows)
+			self.n_fetched += len(rows)
+			for k, acc, taxid, name in rows:
+				ret[k] = (acc, taxid, name)
+			not_found = [k for k in missing if k not in ret]
+			# a concurrent worker may have found it meanwhile, keep that
+			with self.conn:
+				self.conn.executemany("INSERT OR IGNORE INTO acc_tax "
+					"VALUES (?, NULL, NULL, NULL)", [(k,) for k in not_found])
+			self.n_not_found += len(not_found)
+		return ret
+
+	@property
+	def hit_rate(self) -> float:
+		return self.n_hits / self.n_lookups if self.n_lookups else 0.0
+
+	def report(self, file=sys.stderr) -> None:
+		print("accession taxonomy cache: %u unique lookups, %u hits (%.1f%%), "
+			"%u fetched by blastdbcmd, %u not found, %u cached in total"
+			% (self.n_lookups, self.n_hits, self.hit_rate * 100,
+				self.n_fetched, self.n_not_found, len(self)), file=file)
+		return
+
+
+def fetch_blastdbcmd(accs: list, config) -> list:
+	"""
+	query blastdbcmd for <accs> in one batch, <config> is a
+	oligo_blastn.BlastConfig; as the shell worker, a non-zero exit status is
+	not an error as long as the output is written, e.g. blastdbcmd exits
+	non-zero if any accession of the batch is not found, but still writes
+	the others
+
+	return: blastdbcmd output lines
+	"""
+	with tempfile.TemporaryDirectory() as tmp:
+		entry_batch = os.path.join(tmp, "accs")
+		out = os.path.join(tmp, "out")
+		with open(entry_batch, "w") as fp:
+			fp.write("".join([i + "\n" for i in accs]))
+		ret = subprocess.run(config.blastdbcmd_cmd(entry_batch, out)).returncode
+		if not os.path.isfile(out):
+			raise IOError("blastdbcmd wrote no output, return code %d" % ret)
+		if ret:
+			print("blastdbcmd exited with return code %d, keeping its partial "
+				"output" % ret, file=sys.stderr)
+		with open(out, "r") as fp:
+			return fp.read().splitlines()
+
+
+def format_blastdbcmd_lines(accs: list, acc_tax: dict) -> list:
+	"""
+	blastdbcmd output lines of <accs> in order, one per accession; unresolved
+	accessions are skipped, the same as by blastdbcmd
+	"""
+	ret = list()
+	for i in accs:
+		v = acc_tax.get(strip_accession_version(i))
+		if v is not None:
+			ret.append("\t".join(v))
+	return ret
+
+
+def main():
+	args = get_args()
+	with AccTaxCache(args.cache) as cache:
+		if args.mode == "resolve":
+			# imported here to avoid a circular import
+			from oligo_blastn import BlastConfig
+			config = BlastConfig.from_env()
+			with get_fp(args.input, "r") as fp:
+				accs = [i.strip() for i in fp if i.strip()]
+			acc_tax = cache.resolve(accs, lambda x: fetch_blastdbcmd(x, config))
+			with get_fp(args.output, "w") as fp:
+				fp.write("".join([i + "\n"
+					for i in format_blastdbcmd_lines(accs, acc_tax)]))
+			cache.report()
+		elif args.mode == "import":
+			for f in args.files:
+				with open(f, "r") as fp:
+					cache.put_many([parse_blastdbcmd_line(i) for i in fp
+						if i.strip()])
+			cache.report()
+		elif args.mode == "stats":
+			print("%u accessions cached in '%s'" % (len(cache), args.cache))
+	return
+
+
+if __name__ == "__main__":
+	main()
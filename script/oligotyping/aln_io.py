@@ -0,0 +1,227 @@
+"""
+weighted alignment of aligned fasta and mothur count_table, and its binary
+cache, used by the native entropy and oligotyping scripts; the fasta and
+count_table readers are shared with mothur2oligo in mothur_io.py
+"""
+
+import io
+import json
+import os
+
+import numpy
+
+from mothur_io import iter_fasta, CountTable
+
+
+def get_fp(f, *ka, factory=open, **kw):
+	if isinstance(f, io.IOBase):
+		ret = f
+	elif isinstance(f, str):
+		ret = factory(f, *ka, **kw)
+	else:
+		raise TypeError("first argument of get_fp() must be str or io.IOBase, "
+			"got '%s'" % type(f).__name__)
+	return ret
+
+
+def sample_from_read_name(name: str) -> str:
+	# oligotyping convention: everything before the last "_" is the sample name
+	return name.rsplit("_", 1)[0]
+
+
+def sequences_to_matrix(seqs: list) -> numpy.ndarray:
+	"""
+	encode equal-length aligned sequences (bytes) as an uppercase uint8 matrix
+	"""
+	if not seqs:
+		return numpy.zeros((0, 0), dtype=numpy.uint8)
+	ncol = len(seqs[0])
+	for i, s in enumerate(seqs):
+		if len(s) != ncol:
+			raise ValueError("sequence #%u has length %u, expected %u; input "
+				"must be aligned" % (i + 1, len(s), ncol))
+	buf = b"".join(seqs).upper()
+	return numpy.frombuffer(buf, dtype=numpy.uint8).reshape(len(seqs), ncol)
+
+
+class WeightedAlignment(object):
+	"""
+	aligned unique sequences with their per-sample counts; redundant reads of
+	the same sequence are represented once with a count in each sample
+	"""
+	def __init__(self, names: list, matrix: numpy.ndarray, samples: list,
+			counts: numpy.ndarray, *ka, **kw):
+		super().__init__(*ka, **kw)
+		self.names = list(names)
+		self.matrix = matrix
+		self.samples = list(samples)
+		self.counts = numpy.asarray(counts, dtype=numpy.int64)
+		self.validate()
+		return
+
+	def validate(self) -> None:
+		if self.matrix.ndim != 2:
+			raise ValueError("matrix must be 2-dimensional")
+		if len(self.names) != self.matrix.shape[0]:
+			raise ValueError("number of names must match number of matrix rows")
+		if self.counts.shape != (len(self.names), len(self.samples)):
+			raise ValueError("counts must be a sequences x samples matrix")
+		return
+
+	@property
+	def n_seqs(self) -> int:
+		return self.matrix.shape[0]
+
+	@property
+	def n_columns(self) -> int:
+		return self.matrix.shape[1]
+
+	@property
+	def n_samples(self) -> int:
+		return len(self.samples)
+
+	@property
+	def weights(self) -> numpy.ndarray:
+		return self.counts.sum(axis=1)
+
+	@classmethod
+	def from_unique_fasta(cls, fasta, count_table):
+		names, seqs, rows = list(), list(), list()
+		with CountTable(count_table) as ct, get_fp(fasta, "rb") as fp:
+			for name, seq in iter_fasta(fp):
+				name = name.decode()
+				row = ct.get_row(name)
+				if row is None:
+					raise ValueError("sequence '%s' is not found in count_table"
+						% name)
+				names.append(name)
+				seqs.append(seq)
+				rows.append(row)
+			samples = ct.samples
+		counts = numpy.zeros((len(names), len(samples)), dtype=numpy.int64)
+		for i, (indices, c) in enumerate(rows):
+			counts[i, indices] = c
+		return cls(names=names, matrix=sequences_to_matrix(seqs),
+			samples=samples, counts=counts)
+
+	@classmethod
+	def from_redundant_fasta(cls, fasta):
+		# collapse identical reads while streaming, so that memory scales with
+		# the number of unique sequences instead of reads
+		seq_index, sample_index = dict(), dict()
+		names, seqs, pairs = list(), list(), dict()
+		with get_fp(fasta, "rb") as fp:
+			for name, seq in iter_fasta(fp):
+				seq = seq.upper()
+				i = seq_index.get(seq)
+				if i is None:
+					i = seq_index[seq] = len(seqs)
+					names.append(name.decode())
+					seqs.append(seq)
+				s = sample_from_read_name(name.decode())
+				j = sample_index.setdefault(s, len(sample_index))
+				pairs[(i, j)] = pairs.get((i, j), 0) + 1
+		counts = numpy.zeros((len(seqs), len(sample_index)), dtype=numpy.int64)
+		if pairs:
+			idx = numpy.asarray(list(pairs.keys()), dtype=numpy.intp)
+			counts[idx[:, 0], idx[:, 1]] = list(pairs.values())
+		return cls(names=names, matrix=sequences_to_matrix(seqs),
+			samples=list(sample_index.keys()), counts=counts)
+
+	@classmethod
+	def load(cls, fasta, count_table=None):
+		"""
+		load from aligned unique fasta with <count_table>, or from a redundant
+		fasta with '<sample>_<read>' headers if <count_table> is None
+		"""
+		if count_table is None:
+			return cls.from_redundant_fasta(fasta)
+		return cls.from_unique_fasta(fasta, count_table)
+
+
+def _source_stats(*paths) -> str:
+	stats = list()
+	for p in paths:
+		if p is None:
+			stats.append(None)
+		else:
+			st = os.stat(p)
+			stats.append([os.path.realpath(p), st.st_size, st.st_mtime_ns])
+	return json.dumps(stats)
+
+
+class AlignmentCache(object):
+	"""
+	on-disk binary copy of a WeightedAlignment: the uint8 alignment matrix is
+	stored column-major in <prefix>.npy so that column slices are contiguous
+	and can be read through numpy.memmap without parsing, while names, samples
+	and counts are in the sidecar <prefix>.index.npz; the cache is invalidated
+	when size or mtime of the source fasta or count_table changes
+	"""
+	def __init__(self, prefix: str, *ka, **kw):
+		super().__init__(*ka, **kw)
+		self.prefix = prefix
+		return
+
+	@classmethod
+	def from_fasta(cls, fasta: str):
+		return cls(fasta + ".alncache")
+
+	@property
+	def matrix_file(self) -> str:
+		return self.prefix + ".npy"
+
+	@property
+	def index_file(self) -> str:
+		return self.prefix + ".index.npz"
+
+	def is_valid(self, fasta: str, count_table: str = None) -> bool:
+		if not (os.path.isfile(self.matrix_file)
+				and os.path.isfile(self.index_file)):
+			return False
+		with numpy.load(self.index_file) as index:
+			sources = str(index["sources"])
+		return sources == _source_stats(fasta, count_table)
+
+	def save(self, aln: WeightedAlignment, fasta: str, count_table: str = None
+			) -> None:
+		# write to temporary files then rename, so that readers never see a
+		# partially written cache
+		tmp_matrix = self.matrix_file + ".tmp"
+		mm = numpy.lib.format.open_memmap(tmp_matrix, mode="w+",
+			dtype=numpy.uint8, shape=aln.matrix.shape, fortran_order=True)
+		mm[:] = aln.matrix
+		mm.flush()
+		del mm
+		tmp_index = self.index_file + ".tmp.npz"
+		numpy.savez(tmp_index,
+			names=numpy.asarray(aln.names, dtype=str),
+			samples=numpy.asarray(aln.samples, dtype=str),
+			counts=aln.counts,
+			sources=numpy.asarray(_source_stats(fasta, count_table)),
+		)
+		os.replace(tmp_matrix, self.matrix_file)
+		os.replace(tmp_index, self.index_file)
+		return
+
+	def load(self, mmap_mode="r") -> WeightedAlignment:
+		matrix = numpy.load(self.matrix_file, mmap_mode=mmap_mode)
+		with numpy.load(self.index_file) as index:
+			names = index["names"].tolist()
+			samples = index["samples"].tolist()
+			counts = index["counts"]
+		return WeightedAlignment(names=names, matrix=matrix, samples=samples,
+			counts=counts)
+
+	@classmethod
+	def load_or_build(cls, fasta: str, count_table: str = None, *,
+			prefix: str = None, mmap_mode="r") -> WeightedAlignment:
+		"""
+		open the cache of <fasta> (and <count_table>) as a memory-mapped
+		WeightedAlignment, (re)building it first if missing or stale
+		"""
+		cache = cls.from_fasta(fasta) if prefix is None else cls(prefix)
+		if not cache.is_valid(fasta, count_table):
+			aln = WeightedAlignment.load(fasta, count_table)
+			cache.save(aln, fasta, count_table)
+		return cache.load(mmap_mode=mmap_mode)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+import argparse
+import random
+import sys
+import time
+
+import job_scheduler
+
+
+def get_args() -> argparse.Namespace:
+	ap = argparse.ArgumentParser(description="compare the job splitting "
+		"strategies of job_scheduler.py on simulated oligo representative "
+		"sizes, i.e. estimated BLAST cost of number of unique sequences times "
+		"sequence length")
+	ap.add_argument("--num-oligos", "-n", type=str, default="20,100,500",
+		metavar="int,int,...",
+		help="comma-separated numbers of oligos [20,100,500]")
+	ap.add_argument("--num-jobs", "-k", type=str, default="4,16,64",
+		metavar="int,int,...",
+		help="comma-separated numbers of jobs [4,16,64]")
+	ap.add_argument("--repeats", "-r", type=int, default=10,
+		metavar="int",
+		help="number of simulated size sets per setting [10]")
+	ap.add_argument("--strategies", "-s", type=str,
+		default=(",").join(job_scheduler.STRATEGIES),
+		metavar="str,str,...",
+		help="comma-separated strategies to compare [%s]"
+			% (",").join(job_scheduler.STRATEGIES))
+	ap.add_argument("--seed", type=int, default=0,
+		metavar="int",
+		help="random seed [0]")
+	ap.add_argument("--output", "-o", type=str, default="-",
+		metavar="tsv",
+		help="output table [stdout]")
+
+	# parse and refine args
+	args = ap.parse_args()
+	args.num_oligos = [int(i) for i in args.num_oligos.split(",")]
+	args.num_jobs = [int(i) for i in args.num_jobs.split(",")]
+	args.strategies = args.strategies.split(",")
+	for s in args.strategies:
+		if s not in job_scheduler.STRATEGIES:
+			ap.error("unknown strategy '%s'" % s)
+
+	return args
+
+
+def _oligo_cost(rng: random.Random, n_uniq: int) -> int:
+	# amplicon lengths vary little, e.g. around 253 bp for V4
+	return n_uniq * rng.randint(240, 260)
+
+
+def simulate_sizes(dist: str, n: int, rng: random.Random) -> list:
+	"""
+	simulate <n> oligo sizes; number of unique sequences per oligo:
+		lognormal: moderately skewed
+		zipf: power law by rank, as abundance of oligotypes
+		dominant: a few oligos are orders of magnitude larger than the rest
+	"""
+	if dist == "lognormal":
+		n_uniq = [max(1, int(rng.lognormvariate(3, 1.2))) for _ in range(n)]
+	elif dist == "zipf":
+		n_uniq = [max(1, int(5000 / (i + 1))) for i in range(n)]
+		rng.shuffle(n_uniq)
+	elif dist == "dominant":
+		n_uniq = [rng.randint(1, 50) for _ in range(n)]
+		for i in rng.sample(range(n), max(1, n // 50)):
+			n_uniq[i] = rng.randint(2000, 10000)
+	else:
+		raise ValueError("unknown distribution '%s'" % dist)
+	return [_oligo_cost(rng, i) for i in n_uniq]
+
+
+def main():
+	args = get_args()
+	rng = random.Random(args.seed)
+	out = sys.stdout if args.output == "-" else open(args.output, "w")
+	print(("\t").join(["distribution", "n_oligos", "n_jobs", "strategy",
+		"mean_imbalance", "max_imbalance", "mean_excess_over_bound",
+		"mean_time_ms"]), file=out)
+	for dist in ["lognormal", "zipf", "dominant"]:
+		for n in args.num_oligos:
+			for k in args.num_jobs:
+				size_sets = [simulate_sizes(dist, n, rng)
+					for _ in range(args.repeats)]
+				for s in args.strategies:
+					imbalance, excess, elapsed = list(), list(), 0.0
+					for sizes in size_sets:
+						t = time.perf_counter()
+						bins = job_scheduler.split(sizes, k, s)
+						elapsed += time.perf_counter() - t
+						stats = job_scheduler.schedule_stats(sizes, bins)
+						imbalance.append(stats["imbalance"])
+						excess.append(stats["makespan"] / stats["lower_bound"] - 1)
+					print("%s\t%u\t%u\t%s\t%.4f\t%.4f\t%.4f\t%.2f" % (dist, n, k,
+						s, sum(imbalance) / len(imbalance), max(imbalance),
+						sum(excess) / len(excess),
+						elapsed / len(size_sets) * 1000), file=out, flush=True)
+	if out is not sys.stdout:
+		out.close()
+	return
+
+
+if __name__ == "__main__":
+	main()
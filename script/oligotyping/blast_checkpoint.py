@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+import argparse
+import collections
+import hashlib
+import json
+import os
+import sys
+
+
+def get_args() -> argparse.Namespace:
+	ap = argparse.ArgumentParser(description="completion markers of the BLAST "
+		"annotation of oligo representative files; each marker records the "
+		"content hash of the representative file and the sizes of the outputs, "
+		"so that missing, stale or truncated outputs can be told from complete "
+		"ones")
+	sp = ap.add_subparsers(dest="mode", required=True)
+	p = sp.add_parser("mark", help="mark files as done, after their outputs "
+		"are completely written")
+	p.add_argument("files", type=str, nargs="+",
+		help="oligo representative fasta files")
+	p = sp.add_parser("unmark", help="remove markers of files, before their "
+		"outputs are rewritten")
+	p.add_argument("files", type=str, nargs="+",
+		help="oligo representative fasta files")
+	p = sp.add_parser("status", help="show the completion state of all "
+		"representatives of an oligotyping output")
+	p.add_argument("oligo_output", type=str,
+		help="oligotyping output directory")
+	p.add_argument("--list", "-l", action="store_true",
+		help="also list each file not done and its state")
+	for p in sp.choices.values():
+		p.add_argument("--blastn-dir", "-d", type=str,
+			default=os.environ.get("BLASTN_DIR", "blastn"),
+			metavar="dir",
+			help="BLAST output directory [$BLASTN_DIR or blastn]")
+
+	# parse and refine args
+	args = ap.parse_args()
+
+	return args
+
+
+# in the order of being reported
+STATES = ("done", "pending", "missing", "truncated", "stale")
+OUTPUT_SUFFIXES = (".blastn", ".blastn.blastdbcmd")
+
+
+def scan_rep_files(oligo_output: str, scan_suffix="_unique") -> list:
+	"""
+	return: representative fasta files of an oligotyping output directory
+	"""
+	if not os.path.isdir(oligo_output):
+		raise IOError("'%s' is not a directory" % oligo_output)
+	rep_dir = os.path.join(oligo_output, "OLIGO-REPRESENTATIVES")
+	if not os.path.isdir(rep_dir):
+		raise IOError("dir '%s' is missing, may be incomplete oligotyping "
+			"output" % rep_dir)
+	return [i.path for i in os.scandir(rep_dir)
+		if i.name.endswith(scan_suffix)]
+
+
+def file_digest(path: str) -> str:
+	h = hashlib.sha1()
+	with open(path, "rb") as fp:
+		for chunk in iter(lambda: fp.read(1 << 20), b""):
+			h.update(chunk)
+	return h.hexdigest()
+
+
+def output_prefix(blastn_dir: str, fasta: str) -> str:
+	# same output names as worker.oligo_fasta_blastn.sh
+	return os.path.join(blastn_dir, os.path.basename(fasta) + ".fna")
+
+
+def marker_path(blastn_dir: str, fasta: str) -> str:
+	return output_prefix(blastn_dir, fasta) + ".done"
+
+
+def mark_done(blastn_dir: str, fasta: str) -> None:
+	prefix = output_prefix(blastn_dir, fasta)
+	outputs = dict()
+	for s in OUTPUT_SUFFIXES:
+		outputs[os.path.basename(prefix + s)] = os.path.getsize(prefix + s)
+	marker = marker_path(blastn_dir, fasta)
+	tmp = marker + ".tmp"
+	with open(tmp, "w") as fp:
+		json.dump(dict(input=os.path.basename(fasta),
+			sha1=file_digest(fasta), outputs=outputs), fp)
+	# atomic, a marker is either complete or absent
+	os.replace(tmp, marker)
+	return
+
+
+def check_done(blastn_dir: str, fasta: str) -> str:
+	"""
+	return: one of
+		done: marker and outputs are consistent with the representative file
+		pending: no marker, never finished
+		missing: marked, but some outputs are gone
+		truncated: marked, but some outputs differ in size from when marked,
+			e.g. being overwritten by a rerun that did not finish
+		stale: the representative file changed since marked
+	"""
+	marker = marker_path(blastn_dir, fasta)
+	try:
+		with open(marker, "r") as fp:
+			info = json.load(fp)
+	except (OSError, ValueError):
+		return "pending"
+	for name, size in info["outputs"].items():
+		path = os.path.join(blastn_dir, name)
+		if not os.path.isfile(path):
+			return "missing"
+		if os.path.getsize(path) != size:
+			return "truncated"
+	if info["sha1"] != file_digest(fasta):
+		return "stale"
+	return "done"
+
+
+def check_files(blastn_dir: str, files: list) -> dict:
+	"""
+	return: dict mapping each file to its state, see check_done()
+	"""
+	return {f: check_done(blastn_dir, f) for f in files}
+
+
+def report_status(file_states: dict, file=sys.stderr, *,
+		list_files=False) -> None:
+	"""
+	print the number of files in each state, and if <list_files>, also each
+	file not done with its state
+	"""
+	counts = collections.Counter(file_states.values())
+	n = len(file_states)
+	print("%u/%u representative files done (%.1f%%); %s" % (counts["done"], n,
+		counts["done"] / n * 100 if n else 100.0,
+		(", ").join(["%u %s" % (counts[s], s) for s in STATES[1:]])),
+		file=file)
+	if list_files:
+		for f, s in sorted(file_states.items()):
+			if s != "done":
+				print("%s\t%s" % (s, f), file=file)
+	return
+
+
+def unmark(blastn_dir: str, fasta: str) -> None:
+	"""
+	remove the marker before outputs are (re)written
+	"""
+	try:
+		os.remove(marker_path(blastn_dir, fasta))
+	except FileNotFoundError:
+		pass
+	return
+
+
+def main():
+	args = get_args()
+	if args.mode == "mark":
+		for f in args.files:
+			mark_done(args.blastn_dir, f)
+	elif args.mode == "unmark":
+		for f in args.files:
+			unmark(args.blastn_dir, f)
+	elif args.mode == "status":
+		file_states = check_files(args.blastn_dir,
+			scan_rep_files(args.oligo_output))
+		report_status(file_states, file=sys.stdout, list_files=args.list)
+	return
+
+
+if __name__ == "__main__":
+	main()
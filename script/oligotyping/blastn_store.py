@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import re
+import sys
+
+import numpy
+
+from acc_tax_cache import AccTaxCache, parse_blastdbcmd_line, \
+	strip_accession_version
+
+
+def get_args() -> argparse.Namespace:
+	ap = argparse.ArgumentParser(description="consolidate the blastn hits and "
+		"their taxonomy of all oligos into a single columnar .npz store")
+	sp = ap.add_subparsers(dest="mode", required=True)
+	p = sp.add_parser("build", help="build the store from the per-oligo "
+		"outputs of the BLAST workers")
+	p.add_argument("blastn_dir", type=str,
+		help="BLAST output directory, with <oligo>_*.fna.blastn hit tables")
+	p.add_argument("--output", "-o", type=str,
+		metavar="npz",
+		help="output store [<blastn_dir>/blastn_hits.npz]")
+	p.add_argument("--tax-cache", "-c", type=str,
+		metavar="sqlite",
+		help="read taxonomy of hits from this accession taxonomy cache, "
+			"instead of the per-oligo .blastn.blastdbcmd files [no]")
+	p.add_argument("--compress", action="store_true",
+		help="compress the store, smaller but slower to load [no]")
+	p = sp.add_parser("info", help="show the size of a store")
+	p.add_argument("store", type=str,
+		help="store built by 'build'")
+
+	# parse and refine args
+	args = ap.parse_args()
+	if (args.mode == "build") and (args.output is None):
+		args.output = os.path.join(args.blastn_dir, "blastn_hits.npz")
+
+	return args
+
+
+HIT_DTYPE = numpy.dtype([
+	("oligo", "<i4"),
+	("qseqid", "<i4"),
+	("sacc", "<i4"),
+	("pident", "<f4"),
+	("evalue", "<f8"),
+	("bitscore", "<f4"),
+	# -1 if the taxonomy of the hit accession is unknown
+	("taxon", "<i4"),
+])
+
+
+class _Encoder(dict):
+	"""
+	dictionary encoding, mapping each distinct value to its code in the order
+	first seen
+	"""
+	def encode(self, value) -> int:
+		code = self.get(value)
+		if code is None:
+			code = self[value] = len(self)
+		return code
+
+	def values_array(self) -> numpy.ndarray:
+		return numpy.array(list(self), dtype=str)
+
+
+def _iter_oligo_files(blastn_dir: str, suffix: str) -> iter:
+	"""
+	yield (oligo, path) of per-oligo files ending in <suffix>; other files like
+	batch.* queries of oligo_blastn.py are skipped
+	"""
+	for i in sorted(os.scandir(blastn_dir), key=lambda x: x.name):
+		m = re.match(r"^(\d+)_", i.name)
+		if m and i.name.endswith(suffix):
+			yield int(m.group(1)), i.path
+	return
+
+
+class BlastHitStore(object):
+	"""
+	blastn hits of all oligos as a structured array of HIT_DTYPE; query IDs,
+	accessions and taxa are dictionary-encoded, each taxon being a
+	(taxid, scientific name) pair; <oligos> are all oligos blasted, including
+	those without any hit; <sacc_dbcmd> is the accession of each of <saccs> as
+	reported by blastdbcmd, empty if unknown
+	"""
+	def __init__(self, hits: numpy.ndarray, oligos: numpy.ndarray,
+			qseqids: numpy.ndarray, saccs: numpy.ndarray,
+			sacc_dbcmd: numpy.ndarray, taxon_ids: numpy.ndarray,
+			taxon_names: numpy.ndarray, *ka, **kw):
+		super().__init__(*ka, **kw)
+		self.hits = hits
+		self.oligos = oligos
+		self.qseqids = qseqids
+		self.saccs = saccs
+		self.sacc_dbcmd = sacc_dbcmd
+		self.taxon_ids = taxon_ids
+		self.taxon_names = taxon_names
+		return
+
+	@property
+	def n_hits(self) -> int:
+		return len(self.hits)
+
+	@classmethod
+	def build(cls, blastn_dir: str, *, tax_cache: AccTaxCache = None):
+		qseqids, saccs, taxa = _Encoder(), _Encoder(), _Encoder()
+		columns = [list() for _ in HIT_DTYPE.names]
+		oligos = list()
+		for oligo, path in _iter_oligo_files(blastn_dir, ".fna.blastn"):
+			oligos.append(oligo)
+			with open(path, "r") as fp:
+				for line in fp:
+					fields = line.rstrip("\r\n").split("\t")
+					if len(fields) < 5:
+						continue
+					columns[0].append(oligo)
+					columns[1].append(qseqids.encode(fields[0]))
+					columns[2].append(saccs.encode(fields[1]))
+					columns[3].append(fields[2])
+					columns[4].append(fields[3])
+					columns[5].append(fields[4])
+
+		# taxonomy of each distinct accession
+		keys = [strip_accession_version(i) for i in saccs]
+		if tax_cache is not None:
+			acc_tax = tax_cache.get_many(set(keys))
+		else:
+			acc_tax = dict()
+			for _, path in _iter_oligo_files(blastn_dir,
+					".fna.blastn.blastdbcmd"):
+				with open(path, "r") as fp:
+					for line in fp:
+						if line.strip():
+							k, acc, taxid, name = parse_blastdbcmd_line(line)
+							acc_tax[k] = (acc, taxid, name)
+		sacc_taxon = numpy.array([taxa.encode(acc_tax[k][1:])
+			if k in acc_tax else -1 for k in keys], dtype=numpy.int32)
+
+		hits = numpy.empty(len(columns[0]), dtype=HIT_DTYPE)
+		for name, col in zip(HIT_DTYPE.names[:6], columns):
+			hits[name] = numpy.asarray(col).astype(HIT_DTYPE[name])
+		hits["taxon"] = sacc_taxon[hits["sacc"]] if len(hits) else []
+		taxa = list(taxa)
+		return cls(hits, numpy.array(oligos, dtype=numpy.int32),
+			qseqids.values_array(), saccs.values_array(),
+			numpy.array([acc_tax[k][0] if k in acc_tax else "" for k in keys],
+				dtype=str),
+			numpy.array([i[0] for i in taxa], dtype=str),
+			numpy.array([i[1] for i in taxa], dtype=str))
+
+	def save(self, path: str, *, compress=False) -> None:
+		# write to a temporary file first, so that readers never see a partial
+		# store; numpy appends .npz to names without it
+		tmp = path + ".tmp.npz"
+		(numpy.savez_compressed if compress else numpy.savez)(tmp,
+			hits=self.hits, oligos=self.oligos, qseqids=self.qseqids,
+			saccs=self.saccs, sacc_dbcmd=self.sacc_dbcmd,
+			taxon_ids=self.taxon_ids, taxon_names=self.taxon_names)
+		os.replace(tmp, path)
+		return
+
+	@classmethod
+	def load(cls, path: str):
+		with numpy.load(path) as data:
+			return cls(data["hits"], data["oligos"], data["qseqids"],
+				data["saccs"], data["sacc_dbcmd"], data["taxon_ids"],
+				data["taxon_names"])
+
+	def filter(self, mask: numpy.ndarray):
+		"""
+		return: a new store of hits selected by boolean <mask>, e.g.
+			store.filter(store.hits["pident"] >= 99.5); dictionaries are shared
+		"""
+		return type(self)(self.hits[mask], self.oligos, self.qseqids,
+			self.saccs, self.sacc_dbcmd, self.taxon_ids, self.taxon_names)
+
+	def hit_labels(self, key_field: int = 2) \
+			-> (numpy.ndarray, numpy.ndarray):
+		"""
+		per-hit labels by the blastdbcmd field <key_field>, 0: accession, 1:
+		taxid, 2: scientific name; hits of unknown taxonomy have no label
+
+		return: label codes of hits (-1 if none) and the label of each code
+		"""
+		if key_field == 0:
+			labels, index = self.sacc_dbcmd, self.hits["sacc"]
+		elif key_field == 1:
+			labels, index = self.taxon_ids, self.hits["taxon"]
+		elif key_field == 2:
+			labels, index = self.taxon_names, self.hits["taxon"]
+		else:
+			raise ValueError("key_field must be 0, 1 or 2, got '%d'"
+				% key_field)
+		# codes of distinct labels, e.g. one name of multiple taxids is merged
+		uniq, inverse = numpy.unique(labels, return_inverse=True)
+		known = self.hits["taxon"] >= 0
+		codes = numpy.full(self.n_hits, -1, dtype=numpy.intp)
+		codes[known] = inverse.reshape(-1)[index[known]]
+		return codes, uniq
+
+
+def main():
+	args = get_args()
+	if args.mode == "build":
+		tax_cache = None if args.tax_cache is None \
+			else AccTaxCache(args.tax_cache)
+		store = BlastHitStore.build(args.blastn_dir, tax_cache=tax_cache)
+		if tax_cache is not None:
+			tax_cache.close()
+		store.save(args.output, compress=args.compress)
+		print("%u hits of %u oligos, %u accessions, %u taxa written to %s"
+			% (store.n_hits, len(store.oligos), len(store.saccs),
+				len(store.taxon_ids), args.output), file=sys.stderr)
+	elif args.mode == "info":
+		store = BlastHitStore.load(args.store)
+		print("hits\t%u" % store.n_hits)
+		print("oligos\t%u" % len(store.oligos))
+		print("query_seqs\t%u" % len(store.qseqids))
+		print("accessions\t%u" % len(store.saccs))
+		print("taxa\t%u" % len(store.taxon_ids))
+		print("hits_without_taxonomy\t%u" % (store.hits["taxon"] < 0).sum())
+	return
+
+
+if __name__ == "__main__":
+	main()
@@ -4,6 +4,7 @@
 rm -rf .log/ \
 	filtered_positions \
 	mothur2oligo.fasta-ENTROPY* \
+	mothur2oligo*.alncache.* \
 	mothur2oligo.fasta.msa_test* \
 	msa_test.* \
 	mothur2oligo.fasta.position_oligotype.* \
@@ -3,8 +3,24 @@
 #SBATCH -pshort -N1 -c1
 
 input_fasta="mothur2oligo.fasta"
+# aligned unique sequences and their counts, used by the weighted engine
+unique_fasta="mothur2oligo.unique.fasta"
+count_table="mothur2oligo.count_table"
 
-entropy-analysis --no-display $input_fasta
+# entropy engine:
+#   weighted: compute entropy from unique sequences weighted by count_table
+#   oligotyping: run entropy-analysis over the redundant reads
+engine="weighted"
+
+if [[ $engine == "weighted" ]]; then
+	# --cache also writes the binary alignment cache reused by oligotyping.sh
+	script/weighted_entropy_analysis.py --cache \
+		-c $count_table \
+		-o ${input_fasta}-ENTROPY \
+		$unique_fasta
+else
+	entropy-analysis --no-display $input_fasta
+fi
 
 # post process
 sort -rnk2 ${input_fasta}-ENTROPY > ${input_fasta}-ENTROPY.ranked
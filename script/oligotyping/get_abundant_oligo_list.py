@@ -2,32 +2,69 @@
 
 import argparse
 import io
+import itertools
 import os
 import sys
 
 import numpy
 
+import oligo_io
+from oligo_io import OligoTable
+
 
 def get_args() -> argparse.Namespace:
 	ap = argparse.ArgumentParser()
 	ap.add_argument("oligo_output", type=str,
 		help="oligotyping output directory")
-	ap.add_argument("--abund-threshold", "-a", type=float, default=0.05,
-		metavar="float",
+	ap.add_argument("--abund-threshold", "-a", type=float, nargs="+",
+		default=[0.05], metavar="float",
 		help="do not list oligos if its abundances are less than this threshold"
 			" across all samples, 0 means report all [0.05]")
-	ap.add_argument("--count-threshold", "-c", type=int, default=0,
-		metavar="int",
+	ap.add_argument("--count-threshold", "-c", type=int, nargs="+",
+		default=[0], metavar="int",
 		help="do not list oligos if its total count is less than this threshold"
 			" across all samples, 0 measn report all [0]")
+	ap.add_argument("--prevalence-threshold", "-p", type=int, nargs="+",
+		default=[0], metavar="int",
+		help="do not list oligos if they are more abundant than "
+			"--prevalence-abund in fewer samples than this threshold, 0 means "
+			"report all [0]")
+	ap.add_argument("--prevalence-abund", type=float, default=0.0,
+		metavar="float",
+		help="abundance above which an oligo counts as present in a sample, "
+			"for --prevalence-threshold [0]")
+	ap.add_argument("--percentile-threshold", "-r", type=float, nargs="+",
+		default=[0.0], metavar="float",
+		help="do not list oligos if the percentile rank (0-100) of their total "
+			"count among all oligos is less than this threshold, 0 means report "
+			"all [0]")
 	ap.add_argument("--output", "-o", type=str, default="-",
 		metavar="txt",
-		help="output oligo name list [stdout]")
+		help="output oligo name list, if only one combination of thresholds "
+			"is given [stdout]")
+	ap.add_argument("--grid-output-dir", "-O", type=str,
+		metavar="dir",
+		help="evaluate every combination of the thresholds given above, and "
+			"write one oligo list per combination and a summary.tsv of the "
+			"number of oligos and the fraction of reads retained by each to "
+			"this directory; required if multiple values of any threshold are "
+			"given [no]")
+	ap.add_argument("--sparse", action="store_true",
+		help="load counts as a sparse matrix, to bound memory for tables of "
+			"many mostly-zero oligos, e.g. without -M filtering; requires "
+			"scipy [no]")
 
 	# parse and refine args
 	args = ap.parse_args()
 	if args.output == "-":
 		args.output = sys.stdout
+	if args.prevalence_abund < 0:
+		ap.error("--prevalence-abund cannot be negative")
+	n_combinations = len(args.abund_threshold) * len(args.count_threshold) \
+		* len(args.prevalence_threshold) * len(args.percentile_threshold)
+	if (n_combinations > 1) and (args.grid_output_dir is None):
+		ap.error("-O/--grid-output-dir is required with multiple values of "
+			"any threshold")
 
 	return args
 
@@ -43,44 +80,127 @@ def get_fp(f, *ka, factory=open, **kw):
 	return ret
 
 
-def get_oligo_data(oligo_output_dir: str) -> (numpy.ndarray, numpy.ndarray):
-	if not os.path.isdir(oligo_output_dir):
-		raise IOError("'%s' is not a directory" % oligo_output_dir)
-	fname = os.path.join(oligo_output_dir, "MATRIX-COUNT.txt")
-	if not os.path.isfile(fname):
-		raise IOError("cannot find file '%s', oligotyping output might be "
-			"incomplete" % fname)
+def get_oligo_data(oligo_output_dir: str, *, sparse=False) \
+		-> (numpy.ndarray, numpy.ndarray):
+	table = OligoTable.from_oligo_output_dir(oligo_output_dir, sparse=sparse)
+	return table.oligos, table.counts
 
-	# read data
-	raw = numpy.loadtxt(fname, dtype=object, delimiter="\t")
-	oligos = raw[0, 1:]
-	samples = raw[1:, 0]
-	counts = raw[1:, 1:].astype(int)
 
-	return oligos, counts
+# criteria in the order of get_oligo_stats() and filter_oligo_grid()
+CRITERIA = ("abund", "count", "prevalence", "percentile")
 
 
-def filter_and_save_oligos(f, oligos, counts, abund_thres: float = 0.0,
-		count_thres: int = 0) -> None:
-	oligo_abund = counts / counts.sum(axis=1, keepdims=True)
-	# select oligos by max abundance across samples
-	abund_mask = (oligo_abund.max(axis=0) >= abund_thres)
-	count_mask = (counts.sum(axis=0) >= count_thres)
-	oligo_select = oligos[abund_mask & count_mask]
-	# save file
+def get_oligo_stats(counts, prevalence_abund: float = 0.0) -> dict:
+	"""
+	per-oligo statistics that all criteria are evaluated on, computed once;
+	counts can be dense or sparse, neither is densified
+
+	return: dict of criteria to arrays of oligos: 'abund' is the max
+		abundance across samples, 'count' the total count, 'prevalence' the
+		number of samples with abundance above <prevalence_abund>, and
+		'percentile' the percentile rank of the total count among all oligos
+	"""
+	oligo_abund = oligo_io.normalize_rows(counts)
+	total = oligo_io.col_sums(counts)
+	# percent of oligos with a total count not greater than each
+	rank = numpy.searchsorted(numpy.sort(total), total, side="right")
+	return dict(
+		abund=oligo_io.col_max(oligo_abund),
+		count=total,
+		prevalence=oligo_io.col_count_above(oligo_abund, prevalence_abund),
+		percentile=rank / max(len(total), 1) * 100,
+	)
+
+
+def filter_oligo_grid(stats: dict, thresholds: dict) -> numpy.ndarray:
+	"""
+	evaluate every combination of thresholds at once, an oligo is kept if
+	each of its statistics is at least the threshold of the criterion
+
+	thresholds: dict of criteria to lists of thresholds
+
+	return: boolean mask of shape (n_oligos, n_abund, n_count, n_prevalence,
+		n_percentile)
+	"""
+	ret = True
+	for i, c in enumerate(CRITERIA):
+		# each criterion varies along its own axis, broadcast to all others
+		shape = [1] * len(CRITERIA)
+		shape[i] = len(thresholds[c])
+		mask = stats[c].reshape(-1, 1) >= numpy.asarray(thresholds[c])
+		ret = ret & mask.reshape(len(stats[c]), *shape)
+	return ret
+
+
+def save_oligo_list(f, oligos) -> None:
 	with get_fp(f, "w") as fp:
-		for i in oligo_select:
+		for i in oligos:
 			print(i, file=fp)
 	return
 
 
+def filter_and_save_oligos(f, oligos, counts, abund_thres: float = 0.0,
+		count_thres: int = 0, prevalence_thres: int = 0,
+		percentile_thres: float = 0.0, prevalence_abund: float = 0.0) -> None:
+	stats = get_oligo_stats(counts, prevalence_abund)
+	keep = filter_oligo_grid(stats, dict(abund=[abund_thres],
+		count=[count_thres], prevalence=[prevalence_thres],
+		percentile=[percentile_thres]))
+	save_oligo_list(f, oligos[keep.reshape(-1)])
+	return
+
+
+def filter_and_save_oligo_grid(output_dir: str, oligos, counts,
+		thresholds: dict, prevalence_abund: float = 0.0) -> None:
+	"""
+	write the oligo list of each combination of thresholds as
+	<output_dir>/a<abund>_c<count>_p<prevalence>_r<percentile>.txt, and the
+	summary of all as <output_dir>/summary.tsv
+	"""
+	stats = get_oligo_stats(counts, prevalence_abund)
+	keep = filter_oligo_grid(stats, thresholds)
+	# retained oligos and reads of all combinations at once
+	n_kept = keep.sum(axis=0)
+	total = stats["count"].sum()
+	read_frac = numpy.tensordot(stats["count"], keep, axes=(0, 0)) \
+		/ (total if total else 1)
+
+	os.makedirs(output_dir, exist_ok=True)
+	with get_fp(os.path.join(output_dir, "summary.tsv"), "w") as fp:
+		print(("\t").join(["oligo_list"] + [c + "_threshold" for c in CRITERIA]
+			+ ["n_oligos", "read_fraction"]), file=fp)
+		for idx in itertools.product(*[range(len(thresholds[c]))
+				for c in CRITERIA]):
+			values = [thresholds[c][i] for c, i in zip(CRITERIA, idx)]
+			fname = "a%g_c%u_p%u_r%g.txt" % tuple(values)
+			save_oligo_list(os.path.join(output_dir, fname),
+				oligos[keep[(slice(None),) + idx]])
+			print(("\t").join([fname] + ["%g" % v for v in values]
+				+ ["%u" % n_kept[idx], "%.6f" % read_frac[idx]]), file=fp)
+	return
+
+
 def main():
 	args = get_args()
-	oligos, counts = get_oligo_data(args.oligo_output)
-	filter_and_save_oligos(args.output, oligos, counts,
-		abund_thres=args.abund_threshold,
-		count_thres=args.count_threshold,
-	)
+	oligos, counts = get_oligo_data(args.oligo_output, sparse=args.sparse)
+	if args.grid_output_dir is not None:
+		filter_and_save_oligo_grid(args.grid_output_dir, oligos, counts,
+			thresholds=dict(
+				abund=args.abund_threshold,
+				count=args.count_threshold,
+				prevalence=args.prevalence_threshold,
+				percentile=args.percentile_threshold,
+			),
+			prevalence_abund=args.prevalence_abund,
+		)
+	else:
+		filter_and_save_oligos(args.output, oligos, counts,
+			abund_thres=args.abund_threshold[0],
+			count_thres=args.count_threshold[0],
+			prevalence_thres=args.prevalence_threshold[0],
+			percentile_thres=args.percentile_threshold[0],
+			prevalence_abund=args.prevalence_abund,
+		)
 	return
 
 
@@ -0,0 +1,226 @@
+"""
+split atomic jobs of known sizes into k parallel jobs, minimizing the largest
+job (makespan); each strategy returns a list of k lists of indices into the
+input sizes, some of which can be empty if there are fewer jobs than k
+"""
+
+import heapq
+import math
+
+
+def _check_input(sizes: list, k: int) -> None:
+	if not sizes:
+		raise ValueError("sizes cannot be empty")
+	if k < 1:
+		raise ValueError("k must be positive, got '%d'" % k)
+	return
+
+
+def _descending_order(sizes: list) -> list:
+	# ties are broken by index to keep the results deterministic
+	return sorted(range(len(sizes)), key=lambda i: (-sizes[i], i))
+
+
+def makespan(sizes: list, bins: list):
+	return max(sum(sizes[i] for i in b) for b in bins)
+
+
+def lower_bound(sizes: list, k: int):
+	"""
+	no split can have a makespan less than the largest atomic job, nor less than
+	the mean of the k jobs
+	"""
+	return max(max(sizes), math.ceil(sum(sizes) / k))
+
+
+def schedule_stats(sizes: list, bins: list) -> dict:
+	"""
+	return: dict of makespan, lower_bound, mean job size and imbalance, i.e.
+		the relative excess of the makespan over the mean
+	"""
+	k = len(bins)
+	mean = sum(sizes) / k
+	ms = makespan(sizes, bins)
+	return dict(makespan=ms, lower_bound=lower_bound(sizes, k), mean=mean,
+		imbalance=(ms / mean - 1) if mean else 0.0)
+
+
+def lpt(sizes: list, k: int) -> list:
+	"""
+	longest processing time first: assign jobs in descending order of size,
+	each to the currently smallest bin; makespan is within 4/3 of the optimum
+	"""
+	_check_input(sizes, k)
+	bins = [list() for _ in range(k)]
+	heap = [(0, j) for j in range(k)]
+	for i in _descending_order(sizes):
+		s, j = heapq.heappop(heap)
+		bins[j].append(i)
+		heapq.heappush(heap, (s + sizes[i], j))
+	return bins
+
+
+def _first_fit_pack(sizes: list, order: list, capacity: int, k: int):
+	sums = list()
+	bins = list()
+	for i in order:
+		v = sizes[i]
+		for j in range(len(sums)):
+			if sums[j] + v <= capacity:
+				sums[j] += v
+				bins[j].append(i)
+				break
+		else:
+			if len(sums) >= k:
+				return None
+			sums.append(v)
+			bins.append([i])
+	return bins
+
+
+def first_fit_decreasing(sizes: list, k: int) -> list:
+	"""
+	bisect the smallest capacity that first-fit decreasing packs into k bins
+	(MULTIFIT); makespan is within 13/11 of the optimum
+	"""
+	_check_input(sizes, k)
+	order = _descending_order(sizes)
+	lo = lower_bound(sizes, k)
+	# first-fit decreasing always fits in k bins of this capacity
+	hi = max(max(sizes), 2 * math.ceil(sum(sizes) / k))
+	best = _first_fit_pack(sizes, order, hi, k)
+	while lo < hi:
+		mid = (lo + hi) // 2
+		attempt = _first_fit_pack(sizes, order, mid, k)
+		if attempt is not None:
+			best, hi = attempt, mid
+		else:
+			lo = mid + 1
+	return best + [list() for _ in range(k - len(best))]
+
+
+def karmarkar_karp(sizes: list, k: int) -> list:
+	"""
+	multiway largest differencing method: repeatedly merge the two partial
+	k-way partitions of the largest spread, pairing the largest bins of one with
+	the smallest of the other; usually much closer to the optimum than greedy
+	methods for skewed sizes
+	"""
+	_check_input(sizes, k)
+	heap = list()
+	for i, v in enumerate(sizes):
+		# partition as a tuple of (sum, indices), in descending order of sum
+		part = [(v, [i])] + [(0, []) for _ in range(k - 1)]
+		heapq.heappush(heap, (-v, i, part))
+	while len(heap) > 1:
+		_, tie, a = heapq.heappop(heap)
+		_, _, b = heapq.heappop(heap)
+		merged = [(sa + sb, ia + ib) for (sa, ia), (sb, ib)
+			in zip(a, reversed(b))]
+		merged.sort(key=lambda x: -x[0])
+		heapq.heappush(heap, (merged[-1][0] - merged[0][0], tie, merged))
+	return [idx for _, idx in heap[0][2]]
+
+
+def _candidate_bins(sums: list) -> list:
+	# smallest bins first; bins of equal sums are interchangeable, so only one
+	# of them needs to be tried
+	ret = list()
+	seen = set()
+	for j in sorted(range(len(sums)), key=lambda j: sums[j]):
+		if sums[j] not in seen:
+			seen.add(sums[j])
+			ret.append(j)
+	return ret
+
+
+def complete_greedy(sizes: list, k: int, *, max_nodes=50000) -> list:
+	"""
+	complete greedy algorithm: branch and bound over all assignments in
+	descending order of size, trying the smallest bins first, starting from the
+	best of lpt() and karmarkar_karp(); stops at a provably optimal split or
+	after <max_nodes> assignments
+	"""
+	_check_input(sizes, k)
+	best_bins = min([lpt(sizes, k), karmarkar_karp(sizes, k)],
+		key=lambda x: makespan(sizes, x))
+	best = makespan(sizes, best_bins)
+	bound = lower_bound(sizes, k)
+	if (best <= bound) or (k == 1):
+		return best_bins
+
+	order = _descending_order(sizes)
+	vals = [sizes[i] for i in order]
+	n = len(order)
+	sums = [0] * k
+	placed = [-1] * n
+	cand = [None] * n
+	pos = [0] * n
+	cand[0] = _candidate_bins(sums)
+	d = 0
+	nodes = 0
+	while (d >= 0) and (nodes < max_nodes):
+		# undo the previous assignment at this depth
+		if placed[d] >= 0:
+			sums[placed[d]] -= vals[d]
+			placed[d] = -1
+		if pos[d] >= len(cand[d]):
+			d -= 1
+			continue
+		j = cand[d][pos[d]]
+		pos[d] += 1
+		if sums[j] + vals[d] >= best:
+			# candidates are in ascending order of sum, no others can do better
+			pos[d] = len(cand[d])
+			continue
+		sums[j] += vals[d]
+		placed[d] = j
+		nodes += 1
+		if d < n - 1:
+			d += 1
+			cand[d] = _candidate_bins(sums)
+			pos[d] = 0
+			placed[d] = -1
+		elif max(sums) < best:
+			best = max(sums)
+			best_bins = [list() for _ in range(k)]
+			for i, b in zip(order, placed):
+				best_bins[b].append(i)
+			if best <= bound:
+				break
+	return best_bins
+
+
+def bisect_first_fit(sizes: list, k: int) -> list:
+	"""
+	the previous splitting method of submit.oligo_fasta_blastn.py: bisect the
+	smallest capacity that first-fit on the unsorted input packs into k bins;
+	kept for comparison
+	"""
+	_check_input(sizes, k)
+	order = list(range(len(sizes)))
+	lo, hi = min(sizes), sum(sizes)
+	best = None
+	while lo <= hi:
+		mid = (lo + hi) // 2
+		attempt = _first_fit_pack(sizes, order, mid, k)
+		if attempt is not None:
+			best, hi = attempt, mid - 1
+		else:
+			lo = mid + 1
+	return best + [list() for _ in range(k - len(best))]
+
+
+STRATEGIES = {
+	"lpt": lpt,
+	"ffd": first_fit_decreasing,
+	"kk": karmarkar_karp,
+	"cga": complete_greedy,
+	"legacy": bisect_first_fit,
+}
+
+
+def split(sizes: list, k: int, strategy="cga") -> list:
+	if strategy not in STRATEGIES:
+		raise ValueError("unknown split strategy '%s'" % strategy)
+	return STRATEGIES[strategy](sizes, k)
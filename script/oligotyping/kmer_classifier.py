@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import sys
+import time
+
+import numpy
+
+import blast_checkpoint
+from aln_io import get_fp, iter_fasta
+
+
+def get_args() -> argparse.Namespace:
+	ap = argparse.ArgumentParser(description="pre-classify oligo "
+		"representatives by exact k-mer matches to a local taxonomy reference, "
+		"e.g. the MIDAS set; files of which all sequences are confidently "
+		"assigned need not be blasted against nt, see "
+		"submit.oligo_fasta_blastn.py --exclude")
+	sp = ap.add_subparsers(dest="mode", required=True)
+	p = sp.add_parser("build", help="build a k-mer index from a reference "
+		"fasta and its accession to taxonomy map")
+	p.add_argument("reference", type=str,
+		help="reference fasta, the first word of each header is the accession")
+	p.add_argument("--accs-tax-map", "-t", type=str, required=True,
+		metavar="table",
+		help="2-column accession to taxonomy map, with the 1st column as "
+			"accession and the 2nd column as taxonomy (required)")
+	p.add_argument("--output", "-o", type=str, required=True,
+		metavar="prefix",
+		help="output index prefix, writes <prefix>.kmers.npy, "
+			"<prefix>.taxa.npy and <prefix>.index.npz (required)")
+	p.add_argument("--kmer-size", "-k", type=int, default=31,
+		metavar="int",
+		help="k-mer size, at most 32 [31]")
+	p.add_argument("--midas-names", action="store_true",
+		help="use only the last section of MIDAS taxonomy strings as the "
+			"taxon, the same way as map_custom_midas_blastn_taxonomy.py [no]")
+	p.add_argument("--delimiter", "-d", type=str, default="\t",
+		metavar="char",
+		help="delimiter in the accession to taxonomy map [tab]")
+	p = sp.add_parser("classify", help="assign the representatives of an "
+		"oligotyping output with an index built by 'build'")
+	p.add_argument("oligo_output", type=str,
+		help="oligotyping output directory")
+	p.add_argument("--index", "-x", type=str, required=True,
+		metavar="prefix",
+		help="k-mer index prefix (required)")
+	p.add_argument("--min-kmer-frac", type=float, default=0.9,
+		metavar="float",
+		help="a sequence is assigned if at least this fraction of its k-mers "
+			"are specific to the same taxon [0.9]")
+	p.add_argument("--output", "-o", type=str, default="-",
+		metavar="table",
+		help="per-sequence assignments, with columns file, sequence, best "
+			"taxon ('-' if none), and the fraction of k-mers specific to it; "
+			"pass to summary.blastn_tax.py -K to count the files excluded "
+			"from BLAST [stdout]")
+	p.add_argument("--resolved", "-r", type=str,
+		metavar="txt",
+		help="write files of which all sequences are assigned to this list, to "
+			"be passed to submit.oligo_fasta_blastn.py --exclude [no]")
+	p.add_argument("--blast-rate", type=float,
+		metavar="float",
+		help="BLAST throughput in query bases per second, to report the "
+			"estimated BLAST time saved [no]")
+
+	# parse and refine args
+	args = ap.parse_args()
+	if args.mode == "build":
+		if not (1 <= args.kmer_size <= 32):
+			ap.error("-k/--kmer-size must be between 1 and 32")
+	elif args.mode == "classify":
+		if not (0 < args.min_kmer_frac <= 1):
+			ap.error("--min-kmer-frac must be in (0, 1]")
+		if args.output == "-":
+			args.output = sys.stdout
+
+	return args
+
+
+# 2-bit codes of bases, other characters break k-mers
+_BASE_CODES = numpy.full(256, 4, dtype=numpy.uint8)
+for _c, _v in zip(b"ACGTUacgtu", (0, 1, 2, 3, 3, 0, 1, 2, 3, 3)):
+	_BASE_CODES[_c] = _v
+GAP_CHARS = b"-."
+
+
+def encode_kmers(seq: bytes, k: int) -> numpy.ndarray:
+	"""
+	return: 2-bit packed k-mers of all windows of the ungapped <seq> without
+		ambiguous bases, as uint64 in the order of positions
+	"""
+	codes = _BASE_CODES[numpy.frombuffer(seq.translate(None, GAP_CHARS),
+		dtype=numpy.uint8)]
+	n = len(codes) - k + 1
+	if n <= 0:
+		return numpy.empty(0, dtype=numpy.uint64)
+	# pack all windows at once, one base position per iteration
+	kmers = numpy.zeros(n, dtype=numpy.uint64)
+	valid = (codes & 3).astype(numpy.uint64)
+	for i in range(k):
+		kmers <<= numpy.uint64(2)
+		kmers |= valid[i:i + n]
+	n_bad = numpy.concatenate([[0], numpy.cumsum(codes > 3)])
+	return kmers[(n_bad[k:] - n_bad[:n]) == 0]
+
+
+def taxon_label(tax: str, *, midas_names=False, delimiter=";") -> str:
+	if not midas_names:
+		return tax
+	# last section, with the MIDAS cluster id appended to the species name
+	fields = tax.rstrip(delimiter).split(delimiter)
+	if fields[-1].startswith("midas_"):
+		return fields[-2] + "_" + fields[-1]
+	return fields[-1]
+
+
+class KmerIndex(object):
+	"""
+	exact k-mer to taxon index; the k-mers are a sorted uint64 array in
+	<prefix>.kmers.npy and the taxon code of each k-mer in <prefix>.taxa.npy,
+	both memory-mapped so that only the pages touched by lookups are read;
+	k-mers shared by multiple taxa have code -1; k and the taxon names are in
+	the sidecar <prefix>.index.npz
+	"""
+	def __init__(self, kmers: numpy.ndarray, taxa: numpy.ndarray, k: int,
+			taxon_names: numpy.ndarray, *ka, **kw):
+		super().__init__(*ka, **kw)
+		self.kmers = kmers
+		self.taxa = taxa
+		self.k = k
+		self.taxon_names = taxon_names
+		return
+
+	def __len__(self) -> int:
+		return len(self.kmers)
+
+	@classmethod
+	def build(cls, reference: str, acc_tax: dict, k: int):
+		"""
+		acc_tax: dict mapping reference accessions to taxa; references not in
+			it are skipped
+		"""
+		taxon_codes = dict()
+		kmer_chunks, taxon_chunks = list(), list()
+		n_skipped = 0
+		with get_fp(reference, "rb") as fp:
+			for name, seq in iter_fasta(fp):
+				acc = name.split(maxsplit=1)[0].decode("utf-8") if name else ""
+				tax = acc_tax.get(acc)
+				if tax is None:
+					n_skipped += 1
+					continue
+				code = taxon_codes.setdefault(tax, len(taxon_codes))
+				kmers = numpy.unique(encode_kmers(seq, k))
+				kmer_chunks.append(kmers)
+				taxon_chunks.append(numpy.full(len(kmers), code,
+					dtype=numpy.int32))
+		if n_skipped:
+			print("%u reference sequences without taxonomy are skipped"
+				% n_skipped, file=sys.stderr)
+		kmers = numpy.concatenate(kmer_chunks) if kmer_chunks \
+			else numpy.empty(0, dtype=numpy.uint64)
+		taxa = numpy.concatenate(taxon_chunks) if taxon_chunks \
+			else numpy.empty(0, dtype=numpy.int32)
+
+		# sort by k-mer then taxon, and collapse each k-mer to its taxon, or -1
+		# if its first and last taxa differ
+		order = numpy.lexsort((taxa, kmers))
+		kmers, taxa = kmers[order], taxa[order]
+		first = numpy.flatnonzero(numpy.concatenate([[True],
+			kmers[1:] != kmers[:-1]])) if len(kmers) \
+			else numpy.empty(0, dtype=numpy.intp)
+		last = numpy.concatenate([first[1:], [len(kmers)]]) - 1
+		uniq_taxa = numpy.where(taxa[first] == taxa[last], taxa[first], -1)
+		return cls(kmers[first], uniq_taxa.astype(numpy.int32), k,
+			numpy.array(list(taxon_codes), dtype=str))
+
+	@staticmethod
+	def _files(prefix: str) -> (str, str, str):
+		return prefix + ".kmers.npy", prefix + ".taxa.npy", \
+			prefix + ".index.npz"
+
+	def save(self, prefix: str) -> None:
+		# write to temporary files then rename, so that readers never see a
+		# partially written index
+		for path, data in zip(self._files(prefix), (self.kmers, self.taxa)):
+			tmp = path + ".tmp.npy"
+			numpy.save(tmp, data)
+			os.replace(tmp, path)
+		index_file = self._files(prefix)[2]
+		tmp = index_file + ".tmp.npz"
+		numpy.savez(tmp, k=self.k, taxon_names=self.taxon_names)
+		os.replace(tmp, index_file)
+		return
+
+	@classmethod
+	def load(cls, prefix: str, mmap_mode="r"):
+		kmers_file, taxa_file, index_file = cls._files(prefix)
+		with numpy.load(index_file) as index:
+			k = int(index["k"])
+			taxon_names = index["taxon_names"]
+		return cls(numpy.load(kmers_file, mmap_mode=mmap_mode),
+			numpy.load(taxa_file, mmap_mode=mmap_mode), k, taxon_names)
+
+	def lookup(self, kmers: numpy.ndarray) -> numpy.ndarray:
+		"""
+		return: taxon code of each of <kmers>, -1 if shared by multiple taxa
+			and -2 if not in the index
+		"""
+		ret = numpy.full(len(kmers), -2, dtype=numpy.int32)
+		if not len(self.kmers):
+			return ret
+		idx = numpy.searchsorted(self.kmers, kmers)
+		idx[idx == len(self.kmers)] = 0
+		found = self.kmers[idx] == kmers
+		ret[found] = self.taxa[idx[found]]
+		return ret
+
+	def classify(self, seqs: list) -> (numpy.ndarray, numpy.ndarray):
+		"""
+		assign each of <seqs> to the taxon with the most specific k-mers, all
+		sequences being looked up at once
+
+		return: best taxon code of each sequence (-1 if none), and the fraction
+			of its k-mers specific to that taxon
+		"""
+		n = len(seqs)
+		kmers = [encode_kmers(s, self.k) for s in seqs]
+		n_kmers = numpy.array([len(i) for i in kmers], dtype=numpy.int64)
+		seq_id = numpy.repeat(numpy.arange(n), n_kmers)
+		taxa = self.lookup(numpy.concatenate(kmers) if n
+			else numpy.empty(0, dtype=numpy.uint64))
+		specific = taxa >= 0
+		best = numpy.full(n, -1, dtype=numpy.int64)
+		frac = numpy.zeros(n, dtype=float)
+		if not specific.any():
+			return best, frac
+		# count distinct (sequence, taxon) pairs, then keep the top taxon of
+		# each sequence, i.e. the last pair after sorting by count
+		pairs, counts = numpy.unique(numpy.stack([seq_id[specific],
+			taxa[specific]]), axis=1, return_counts=True)
+		order = numpy.lexsort((counts, pairs[0]))
+		pairs, counts = pairs[:, order], counts[order]
+		is_last = numpy.concatenate([pairs[0, 1:] != pairs[0, :-1], [True]])
+		s = pairs[0, is_last]
+		best[s] = pairs[1, is_last]
+		frac[s] = counts[is_last] / n_kmers[s]
+		return best, frac
+
+
+def load_accs_tax_map(f, *, midas_names=False, delimiter="\t") -> dict:
+	ret = dict()
+	with get_fp(f, "r") as fp:
+		for line in fp:
+			if not line.strip():
+				continue
+			acc, tax = line.rstrip("\r\n").split(delimiter)[:2]
+			ret[acc] = taxon_label(tax, midas_names=midas_names)
+	return ret
+
+
+def classify_rep_files(index: KmerIndex, files: list, ofile, *,
+		min_kmer_frac=0.9) -> (list, dict):
+	"""
+	classify all sequences of each representative file, and write the
+	per-sequence assignments to <ofile>
+
+	return: files of which all sequences are assigned, and the statistics of
+		files, sequences and ungapped bases in total and resolved
+	"""
+	resolved = list()
+	stats = dict.fromkeys(["files", "seqs", "bases", "resolved_files",
+		"resolved_seqs", "resolved_bases"], 0)
+	with get_fp(ofile, "w") as ofp:
+		for f in files:
+			with open(f, "rb") as fp:
+				records = list(iter_fasta(fp))
+			best, frac = index.classify([s for _, s in records])
+			assigned = frac >= min_kmer_frac
+			n_bases = sum(len(s.translate(None, GAP_CHARS))
+				for _, s in records)
+			for (name, _), t, r in zip(records, best.tolist(), frac.tolist()):
+				print(("\t").join([f, name.decode("utf-8"),
+					"-" if t < 0 else str(index.taxon_names[t]), "%.4f" % r]),
+					file=ofp)
+			stats["files"] += 1
+			stats["seqs"] += len(records)
+			stats["bases"] += n_bases
+			stats["resolved_seqs"] += int(assigned.sum())
+			if records and assigned.all():
+				resolved.append(f)
+				stats["resolved_files"] += 1
+				stats["resolved_bases"] += n_bases
+	return resolved, stats
+
+
+def report_stats(stats: dict, elapsed: float, blast_rate=None,
+		file=sys.stderr) -> None:
+	def pct(a, b):
+		return a / b * 100 if b else 0.0
+	print("k-mer pre-classification: %u/%u files (%.1f%%) resolved, "
+		"%u/%u sequences (%.1f%%) assigned; %u/%u bases (%.1f%%) of BLAST "
+		"queries avoided; classified in %.1fs" % (stats["resolved_files"],
+			stats["files"], pct(stats["resolved_files"], stats["files"]),
+			stats["resolved_seqs"], stats["seqs"],
+			pct(stats["resolved_seqs"], stats["seqs"]), stats["resolved_bases"],
+			stats["bases"], pct(stats["resolved_bases"], stats["bases"]),
+			elapsed), file=file)
+	if blast_rate:
+		saved = stats["resolved_bases"] / blast_rate
+		print("estimated BLAST time saved: %.1fs (%.1fs net of "
+			"classification)" % (saved, saved - elapsed), file=file)
+	return
+
+
+def main():
+	args = get_args()
+	if args.mode == "build":
+		acc_tax = load_accs_tax_map(args.accs_tax_map,
+			midas_names=args.midas_names, delimiter=args.delimiter)
+		index = KmerIndex.build(args.reference, acc_tax, args.kmer_size)
+		index.save(args.output)
+		print("%u distinct %u-mers of %u taxa written to %s, %u shared by "
+			"multiple taxa" % (len(index), index.k, len(index.taxon_names),
+				args.output, (index.taxa < 0).sum()), file=sys.stderr)
+	elif args.mode == "classify":
+		start = time.time()
+		index = KmerIndex.load(args.index)
+		files = sorted(blast_checkpoint.scan_rep_files(args.oligo_output))
+		resolved, stats = classify_rep_files(index, files, args.output,
+			min_kmer_frac=args.min_kmer_frac)
+		if args.resolved is not None:
+			with open(args.resolved, "w") as fp:
+				for f in resolved:
+					print(f, file=fp)
+		report_stats(stats, time.time() - start, args.blast_rate)
+	return
+
+
+if __name__ == "__main__":
+	main()
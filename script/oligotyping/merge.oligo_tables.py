@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+
+import argparse
+import io
+import json
+import os
+import sys
+
+import numpy
+
+from oligo_io import iter_matrix_count_rows, matrix_count_file_from_dir, \
+	read_matrix_count_header
+
+
+def get_args() -> argparse.Namespace:
+	ap = argparse.ArgumentParser(description="merge the oligotyping outputs of "
+		"many taxa into one long-format (taxon, oligo, sample, count) store, "
+		"with per-taxon and per-sample queries")
+	sp = ap.add_subparsers(dest="mode", required=True)
+	p = sp.add_parser("merge", help="append taxa to the store, creating it if "
+		"missing; taxa already in the store are not reloaded")
+	p.add_argument("taxon_dirs", type=str, nargs="*",
+		help="taxon directories of oligo_batch.py, e.g. oligo.<name>; the "
+			"taxon is <name>, and the oligotyping output is read from "
+			"<taxon_dir>/oligotyping/mothur2oligo.fasta.oligo_final")
+	p.add_argument("--list", "-l", type=str,
+		metavar="table",
+		help="also merge taxa in this table, one per line as '<taxon><tab>"
+			"<oligotyping output dir>[<tab><abundant oligo list>]' [no]")
+	p.add_argument("--abund-list-name", type=str, default="abund_oligo.list",
+		metavar="name",
+		help="abundant oligo list of each taxon directory, read from "
+			"<taxon_dir>/oligotyping/<name> if it exists, see "
+			"get_abundant_oligo_list.py [abund_oligo.list]")
+	p.add_argument("--replace", action="store_true",
+		help="replace taxa already in the store, instead of skipping them [no]")
+	p = sp.add_parser("query", help="print records of the store as a long "
+		"table")
+	g = p.add_mutually_exclusive_group(required=True)
+	g.add_argument("--taxon", "-t", type=str,
+		metavar="name",
+		help="all records of this taxon")
+	g.add_argument("--sample", "-s", type=str,
+		metavar="name",
+		help="all records of this sample, across taxa")
+	p.add_argument("--abundant-only", "-a", action="store_true",
+		help="only records of oligos in the abundant oligo list of the taxon "
+			"[no]")
+	p.add_argument("--output", "-o", type=str, default="-",
+		metavar="table",
+		help="output table [stdout]")
+	p = sp.add_parser("info", help="show the taxa in the store")
+	for p in sp.choices.values():
+		p.add_argument("--store", "-S", type=str, default="oligo_tables.store",
+			metavar="dir",
+			help="store directory [oligo_tables.store]")
+
+	# parse and refine args
+	args = ap.parse_args()
+	if (args.mode == "merge") and (not args.taxon_dirs) and (not args.list):
+		ap.error("no taxa to merge, give taxon directories or -l/--list")
+	if (args.mode == "query") and (args.output == "-"):
+		args.output = sys.stdout
+
+	return args
+
+
+def get_fp(f, *ka, factory=open, **kw):
+	if isinstance(f, io.IOBase):
+		ret = f
+	elif isinstance(f, str):
+		ret = factory(f, *ka, **kw)
+	else:
+		raise TypeError("first argument of get_fp() must be str or io.IOBase, "
+			"got '%s'" % type(f).__name__)
+	return ret
+
+
+LONG_DTYPE = numpy.dtype([
+	("taxon", "<i4"),
+	("oligo", "<i4"),
+	("sample", "<i4"),
+	("count", "<i8"),
+	# if the oligo is in the abundant oligo list of the taxon
+	("abundant", "?"),
+])
+
+
+class _Dictionary(object):
+	"""
+	append-only dictionary encoding stored as one value per line, the code of
+	a value is its line number; new values are written by flush()
+	"""
+	def __init__(self, path: str, *ka, **kw):
+		super().__init__(*ka, **kw)
+		self.path = path
+		self.values = list()
+		if os.path.isfile(path):
+			with open(path, "r") as fp:
+				self.values = fp.read().splitlines()
+		self.codes = {v: i for i, v in enumerate(self.values)}
+		self._n_flushed = len(self.values)
+		return
+
+	def encode(self, value: str) -> int:
+		code = self.codes.get(value)
+		if code is None:
+			if "\n" in value:
+				raise ValueError("values cannot contain newlines, got '%s'"
+					% value)
+			code = self.codes[value] = len(self.values)
+			self.values.append(value)
+		return code
+
+	def flush(self) -> None:
+		with open(self.path, "a") as fp:
+			for v in self.values[self._n_flushed:]:
+				print(v, file=fp)
+		self._n_flushed = len(self.values)
+		return
+
+
+class OligoTableStore(object):
+	"""
+	long-format store of the oligo counts of many taxa, in directory <path>:
+	taxon, oligo and sample names are dictionary-encoded in taxa.txt,
+	oligos.txt and samples.txt; the non-zero counts of each taxon are a chunk
+	chunks/<n>.npy of LONG_DTYPE records sorted by sample then oligo, read
+	through mmap; manifest.json maps each taxon to its chunk and the record
+	range of each sample in it, so that per-taxon and per-sample queries only
+	read the records they return; the manifest is written last, so that a
+	taxon is either completely in the store or absent; a store has one
+	writer at a time
+	"""
+	def __init__(self, path: str, *ka, **kw):
+		super().__init__(*ka, **kw)
+		self.path = path
+		os.makedirs(os.path.join(path, "chunks"), exist_ok=True)
+		self.taxa = _Dictionary(os.path.join(path, "taxa.txt"))
+		self.oligos = _Dictionary(os.path.join(path, "oligos.txt"))
+		self.samples = _Dictionary(os.path.join(path, "samples.txt"))
+		self.manifest = dict(chunks=dict(), next_chunk=0)
+		if os.path.isfile(self.manifest_file):
+			with open(self.manifest_file, "r") as fp:
+				self.manifest = json.load(fp)
+		return
+
+	@property
+	def manifest_file(self) -> str:
+		return os.path.join(self.path, "manifest.json")
+
+	@property
+	def chunks(self) -> dict:
+		return self.manifest["chunks"]
+
+	def __contains__(self, taxon: str) -> bool:
+		return taxon in self.chunks
+
+	def _write_manifest(self) -> None:
+		tmp = self.manifest_file + ".tmp"
+		with open(tmp, "w") as fp:
+			json.dump(self.manifest, fp)
+		os.replace(tmp, self.manifest_file)
+		return
+
+	def append_taxon(self, taxon: str, matrix_count: str,
+			abundant: set = None, *, delimiter="\t") -> int:
+		"""
+		add the non-zero counts of <matrix_count> as <taxon>, streaming its
+		rows; an existing chunk of <taxon> is replaced
+
+		return: number of records added
+		"""
+		abundant = set() if abundant is None else abundant
+		taxon_code = self.taxa.encode(taxon)
+		oligos = read_matrix_count_header(matrix_count, delimiter)
+		oligo_codes = numpy.array([self.oligos.encode(i) for i in oligos],
+			dtype=numpy.int32)
+		oligo_abund = numpy.array([i in abundant for i in oligos], dtype=bool)
+		parts = list()
+		for sample, row in iter_matrix_count_rows(matrix_count, delimiter):
+			nz = numpy.flatnonzero(row)
+			part = numpy.empty(len(nz), dtype=LONG_DTYPE)
+			part["taxon"] = taxon_code
+			part["oligo"] = oligo_codes[nz]
+			part["sample"] = self.samples.encode(sample)
+			part["count"] = row[nz]
+			part["abundant"] = oligo_abund[nz]
+			parts.append(part)
+		records = numpy.concatenate(parts) if parts \
+			else numpy.empty(0, dtype=LONG_DTYPE)
+		records = records[numpy.lexsort((records["oligo"], records["sample"]))]
+
+		# record range of each sample
+		samples, first = numpy.unique(records["sample"], return_index=True)
+		last = numpy.concatenate([first[1:], [len(records)]])
+		sample_ranges = {str(s): [int(a), int(b)]
+			for s, a, b in zip(samples.tolist(), first, last)}
+
+		chunk = "chunks/%06u.npy" % self.manifest["next_chunk"]
+		tmp = os.path.join(self.path, chunk + ".tmp.npy")
+		numpy.save(tmp, records)
+		os.replace(tmp, os.path.join(self.path, chunk))
+		for d in (self.taxa, self.oligos, self.samples):
+			d.flush()
+		old = self.chunks.get(taxon)
+		self.chunks[taxon] = dict(file=chunk, n_records=len(records),
+			samples=sample_ranges)
+		self.manifest["next_chunk"] += 1
+		self._write_manifest()
+		if old is not None:
+			os.remove(os.path.join(self.path, old["file"]))
+		return len(records)
+
+	def _load_chunk(self, taxon: str) -> numpy.ndarray:
+		return numpy.load(os.path.join(self.path, self.chunks[taxon]["file"]),
+			mmap_mode="r")
+
+	def query_taxon(self, taxon: str) -> numpy.ndarray:
+		"""
+		return: LONG_DTYPE records of <taxon>, empty if not in the store
+		"""
+		if taxon not in self:
+			return numpy.empty(0, dtype=LONG_DTYPE)
+		return numpy.array(self._load_chunk(taxon))
+
+	def query_sample(self, sample: str) -> numpy.ndarray:
+		"""
+		return: LONG_DTYPE records of <sample> across all taxa, only reading
+			the range of the sample in each chunk
+		"""
+		code = self.samples.codes.get(sample)
+		parts = list()
+		if code is not None:
+			for taxon, info in self.chunks.items():
+				r = info["samples"].get(str(code))
+				if r is not None:
+					parts.append(numpy.array(self._load_chunk(taxon)[r[0]:r[1]]))
+		return numpy.concatenate(parts) if parts \
+			else numpy.empty(0, dtype=LONG_DTYPE)
+
+	def decode(self, records: numpy.ndarray) -> iter:
+		"""
+		yield (taxon, oligo, sample, count) of <records> with names decoded
+		"""
+		for t, o, s, c in zip(records["taxon"].tolist(),
+				records["oligo"].tolist(), records["sample"].tolist(),
+				records["count"].tolist()):
+			yield self.taxa.values[t], self.oligos.values[o], \
+				self.samples.values[s], c
+		return
+
+
+def load_oligo_list(f) -> set:
+	with get_fp(f, "r") as fp:
+		ret = set(i for i in fp.read().splitlines() if i)
+	return ret
+
+
+def get_merge_inputs(taxon_dirs: list, list_file: str = None, *,
+		abund_list_name="abund_oligo.list") -> list:
+	"""
+	return: list of (taxon, oligotyping output dir, abundant oligo list or
+		None)
+	"""
+	ret = list()
+	for d in taxon_dirs:
+		name = os.path.basename(os.path.normpath(d))
+		if name.startswith("oligo."):
+			name = name[len("oligo."):]
+		oligo_dir = os.path.join(d, "oligotyping")
+		abund_list = os.path.join(oligo_dir, abund_list_name)
+		ret.append((name,
+			os.path.join(oligo_dir, "mothur2oligo.fasta.oligo_final"),
+			abund_list if os.path.isfile(abund_list) else None))
+	if list_file is not None:
+		with get_fp(list_file, "r") as fp:
+			for line in fp:
+				fields = line.rstrip("\r\n").split("\t")
+				if not fields[0]:
+					continue
+				ret.append((fields[0], fields[1],
+					fields[2] if len(fields) > 2 and fields[2] else None))
+	return ret
+
+
+def main():
+	args = get_args()
+	if (args.mode != "merge") and (not os.path.isdir(args.store)):
+		print("store '%s' does not exist" % args.store, file=sys.stderr)
+		sys.exit(1)
+	store = OligoTableStore(args.store)
+	if args.mode == "merge":
+		for taxon, oligo_output, abund_list in get_merge_inputs(
+				args.taxon_dirs, args.list,
+				abund_list_name=args.abund_list_name):
+			if (taxon in store) and (not args.replace):
+				print("skipping taxon '%s', already in the store" % taxon,
+					file=sys.stderr)
+				continue
+			n = store.append_taxon(taxon,
+				matrix_count_file_from_dir(oligo_output),
+				abundant=None if abund_list is None
+					else load_oligo_list(abund_list))
+			print("taxon '%s': %u records" % (taxon, n), file=sys.stderr)
+	elif args.mode == "query":
+		if args.taxon is not None:
+			records = store.query_taxon(args.taxon)
+		else:
+			records = store.query_sample(args.sample)
+		if args.abundant_only:
+			records = records[records["abundant"]]
+		with get_fp(args.output, "w") as fp:
+			print(("\t").join(["taxon", "oligo", "sample", "count"]), file=fp)
+			for r in store.decode(records):
+				print(("\t").join(map(str, r)), file=fp)
+	elif args.mode == "info":
+		print(("\t").join(["taxon", "records", "samples"]))
+		for taxon, info in store.chunks.items():
+			print("%s\t%u\t%u" % (taxon, info["n_records"],
+				len(info["samples"])))
+	return
+
+
+if __name__ == "__main__":
+	main()
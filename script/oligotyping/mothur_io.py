@@ -0,0 +1 @@
+../mothur2oligo/mothur_io.py
\ No newline at end of file
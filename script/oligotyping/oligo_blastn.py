@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+#SBATCH -N1 -c8 -pshort
+#SBATCH --time 24:00:00
+
+import argparse
+import collections
+import io
+import os
+import subprocess
+import sys
+
+import blast_checkpoint
+from acc_tax_cache import AccTaxCache, default_cache_path, fetch_blastdbcmd, \
+	format_blastdbcmd_lines, strip_accession_version
+from work_queue import WorkQueue, default_worker_id
+
+
+def get_args() -> argparse.Namespace:
+	ap = argparse.ArgumentParser(description="python BLAST worker for oligo "
+		"representative fasta files; tool and database paths are read from the "
+		"same environment variables as worker.oligo_fasta_blastn.sh")
+	sp = ap.add_subparsers(dest="mode", required=True)
+	p = sp.add_parser("files", help="blast each input file on its own, "
+		"producing the same outputs as worker.oligo_fasta_blastn.sh, all in "
+		"this process")
+	p.add_argument("input_list", type=str,
+		help="list of oligo representative fasta files, one per line")
+	p = sp.add_parser("batch", help="concatenate all input files into one "
+		"query, run blastn and blastdbcmd once, then split the results back "
+		"into per-file outputs")
+	p.add_argument("input_list", type=str,
+		help="list of oligo representative fasta files, one per line")
+	p = sp.add_parser("queue", help="claim oligo representative fasta files "
+		"one at a time from a work queue and blast each of them, until the "
+		"queue is drained; see work_queue.py")
+	p.add_argument("queue", type=str,
+		help="work queue database, created by submit.oligo_fasta_blastn.py "
+			"--work-queue")
+	p.add_argument("--worker-id", type=str,
+		metavar="str",
+		help="name of this worker in the queue [<hostname>:<pid>]")
+	p.add_argument("--heartbeat-interval", type=float, default=60,
+		metavar="float",
+		help="seconds between heartbeats of the claimed item [60]")
+	p.add_argument("--stale-timeout", type=float, default=600,
+		metavar="float",
+		help="claims of other workers without a heartbeat for this many "
+			"seconds are reclaimed [600]")
+	p.add_argument("--max-attempts", type=int, default=3,
+		metavar="int",
+		help="an item is marked failed after this many attempts [3]")
+	p.add_argument("--poll-interval", type=float, default=30,
+		metavar="float",
+		help="seconds to wait before checking again, when no item is pending "
+			"but others are still claimed [30]")
+	for p in sp.choices.values():
+		p.add_argument("--tax-cache", type=str,
+			metavar="sqlite",
+			help="accession taxonomy cache database [$BLAST_TAX_CACHE, or "
+				"~/.cache/oligotyping/acc_tax.<db name>.sqlite]")
+
+	# parse and refine args
+	args = ap.parse_args()
+
+	return args
+
+
+def get_fp(f, *ka, factory=open, **kw):
+	if isinstance(f, io.IOBase):
+		ret = f
+	elif isinstance(f, str):
+		ret = factory(f, *ka, **kw)
+	else:
+		raise TypeError("first argument of get_fp() must be str or io.IOBase, "
+			"got '%s'" % type(f).__name__)
+	return ret
+
+
+class BlastConfig(object):
+	"""
+	paths and parameters of blastn/blastdbcmd, defaults are the same as in
+	worker.oligo_fasta_blastn.sh
+	"""
+	outfmt = "6 qseqid sacc pident evalue bitscore"
+	dbcmd_outfmt = "%a\t%T\t%S"
+
+	def __init__(self, *ka, blastn_dir="blastn", blast_db=None,
+			blastx_prefix=None, threads=1, max_target_seqs=20,
+			perc_identity=99, **kw):
+		super().__init__(*ka, **kw)
+		home = os.path.expanduser("~")
+		self.blastn_dir = blastn_dir
+		self.blast_db = blast_db or os.path.join(home,
+			"scratch/DATABASE/BLAST/nt")
+		self.blastx_prefix = blastx_prefix or os.path.join(home,
+			"opt/ncbi/blast+-2.13.0")
+		self.threads = threads
+		self.max_target_seqs = max_target_seqs
+		self.perc_identity = perc_identity
+		return
+
+	@classmethod
+	def from_env(cls, **kw):
+		return cls(
+			blastn_dir=os.environ.get("BLASTN_DIR", "blastn"),
+			blast_db=os.environ.get("BLAST_DB"),
+			blastx_prefix=os.environ.get("BLASTX_PREFIX"),
+			threads=int(os.environ.get("SLURM_CPUS_PER_TASK", 1)),
+			**kw,
+		)
+
+	@property
+	def blastn(self) -> str:
+		return os.path.join(self.blastx_prefix, "bin", "blastn")
+
+	@property
+	def blastdbcmd(self) -> str:
+		return os.path.join(self.blastx_prefix, "bin", "blastdbcmd")
+
+	def blastn_cmd(self, query: str, out: str) -> list:
+		return [self.blastn, "-query", query, "-out", out,
+			"-outfmt", self.outfmt, "-db", self.blast_db,
+			"-max_target_seqs", str(self.max_target_seqs),
+			"-perc_identity", str(self.perc_identity),
+			"-num_threads", str(self.threads)]
+
+	def blastdbcmd_cmd(self, entry_batch: str, out: str) -> list:
+		return [self.blastdbcmd, "-db", self.blast_db, "-dbtype", "nucl",
+			"-entry_batch", entry_batch, "-out", out,
+			"-outfmt", self.dbcmd_outfmt]
+
+
+def iter_fasta(fp) -> iter:
+	"""
+	yield (header, sequence) as str from a text fasta stream, multi-line
+	sequences are joined
+	"""
+	header, seq = None, list()
+	for line in fp:
+		if line.startswith(">"):
+			if header is not None:
+				yield header, "".join(seq)
+			header, seq = line[1:].rstrip("\r\n"), list()
+		else:
+			seq.append(line.strip())
+	if header is not None:
+		yield header, "".join(seq)
+	return
+
+
+GAP_CHARS = b"-."
+# the same gaps, as a str.translate() table deleting them
+_GAP_TABLE = dict.fromkeys(GAP_CHARS)
+
+
+def ungap(seq: str) -> str:
+	return seq.translate(_GAP_TABLE)
+
+
+def ungap_fasta(src: str, dst: str) -> None:
+	"""
+	copy fasta <src> to <dst> with gaps removed from sequence lines, as
+	seqmagick convert --ungap; headers are kept as-is
+	"""
+	with open(src, "rb") as ifp, open(dst, "wb") as ofp:
+		for line in ifp:
+			if not line.startswith(b">"):
+				line = line.translate(None, GAP_CHARS)
+				if not line.strip():
+					continue
+			ofp.write(line)
+	return
+
+
+def split_hit_accs(hits_file: str, acc_file: str) -> list:
+	"""
+	stream blastn tabular output, writing the accession of each hit to
+	<acc_file>, as cut -f2
+
+	return: accession of each hit, in order
+	"""
+	ret = list()
+	with open(hits_file, "r") as ifp, open(acc_file, "w") as ofp:
+		for line in ifp:
+			fields = line.rstrip("\r\n").split("\t", 2)
+			if len(fields) < 2:
+				continue
+			ret.append(fields[1])
+			ofp.write(fields[1] + "\n")
+	return ret
+
+
+def load_input_list(f) -> list:
+	with get_fp(f, "r") as fp:
+		return [i.strip() for i in fp if i.strip()]
+
+
+def output_prefix(config: BlastConfig, fasta: str) -> str:
+	# same output names as worker.oligo_fasta_blastn.sh
+	return os.path.join(config.blastn_dir, os.path.basename(fasta) + ".fna")
+
+
+def file_blastn(fasta: str, config: BlastConfig, cache: AccTaxCache) -> None:
+	"""
+	blast one representative file and look up the taxonomy of its hits,
+	writing <blastn_dir>/<file>.fna{,.blastn,.blastn.hit_accs,
+	.blastn.blastdbcmd} the same as worker.oligo_fasta_blastn.sh, then mark it
+	as done
+	"""
+	prefix = output_prefix(config, fasta)
+	blast_checkpoint.unmark(config.blastn_dir, fasta)
+	ungap_fasta(fasta, prefix)
+	subprocess.run(config.blastn_cmd(prefix, prefix + ".blastn"), check=True)
+	accs = split_hit_accs(prefix + ".blastn", prefix + ".blastn.hit_accs")
+	acc_tax = cache.resolve(accs, lambda x: fetch_blastdbcmd(x, config))
+	with open(prefix + ".blastn.blastdbcmd", "w") as fp:
+		fp.write("".join([i + "\n"
+			for i in format_blastdbcmd_lines(accs, acc_tax)]))
+	blast_checkpoint.mark_done(config.blastn_dir, fasta)
+	return
+
+
+def files_blastn(fasta_files: list, config: BlastConfig, *,
+		cache_path: str = None) -> int:
+	"""
+	blast each file by file_blastn(); files already done are skipped, e.g.
+	when a failed job is retried, and a failing file does not stop the rest,
+	the same as by queue_blastn()
+
+	return: number of files that failed
+	"""
+	os.makedirs(config.blastn_dir, exist_ok=True)
+	n_done, n_skipped, n_failed = 0, 0, 0
+	with AccTaxCache(cache_path or default_cache_path()) as cache:
+		for fasta in fasta_files:
+			if blast_checkpoint.check_done(config.blastn_dir, fasta) == "done":
+				n_skipped += 1
+				continue
+			try:
+				file_blastn(fasta, config, cache)
+			except (OSError, subprocess.CalledProcessError) as e:
+				print("failed %s: %s" % (fasta, e), file=sys.stderr, flush=True)
+				n_failed += 1
+			else:
+				n_done += 1
+		cache.report()
+	print("%u files done, %u skipped as already done, %u failed" % (n_done,
+		n_skipped, n_failed), file=sys.stderr)
+	return n_failed
+
+
+def batch_blastn(fasta_files: list, config: BlastConfig, *,
+		tag="batch", cache_path: str = None) -> None:
+	"""
+	blast all sequences in <fasta_files> as a single query, so that the
+	database is loaded once, then demultiplex the hits and the blastdbcmd
+	taxonomy into per-file .fna.blastn and .fna.blastn.blastdbcmd outputs, the
+	same as running the worker on each file; taxonomy is looked up in the
+	accession taxonomy cache first, see acc_tax_cache.py
+	"""
+	os.makedirs(config.blastn_dir, exist_ok=True)
+	for fasta in fasta_files:
+		blast_checkpoint.unmark(config.blastn_dir, fasta)
+	query = os.path.join(config.blastn_dir, tag + ".fna")
+	# query IDs are replaced by '<file index>_<seq index>' tags, so that hits
+	# can be traced back regardless of the original headers
+	qseqids = list()
+	with open(query, "w") as ofp:
+		for i, fasta in enumerate(fasta_files):
+			ids = list()
+			with open(fasta, "r") as ifp:
+				for j, (header, seq) in enumerate(iter_fasta(ifp)):
+					ids.append(header.split()[0] if header.split() else "")
+					ofp.write(">q%u_%u\n%s\n" % (i, j, ungap(seq)))
+			qseqids.append(ids)
+
+	# blastn
+	hits = query + ".blastn"
+	subprocess.run(config.blastn_cmd(query, hits), check=True)
+
+	# demultiplex hits by file
+	file_hits = [list() for _ in fasta_files]
+	with open(hits, "r") as fp:
+		for line in fp:
+			fields = line.rstrip("\r\n").split("\t")
+			if len(fields) < 2:
+				continue
+			i, j = [int(k) for k in fields[0][1:].split("_")]
+			fields[0] = qseqids[i][j]
+			file_hits[i].append(fields)
+
+	# blastdbcmd once for all unique accessions not in the taxonomy cache
+	accs = collections.OrderedDict.fromkeys(h[1] for fh in file_hits
+		for h in fh)
+	acc_file = query + ".blastn.hit_accs"
+	with open(acc_file, "w") as fp:
+		fp.write("".join([i + "\n" for i in accs]))
+	with AccTaxCache(cache_path or default_cache_path()) as cache:
+		acc_tax = cache.resolve(accs, lambda x: fetch_blastdbcmd(x, config))
+		cache.report()
+	write_file_outputs(fasta_files, file_hits, acc_tax, config)
+	return
+
+
+def write_file_outputs(fasta_files: list, file_hits: list, acc_tax: dict,
+		config: BlastConfig) -> None:
+	"""
+	write the per-file blastn hits and their blastdbcmd taxonomy, one taxonomy
+	line per hit as running blastdbcmd on each file's hit list, then mark each
+	file as done
+	"""
+	for fasta, hits in zip(fasta_files, file_hits):
+		prefix = output_prefix(config, fasta)
+		with open(prefix + ".blastn", "w") as fp:
+			fp.write("".join(["\t".join(h) + "\n" for h in hits]))
+		with open(prefix + ".blastn.blastdbcmd", "w") as fp:
+			for h in hits:
+				v = acc_tax.get(strip_accession_version(h[1]))
+				if v is not None:
+					fp.write("\t".join(v) + "\n")
+		blast_checkpoint.mark_done(config.blastn_dir, fasta)
+	return
+
+
+def queue_blastn(queue: WorkQueue, config: BlastConfig, cache: AccTaxCache, *,
+		worker: str, heartbeat_interval=60, poll_interval=30) -> int:
+	"""
+	process files claimed from <queue> until it is drained, each by
+	file_blastn()
+
+	return: number of files that failed
+	"""
+	os.makedirs(config.blastn_dir, exist_ok=True)
+	n_done, n_failed = 0, 0
+	for task_id, fasta in queue.iter_claims(worker,
+			poll_interval=poll_interval):
+		print("%s: claimed %s" % (worker, fasta), file=sys.stderr, flush=True)
+		try:
+			with queue.heartbeat_thread(task_id, worker,
+					interval=heartbeat_interval):
+				file_blastn(fasta, config, cache)
+		except (OSError, subprocess.CalledProcessError) as e:
+			print("%s: failed %s: %s" % (worker, fasta, e), file=sys.stderr,
+				flush=True)
+			queue.fail(task_id, worker)
+			n_failed += 1
+		else:
+			queue.complete(task_id, worker)
+			n_done += 1
+	print("%s: %u files done, %u failed" % (worker, n_done, n_failed),
+		file=sys.stderr)
+	return n_failed
+
+
+def main():
+	args = get_args()
+	config = BlastConfig.from_env()
+	if args.mode == "files":
+		if files_blastn(load_input_list(args.input_list), config,
+				cache_path=args.tax_cache):
+			sys.exit(1)
+	elif args.mode == "batch":
+		fasta_files = load_input_list(args.input_list)
+		tag = "batch." + os.path.basename(args.input_list)
+		batch_blastn(fasta_files, config, tag=tag, cache_path=args.tax_cache)
+	elif args.mode == "queue":
+		with WorkQueue(args.queue, stale_timeout=args.stale_timeout,
+				max_attempts=args.max_attempts) as queue, \
+				AccTaxCache(args.tax_cache or default_cache_path()) as cache:
+			n_failed = queue_blastn(queue, config, cache,
+				worker=args.worker_id or default_worker_id(),
+				heartbeat_interval=args.heartbeat_interval,
+				poll_interval=args.poll_interval)
+			cache.report()
+		if n_failed:
+			sys.exit(1)
+	return
+
+
+if __name__ == "__main__":
+	main()
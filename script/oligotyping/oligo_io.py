@@ -0,0 +1,298 @@
+"""
+shared reader of the oligotyping MATRIX-COUNT.txt, with a binary cache, used
+by the post-oligotyping filter and plot scripts; counts are either a dense
+numpy array or, for tables of many mostly-zero oligos, a scipy.sparse CSR
+matrix; scipy is only imported by the sparse backend
+"""
+
+import os
+import sys
+
+import numpy
+
+
+def matrix_count_file_from_dir(oligo_output_dir: str) -> str:
+	if not os.path.isdir(oligo_output_dir):
+		raise IOError("'%s' is not a directory" % oligo_output_dir)
+	fname = os.path.join(oligo_output_dir, "MATRIX-COUNT.txt")
+	if not os.path.isfile(fname):
+		raise IOError("cannot find file '%s', oligotyping output might be "
+			"incomplete" % fname)
+	return fname
+
+
+def read_matrix_count(fname: str, delimiter="\t") \
+		-> (numpy.ndarray, numpy.ndarray, numpy.ndarray):
+	"""
+	parse a sample x oligo count matrix, with oligo names in the header line
+	and sample names in the first column; all counts are parsed by a single
+	typed numpy.fromstring call, instead of a python object per cell
+
+	return: samples, oligos and the int64 sample x oligo count matrix
+	"""
+	with open(fname, "r") as fp:
+		header = fp.readline().rstrip("\r\n").split(delimiter)
+		lines = fp.read().splitlines()
+	oligos = header[1:]
+	samples, values = list(), list()
+	for line in lines:
+		if not line:
+			continue
+		name, _, v = line.partition(delimiter)
+		samples.append(name)
+		values.append(v)
+	counts = numpy.fromstring(delimiter.join(values), dtype=numpy.int64,
+		sep=delimiter) if values else numpy.empty(0, dtype=numpy.int64)
+	if counts.size != len(samples) * len(oligos):
+		raise ValueError("malformed count matrix '%s', expected %u counts in "
+			"each of %u rows" % (fname, len(oligos), len(samples)))
+	return numpy.array(samples, dtype=str), numpy.array(oligos, dtype=str), \
+		counts.reshape(len(samples), len(oligos))
+
+
+def _scipy_sparse():
+	try:
+		import scipy.sparse
+	except ImportError as e:
+		raise ImportError("the sparse backend requires scipy") from e
+	return scipy.sparse
+
+
+def is_sparse(m) -> bool:
+	# no sparse matrix can exist unless scipy is already imported
+	return ("scipy.sparse" in sys.modules) \
+		and sys.modules["scipy.sparse"].issparse(m)
+
+
+def read_matrix_count_header(fname: str, delimiter="\t") -> list:
+	"""
+	return: oligo names of a count matrix
+	"""
+	with open(fname, "r") as fp:
+		return fp.readline().rstrip("\r\n").split(delimiter)[1:]
+
+
+def iter_matrix_count_rows(fname: str, delimiter="\t") -> iter:
+	"""
+	yield (sample, int64 counts) of each row of a count matrix, one row at a
+	time
+	"""
+	with open(fname, "r") as fp:
+		n_oligos = len(fp.readline().rstrip("\r\n").split(delimiter)) - 1
+		for line in fp:
+			line = line.rstrip("\r\n")
+			if not line:
+				continue
+			name, _, v = line.partition(delimiter)
+			row = numpy.fromstring(v, dtype=numpy.int64, sep=delimiter)
+			if row.size != n_oligos:
+				raise ValueError("malformed count matrix '%s', expected %u "
+					"counts in row '%s'" % (fname, n_oligos, name))
+			yield name, row
+	return
+
+
+def read_matrix_count_sparse(fname: str, delimiter="\t"):
+	"""
+	same as read_matrix_count(), but the counts are a CSR matrix built one row
+	at a time, so that memory is bounded by the number of non-zero counts
+
+	return: samples, oligos and the int64 sample x oligo CSR count matrix
+	"""
+	sparse = _scipy_sparse()
+	oligos = read_matrix_count_header(fname, delimiter)
+	samples, indices, data, indptr = list(), list(), list(), [0]
+	for name, row in iter_matrix_count_rows(fname, delimiter):
+		nz = numpy.flatnonzero(row)
+		samples.append(name)
+		indices.append(nz.astype(numpy.int32))
+		data.append(row[nz])
+		indptr.append(indptr[-1] + len(nz))
+	counts = sparse.csr_matrix((
+		numpy.concatenate(data) if data else numpy.empty(0, numpy.int64),
+		numpy.concatenate(indices) if indices else numpy.empty(0, numpy.int32),
+		numpy.array(indptr, dtype=numpy.int64)),
+		shape=(len(samples), len(oligos)))
+	return numpy.array(samples, dtype=str), numpy.array(oligos, dtype=str), \
+		counts
+
+
+def row_sums(m) -> numpy.ndarray:
+	return numpy.asarray(m.sum(axis=1)).reshape(-1)
+
+
+def col_sums(m) -> numpy.ndarray:
+	return numpy.asarray(m.sum(axis=0)).reshape(-1)
+
+
+def normalize_rows(m, totals: numpy.ndarray = None):
+	"""
+	divide each row by its total, or by <totals> if provided; rows of zero
+	total stay zero; sparse matrices stay sparse
+	"""
+	totals = row_sums(m) if totals is None else numpy.asarray(totals)
+	inv = numpy.divide(1.0, totals, out=numpy.zeros(len(totals)),
+		where=totals != 0)
+	if is_sparse(m):
+		return (_scipy_sparse().diags(inv) @ m).tocsr()
+	return m * inv.reshape(-1, 1)
+
+
+def col_max(m) -> numpy.ndarray:
+	if not m.shape[0]:
+		return numpy.zeros(m.shape[1])
+	if is_sparse(m):
+		# implicit zeros count, as in the dense matrix
+		return m.max(axis=0).toarray().reshape(-1)
+	return m.max(axis=0)
+
+
+def col_count_above(m, x: float = 0.0) -> numpy.ndarray:
+	"""
+	number of rows greater than <x> in each column, <x> must not be negative
+	so that implicit zeros of sparse matrices never count
+	"""
+	if is_sparse(m):
+		m = m.tocsr()
+		return numpy.bincount(m.indices[m.data > x], minlength=m.shape[1])
+	return (m > x).sum(axis=0)
+
+
+def to_dense(m) -> numpy.ndarray:
+	return m.toarray() if is_sparse(m) else numpy.asarray(m)
+
+
+def _source_stats(fname: str) -> str:
+	st = os.stat(fname)
+	return "%s\t%u\t%u" % (os.path.realpath(fname), st.st_size, st.st_mtime_ns)
+
+
+class OligoTable(object):
+	"""
+	sample x oligo count matrix of an oligotyping output, dense or sparse;
+	loading through from_matrix_count() keeps a binary copy next to the text
+	file, <MATRIX-COUNT.txt>.npz if dense or <MATRIX-COUNT.txt>.csr.npz if
+	sparse, reused as long as size and mtime of the text file are unchanged
+	"""
+	def __init__(self, samples: numpy.ndarray, oligos: numpy.ndarray,
+			counts: numpy.ndarray, *ka, **kw):
+		super().__init__(*ka, **kw)
+		self.samples = samples
+		self.oligos = oligos
+		self.counts = counts
+		self.validate()
+		return
+
+	def validate(self) -> None:
+		if self.counts.ndim != 2:
+			raise ValueError("counts must be a 2-dimensional matrix")
+		if self.counts.shape != (len(self.samples), len(self.oligos)):
+			raise ValueError("counts must be of shape (n_samples, n_oligos)")
+		return
+
+	@property
+	def n_samples(self) -> int:
+		return len(self.samples)
+
+	@property
+	def n_oligos(self) -> int:
+		return len(self.oligos)
+
+	@property
+	def is_sparse(self) -> bool:
+		return is_sparse(self.counts)
+
+	@property
+	def sample_totals(self) -> numpy.ndarray:
+		return row_sums(self.counts)
+
+	@property
+	def oligo_totals(self) -> numpy.ndarray:
+		return col_sums(self.counts)
+
+	def rel_abund(self):
+		"""
+		return: counts divided by sample totals, sparse if counts are sparse
+		"""
+		return normalize_rows(self.counts, self.sample_totals)
+
+	def select_oligos(self, mask: numpy.ndarray):
+		"""
+		return: a new table of oligos selected by boolean <mask>
+		"""
+		mask = numpy.asarray(mask, dtype=bool)
+		counts = self.counts.tocsc()[:, mask].tocsr() if self.is_sparse \
+			else self.counts[:, mask]
+		return type(self)(self.samples, self.oligos[mask], counts)
+
+	def save(self, path: str, **extra) -> None:
+		"""
+		save as .npz, sparse counts as their CSR arrays; <extra> arrays are
+		stored along
+		"""
+		if self.is_sparse:
+			counts = self.counts.tocsr()
+			arrays = dict(counts_data=counts.data,
+				counts_indices=counts.indices, counts_indptr=counts.indptr,
+				counts_shape=numpy.asarray(counts.shape))
+		else:
+			arrays = dict(counts=self.counts)
+		numpy.savez(path, samples=self.samples, oligos=self.oligos, **arrays,
+			**extra)
+		return
+
+	@classmethod
+	def load(cls, path: str):
+		with numpy.load(path) as data:
+			if "counts" in data:
+				counts = data["counts"]
+			else:
+				counts = _scipy_sparse().csr_matrix((data["counts_data"],
+					data["counts_indices"], data["counts_indptr"]),
+					shape=tuple(data["counts_shape"]))
+			return cls(data["samples"], data["oligos"], counts)
+
+	@staticmethod
+	def cache_file(fname: str, *, sparse=False) -> str:
+		return fname + (".csr.npz" if sparse else ".npz")
+
+	@classmethod
+	def _load_cache(cls, fname: str, *, sparse=False):
+		cache = cls.cache_file(fname, sparse=sparse)
+		try:
+			with numpy.load(cache) as data:
+				if str(data["sources"]) != _source_stats(fname):
+					return None
+			return cls.load(cache)
+		except (OSError, KeyError, ValueError):
+			return None
+
+	def _save_cache(self, fname: str) -> None:
+		# write to a temporary file then rename, so that readers never see a
+		# partial cache; the cache is optional, e.g. in read-only directories
+		cache = self.cache_file(fname, sparse=self.is_sparse)
+		tmp = cache + ".tmp.npz"
+		try:
+			self.save(tmp, sources=numpy.asarray(_source_stats(fname)))
+			os.replace(tmp, cache)
+		except OSError:
+			pass
+		return
+
+	@classmethod
+	def from_matrix_count(cls, fname: str, *, delimiter="\t", cache=True,
+			sparse=False):
+		if cache:
+			new = cls._load_cache(fname, sparse=sparse)
+			if new is not None:
+				return new
+		reader = read_matrix_count_sparse if sparse else read_matrix_count
+		new = cls(*reader(fname, delimiter=delimiter))
+		if cache:
+			new._save_cache(fname)
+		return new
+
+	@classmethod
+	def from_oligo_output_dir(cls, oligo_output_dir: str, **kw):
+		return cls.from_matrix_count(
+			matrix_count_file_from_dir(oligo_output_dir), **kw)
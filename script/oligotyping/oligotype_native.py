@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import sys
+
+import numpy
+
+from aln_io import get_fp, AlignmentCache, WeightedAlignment
+
+
+def get_args() -> argparse.Namespace:
+	ap = argparse.ArgumentParser(description="native oligotype assignment, "
+		"writing MATRIX-COUNT.txt, MATRIX-PERCENT.txt and OLIGO-REPRESENTATIVES "
+		"in the same format as oligotyping's oligotype")
+	ap.add_argument("fasta", type=str,
+		help="aligned fasta; unique sequences if --count-table is set, "
+			"otherwise redundant reads with '<sample>_<read>' headers")
+	ap.add_argument("--count-table", "-c", type=str,
+		metavar="count_table",
+		help="mothur count_table of the unique sequences in <fasta> [no]")
+	ap.add_argument("--cache", action="store_true",
+		help="read the alignment from its binary cache <fasta>.alncache.*, "
+			"which is (re)built if missing or outdated [no]")
+	ag = ap.add_mutually_exclusive_group(required=True)
+	ag.add_argument("--positions", "-C", type=str,
+		metavar="int,int,...",
+		help="comma-separated 0-based alignment positions to oligotype on")
+	ag.add_argument("--positions-file", "-P", type=str,
+		metavar="txt",
+		help="file of comma-separated positions, e.g. filtered_positions")
+	ap.add_argument("--output-dir", "-o", type=str, required=True,
+		metavar="dir",
+		help="output directory (required)")
+	ap.add_argument("--min-number-of-samples", "-s", type=int, default=1,
+		metavar="int",
+		help="minimum number of samples an oligotype must occur in [1]")
+	ap.add_argument("--min-percent-abundance", "-a", type=float, default=0.0,
+		metavar="float",
+		help="minimum percent abundance of an oligotype in at least one sample "
+			"[0]")
+	ap.add_argument("--min-actual-abundance", "-A", type=int, default=0,
+		metavar="int",
+		help="minimum total count of an oligotype across all samples [0]")
+	ap.add_argument("--min-substantive-abundance", "-M", type=int, default=0,
+		metavar="int",
+		help="minimum count of the most abundant unique sequence in an "
+			"oligotype [0]")
+	ap.add_argument("--max-representatives", type=int, default=0,
+		metavar="int",
+		help="maximum number of unique sequences written per oligotype in "
+			"OLIGO-REPRESENTATIVES, 0 means all [0]")
+
+	# parse and refine args
+	args = ap.parse_args()
+	if args.positions_file is not None:
+		args.positions = read_positions(args.positions_file)
+	else:
+		args.positions = parse_positions(args.positions)
+
+	return args
+
+
+def parse_positions(s: str) -> list:
+	ret = [int(i) for i in s.strip().split(",") if i.strip()]
+	if not ret:
+		raise ValueError("no position is given")
+	return ret
+
+
+def read_positions(f) -> list:
+	with get_fp(f, "r") as fp:
+		return parse_positions(fp.read())
+
+
+class OligotypeResult(object):
+	"""
+	oligotypes as strings of bases at the selected positions, their sample x
+	oligotype count matrix, and the oligotype index of each unique sequence
+	(-1 if the sequence belongs to a filtered oligotype)
+	"""
+	def __init__(self, positions: list, oligos: list, samples: list,
+			counts: numpy.ndarray, seq_oligo: numpy.ndarray, *ka, **kw):
+		super().__init__(*ka, **kw)
+		self.positions = list(positions)
+		self.oligos = list(oligos)
+		self.samples = list(samples)
+		self.counts = counts
+		self.seq_oligo = seq_oligo
+		return
+
+	@property
+	def n_oligos(self) -> int:
+		return len(self.oligos)
+
+	@property
+	def percents(self) -> numpy.ndarray:
+		total = self.counts.sum(axis=1, keepdims=True)
+		return self.counts * 100.0 / numpy.where(total > 0, total, 1)
+
+
+def factorize_rows(sub: numpy.ndarray) -> (numpy.ndarray, numpy.ndarray):
+	"""
+	hash each row of a uint8 matrix as one fixed-width key
+
+	return: unique rows, and the index of each input row in unique rows
+	"""
+	sub = numpy.ascontiguousarray(sub, dtype=numpy.uint8)
+	keys = sub.view(numpy.dtype((numpy.void, sub.shape[1]))).ravel()
+	u_keys, inverse = numpy.unique(keys, return_inverse=True)
+	u_rows = u_keys.view(numpy.uint8).reshape(len(u_keys), sub.shape[1])
+	return u_rows, inverse.ravel()
+
+
+def group_sum(values: numpy.ndarray, group: numpy.ndarray, n_groups: int
+		) -> numpy.ndarray:
+	"""
+	sum rows of <values> by integer <group> labels, 0 <= group < n_groups
+	"""
+	order = numpy.argsort(group, kind="stable")
+	sorted_group = group[order]
+	starts = numpy.flatnonzero(numpy.r_[True, sorted_group[1:]
+		!= sorted_group[:-1]]) if len(order) else numpy.zeros(0, dtype=int)
+	ret = numpy.zeros((n_groups,) + values.shape[1:], dtype=values.dtype)
+	if len(order):
+		ret[sorted_group[starts]] = numpy.add.reduceat(values[order], starts,
+			axis=0)
+	return ret
+
+
+def get_collapsed_weights(aln: WeightedAlignment) -> numpy.ndarray:
+	"""
+	return: weight of each sequence summed over all sequences identical to it
+		after alignment, e.g. distinct mothur uniques, as if collapsed from a
+		redundant fasta
+	"""
+	u_seqs, seq_uniq = factorize_rows(aln.matrix)
+	return group_sum(aln.weights, seq_uniq, len(u_seqs))[seq_uniq]
+
+
+def oligotype(aln: WeightedAlignment, positions: list, *,
+		min_number_of_samples=1, min_percent_abundance=0.0,
+		min_actual_abundance=0, min_substantive_abundance=0,
+		columns: numpy.ndarray = None,
+		collapsed_weights: numpy.ndarray = None) -> OligotypeResult:
+	"""
+	assign each unique sequence in <aln> to an oligotype by bases at
+	<positions>, and aggregate counts per sample
+
+	columns: optional pre-sliced aln.matrix[:, positions], to reuse the column
+		slice across calls
+	collapsed_weights: optional get_collapsed_weights(aln), to reuse it across
+		calls
+	"""
+	positions = list(positions)
+	if (min(positions) < 0) or (max(positions) >= aln.n_columns):
+		raise ValueError("positions must be within [0, %u)" % aln.n_columns)
+	if columns is None:
+		columns = aln.matrix[:, positions]
+	u_rows, seq_oligo = factorize_rows(columns)
+	oligos = [bytes(i).decode() for i in u_rows]
+	oligo_counts = group_sum(aln.counts, seq_oligo, len(oligos))
+
+	# filters, using the same definitions as oligotyping
+	total = oligo_counts.sum(axis=1)
+	sample_total = oligo_counts.sum(axis=0)
+	percent = oligo_counts * 100.0 / numpy.where(sample_total > 0,
+		sample_total, 1)
+	substantive = numpy.zeros(len(oligos), dtype=numpy.int64)
+	if min_substantive_abundance > 0:
+		if collapsed_weights is None:
+			collapsed_weights = get_collapsed_weights(aln)
+		numpy.maximum.at(substantive, seq_oligo, collapsed_weights)
+	keep = ((oligo_counts > 0).sum(axis=1) >= min_number_of_samples) \
+		& (percent.max(axis=1, initial=0) >= min_percent_abundance) \
+		& (total >= min_actual_abundance) \
+		& (substantive >= min_substantive_abundance)
+
+	# sort kept oligos by total count descending, then by oligo
+	kept = sorted(numpy.flatnonzero(keep), key=lambda i: (-total[i], oligos[i]))
+	remap = numpy.full(len(oligos), -1, dtype=numpy.intp)
+	remap[kept] = numpy.arange(len(kept))
+
+	# samples in alphabetical order
+	sample_order = sorted(range(aln.n_samples), key=lambda i: aln.samples[i])
+	counts = oligo_counts[kept][:, sample_order].T
+	return OligotypeResult(positions=positions,
+		oligos=[oligos[i] for i in kept],
+		samples=[aln.samples[i] for i in sample_order],
+		counts=counts,
+		seq_oligo=remap[seq_oligo],
+	)
+
+
+def save_matrix_files(out_dir: str, result: OligotypeResult,
+		delimiter="\t") -> None:
+	count_lines = [delimiter.join(["samples"] + result.oligos)]
+	percent_lines = [count_lines[0]]
+	for s, c, p in zip(result.samples, result.counts, result.percents):
+		count_lines.append(delimiter.join([s] + [str(i) for i in c]))
+		percent_lines.append(delimiter.join([s] + [str(i) for i in p]))
+	with open(os.path.join(out_dir, "MATRIX-COUNT.txt"), "w") as fp:
+		fp.write("\n".join(count_lines) + "\n")
+	with open(os.path.join(out_dir, "MATRIX-PERCENT.txt"), "w") as fp:
+		fp.write("\n".join(percent_lines) + "\n")
+	return
+
+
+def save_representatives(out_dir: str, result: OligotypeResult,
+		aln: WeightedAlignment, *, max_representatives=0) -> None:
+	"""
+	write the unique sequences of each oligotype, most abundant first, as
+	OLIGO-REPRESENTATIVES/<index>_<oligo>_unique; input sequences identical
+	after alignment, e.g. distinct mothur uniques, are written once with their
+	weights summed, the same as from a redundant fasta
+	"""
+	rep_dir = os.path.join(out_dir, "OLIGO-REPRESENTATIVES")
+	os.makedirs(rep_dir, exist_ok=True)
+	weights = aln.weights
+	# rows of each oligotype, in input order
+	order = numpy.argsort(result.seq_oligo, kind="stable")
+	order = order[result.seq_oligo[order] >= 0]
+	bounds = numpy.searchsorted(result.seq_oligo[order],
+		numpy.arange(result.n_oligos + 1))
+	for i, oligo in enumerate(result.oligos):
+		idx = order[bounds[i]:bounds[i + 1]]
+		# gather all rows at once, a cached matrix is column-major
+		seqs = numpy.ascontiguousarray(aln.matrix[idx])
+		uniq, inverse = factorize_rows(seqs)
+		uniq_weights = group_sum(weights[idx], inverse, len(uniq))
+		first = numpy.full(len(uniq), len(idx))
+		numpy.minimum.at(first, inverse, numpy.arange(len(idx)))
+		# weight descending, ties in the order first seen
+		rank = numpy.lexsort((first, -uniq_weights))
+		if max_representatives > 0:
+			rank = rank[:max_representatives]
+		fname = os.path.join(rep_dir, "%05d_%s_unique" % (i, oligo))
+		with open(fname, "wb") as fp:
+			for j, k in enumerate(rank):
+				fp.write(b">%s_%d|freq:%d\n" % (oligo.encode(), j,
+					uniq_weights[k]))
+				fp.write(uniq[k].tobytes() + b"\n")
+	return
+
+
+def save_oligotype_output(out_dir: str, result: OligotypeResult,
+		aln: WeightedAlignment, *, max_representatives=0) -> None:
+	os.makedirs(out_dir, exist_ok=True)
+	save_matrix_files(out_dir, result)
+	save_representatives(out_dir, result, aln,
+		max_representatives=max_representatives)
+	return
+
+
+def main():
+	args = get_args()
+	if args.cache:
+		aln = AlignmentCache.load_or_build(args.fasta, args.count_table)
+	else:
+		aln = WeightedAlignment.load(args.fasta, args.count_table)
+	result = oligotype(aln, args.positions,
+		min_number_of_samples=args.min_number_of_samples,
+		min_percent_abundance=args.min_percent_abundance,
+		min_actual_abundance=args.min_actual_abundance,
+		min_substantive_abundance=args.min_substantive_abundance,
+	)
+	save_oligotype_output(args.output_dir, result, aln,
+		max_representatives=args.max_representatives)
+	print("%u oligotypes in %u samples" % (result.n_oligos,
+		len(result.samples)), file=sys.stderr)
+	return
+
+
+if __name__ == "__main__":
+	main()
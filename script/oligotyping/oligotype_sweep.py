@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+import argparse
+import shutil
+import sys
+
+import numpy
+
+from aln_io import get_fp, AlignmentCache, WeightedAlignment
+from filter_position import load_postion_entropy, filter_positions
+from oligotype_native import parse_positions, oligotype, \
+	save_oligotype_output, get_collapsed_weights
+
+
+def get_args() -> argparse.Namespace:
+	ap = argparse.ArgumentParser(description="run native oligotyping over "
+		"multiple entropy thresholds or position sets in one pass over the "
+		"alignment")
+	ap.add_argument("fasta", type=str,
+		help="aligned fasta; unique sequences if --count-table is set, "
+			"otherwise redundant reads with '<sample>_<read>' headers")
+	ap.add_argument("--count-table", "-c", type=str,
+		metavar="count_table",
+		help="mothur count_table of the unique sequences in <fasta> [no]")
+	ap.add_argument("--cache", action="store_true",
+		help="read the alignment from its binary cache <fasta>.alncache.*, "
+			"which is (re)built if missing or outdated [no]")
+	ap.add_argument("--entropy", "-e", type=str,
+		metavar="txt",
+		help="ranked 2-column position-entropy table, e.g. "
+			"mothur2oligo.fasta-ENTROPY.ranked; required by -t/--thresholds")
+	ap.add_argument("--thresholds", "-t", type=str,
+		metavar="float,float,...",
+		help="comma-separated entropy thresholds, each selects positions the "
+			"same way as filter_position.py -t")
+	ap.add_argument("--positions", "-C", type=str, action="append",
+		default=list(), metavar="int,int,...",
+		help="a comma-separated position set to oligotype on, can be used "
+			"multiple times")
+	ap.add_argument("--output-prefix", "-o", type=str,
+		metavar="prefix",
+		help="output directory prefix, each setting is written to "
+			"<prefix><positions joined by '_'> [<fasta>.position_oligotype.]")
+	ap.add_argument("--summary", "-S", type=str, default="-",
+		metavar="tsv",
+		help="summary table of number of oligotypes per setting [stdout]")
+	ap.add_argument("--min-number-of-samples", "-s", type=int, default=1,
+		metavar="int",
+		help="minimum number of samples an oligotype must occur in [1]")
+	ap.add_argument("--min-percent-abundance", "-a", type=float, default=0.0,
+		metavar="float",
+		help="minimum percent abundance of an oligotype in at least one sample "
+			"[0]")
+	ap.add_argument("--min-actual-abundance", "-A", type=int, default=0,
+		metavar="int",
+		help="minimum total count of an oligotype across all samples [0]")
+	ap.add_argument("--min-substantive-abundance", "-M", type=int, default=0,
+		metavar="int",
+		help="minimum count of the most abundant unique sequence in an "
+			"oligotype [0]")
+	ap.add_argument("--max-representatives", type=int, default=0,
+		metavar="int",
+		help="maximum number of unique sequences written per oligotype in "
+			"OLIGO-REPRESENTATIVES, 0 means all [0]")
+
+	# parse and refine args
+	args = ap.parse_args()
+	if (args.thresholds is None) and (not args.positions):
+		ap.error("at least one of -t/--thresholds or -C/--positions is required")
+	if (args.thresholds is not None) and (args.entropy is None):
+		ap.error("-t/--thresholds requires -e/--entropy")
+	if args.output_prefix is None:
+		args.output_prefix = args.fasta + ".position_oligotype."
+	if args.summary == "-":
+		args.summary = sys.stdout
+
+	return args
+
+
+def get_sweep_settings(*, entropy_file=None, thresholds: str = None,
+		position_sets: list = tuple()) -> list:
+	"""
+	return: list of (label, positions) of each setting
+	"""
+	ret = list()
+	if thresholds is not None:
+		pos_entropy = load_postion_entropy(entropy_file)
+		for t in [float(i) for i in thresholds.split(",") if i.strip()]:
+			ret.append(("threshold=%s" % t, filter_positions(pos_entropy, t)))
+	for s in position_sets:
+		ret.append(("positions", parse_positions(s)))
+	return ret
+
+
+def sweep_oligotype(aln: WeightedAlignment, settings: list, *,
+		output_prefix: str, max_representatives=0, **kw) -> list:
+	"""
+	oligotype <aln> with each setting and save to its own output directory;
+	columns of all positions are sliced from the alignment once and reused by
+	every setting, settings of the same positions in any order are computed
+	once, and share the output directory of the first of them
+
+	return: list of (label, positions, number of oligotypes, output dir)
+	"""
+	union = sorted(set(p for _, positions in settings for p in positions))
+	union_index = {p: i for i, p in enumerate(union)}
+	union_columns = numpy.asarray(aln.matrix[:, union])
+	if kw.get("min_substantive_abundance", 0) > 0:
+		kw["collapsed_weights"] = get_collapsed_weights(aln)
+
+	ret = list()
+	done = dict()
+	for label, positions in settings:
+		if not positions:
+			ret.append((label, positions, 0, None))
+			continue
+		key = tuple(sorted(positions))
+		if key not in done:
+			out_dir = output_prefix + ("_").join([str(i) for i in positions])
+			columns = union_columns[:, [union_index[p] for p in positions]]
+			result = oligotype(aln, positions, columns=columns, **kw)
+			# clean up old results, as oligotyping.sh does
+			shutil.rmtree(out_dir, ignore_errors=True)
+			save_oligotype_output(out_dir, result, aln,
+				max_representatives=max_representatives)
+			done[key] = (result.n_oligos, out_dir)
+		n_oligos, out_dir = done[key]
+		ret.append((label, positions, n_oligos, out_dir))
+	return ret
+
+
+def save_summary(f, summary: list, delimiter="\t") -> None:
+	with get_fp(f, "w") as fp:
+		print(delimiter.join(["setting", "n_positions", "n_oligotypes",
+			"positions", "output_dir"]), file=fp)
+		for label, positions, n_oligos, out_dir in summary:
+			print(delimiter.join([label, str(len(positions)), str(n_oligos),
+				(",").join([str(i) for i in positions]), out_dir or ""]), file=fp)
+	return
+
+
+def main():
+	args = get_args()
+	settings = get_sweep_settings(entropy_file=args.entropy,
+		thresholds=args.thresholds, position_sets=args.positions)
+	if args.cache:
+		aln = AlignmentCache.load_or_build(args.fasta, args.count_table)
+	else:
+		aln = WeightedAlignment.load(args.fasta, args.count_table)
+	summary = sweep_oligotype(aln, settings,
+		output_prefix=args.output_prefix,
+		max_representatives=args.max_representatives,
+		min_number_of_samples=args.min_number_of_samples,
+		min_percent_abundance=args.min_percent_abundance,
+		min_actual_abundance=args.min_actual_abundance,
+		min_substantive_abundance=args.min_substantive_abundance,
+	)
+	save_summary(args.summary, summary)
+	return
+
+
+if __name__ == "__main__":
+	main()
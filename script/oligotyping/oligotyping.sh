@@ -4,17 +4,30 @@
 
 positions=$(cat filtered_positions)
 aln="mothur2oligo.fasta"
+# aligned unique sequences and their counts, used by the native engine
+unique_aln="mothur2oligo.unique.fasta"
+count_table="mothur2oligo.count_table"
+
+# oligotyping engine:
+#   native: assign oligotypes from unique sequences weighted by count_table
+#   oligotyping: run oligotype over the redundant reads
+engine="native"
 
 entropy=$aln"-ENTROPY"
 out_dir=$aln".position_oligotype."$(echo $positions | sed 's/,/_/g')
 
 rm -rf $out_dir # clean up old results
 
-oligotype -M 0 -s 3 -C $positions -N $SLURM_CPUS_PER_TASK -o $out_dir \
-	$aln $aln"-ENTROPY"
+if [[ $engine == "native" ]]; then
+	script/oligotype_native.py -M 0 -s 3 -C $positions -o $out_dir \
+		--cache -c $count_table $unique_aln
+else
+	oligotype -M 0 -s 3 -C $positions -N $SLURM_CPUS_PER_TASK -o $out_dir \
+		$aln $aln"-ENTROPY"
+fi
 
 ln -sfT $out_dir mothur2oligo.fasta.oligo_final
 
 script/plot.oligo_size_histogram.py \
 	-p $out_dir.oligo_size_histogram.png \
-	$out_dir
\ No newline at end of file
+	$out_dir
@@ -6,11 +6,13 @@ import itertools
 import matplotlib
 import matplotlib.pyplot
 import numpy
-import os
 import sys
 
 import mpllayout
 
+import oligo_io
+from oligo_io import OligoTable, matrix_count_file_from_dir
+
 
 def get_args():
 	ap = argparse.ArgumentParser()
@@ -31,6 +33,9 @@ def get_args():
 	ap.add_argument("--dpi", type=int, default=300,
 		metavar="int",
 		help="plot image DPI [300]")
+	ap.add_argument("--sparse", action="store_true",
+		help="load counts as a sparse matrix, only the plotted oligos are "
+			"densified; requires scipy [no]")
 
 	# parse and refine arsg
 	args = ap.parse_args()
@@ -62,7 +67,7 @@ class OligoCountTable(object):
 
 	@property
 	def sample_count_sum(self) -> numpy.ndarray:
-		return self.data.sum(axis=1)
+		return oligo_io.row_sums(self.data)
 
 	def validate_data(self) -> None:
 		if self.data.ndim != 2:
@@ -89,29 +94,26 @@ class OligoCountTable(object):
 		return
 
 	@classmethod
-	def from_oligo_outptu_dir(cls, oligo_output_dir: str, *, delimiter="\t"):
-		if not os.path.isdir(oligo_output_dir):
-			raise IOError("'%s' is not a directory" % oligo_output_dir)
-		fname = os.path.join(oligo_output_dir, "MATRIX-COUNT.txt")
-		if not os.path.isfile(fname):
-			raise IOError("cannot find file '%s', oligotyping output might be "
-				"incomplete" % fname)
-		return cls.from_oligo_output_matrix_count(fname, delimiter=delimiter)
+	def from_oligo_outptu_dir(cls, oligo_output_dir: str, *, delimiter="\t",
+			sparse=False):
+		fname = matrix_count_file_from_dir(oligo_output_dir)
+		return cls.from_oligo_output_matrix_count(fname, delimiter=delimiter,
+			sparse=sparse)
 
 	@classmethod
-	def from_oligo_output_matrix_count(cls, fname: str, *, delimiter="\t"):
-		# read data
-		raw = numpy.loadtxt(fname, dtype=object, delimiter=delimiter)
-		samples = raw[1:, 0]
-		oligos = raw[0, 1:]
-		data = raw[1:, 1:].astype(int)
-
-		new = cls(samples=samples, oligos=oligos, data=data)
+	def from_oligo_output_matrix_count(cls, fname: str, *, delimiter="\t",
+			sparse=False):
+		# read data, through the binary cache of oligo_io
+		table = OligoTable.from_matrix_count(fname, delimiter=delimiter,
+			sparse=sparse)
+		new = cls(samples=table.samples, oligos=table.oligos,
+			data=table.counts)
 		return new
 
 	def select_by_oligo_list(self, oligo_list, **kw):
 		select_oligos = set(oligo_list)
-		mask = [i in select_oligos for i in self.oligos]
+		mask = numpy.array([i in select_oligos for i in self.oligos],
+			dtype=bool)
 
 		# create new object
 		samples = self.samples.copy()
@@ -202,8 +204,9 @@ def plot_oligo_abund_stackbar(png, count_table: OligoCountTable, *,
 	colors = OligoColorList.get_default_list()
 
 	ax = layout["axes"]
-	counts = count_table.data
-	fracs = counts / total_counts.reshape(-1, 1)
+	# only the plotted oligos are densified
+	fracs = oligo_io.to_dense(oligo_io.normalize_rows(count_table.data,
+		total_counts))
 	bottom = numpy.zeros(n_samples, dtype=float)
 	handles = list()
 
@@ -242,7 +245,8 @@ def plot_oligo_abund_stackbar(png, count_table: OligoCountTable, *,
 def main():
 	args = get_args()
 	# load data
-	count_table = OligoCountTable.from_oligo_outptu_dir(args.oligo_output)
+	count_table = OligoCountTable.from_oligo_outptu_dir(args.oligo_output,
+		sparse=args.sparse)
 	# plot
 	plot_oligo_abund_stackbar(args.plot, count_table,
 		oligo_list_file=args.oligo_list, dpi=args.dpi)
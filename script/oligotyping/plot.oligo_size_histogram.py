@@ -10,6 +10,8 @@ import sys
 
 import mpllayout
 
+from oligo_io import OligoTable
+
 
 def get_args() -> argparse.Namespace:
 	ap = argparse.ArgumentParser()
@@ -61,9 +63,7 @@ class OligoSize(object):
 		if not os.path.isfile(path):
 			raise IOError("path '%s' is not a file, make sure the oligotyping "
 				"finished completely" % path)
-		raw = numpy.loadtxt(path, dtype=object, delimiter="\t")
-		data = raw[1:, 1:].astype(int)
-		new = cls(count_data=data)
+		new = cls(count_data=OligoTable.from_matrix_count(path).counts)
 		return new
 
 	@classmethod
@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 
+import abc
 import argparse
+import concurrent.futures
 import os
 import re
 import subprocess
@@ -8,7 +10,9 @@ import sys
 import typing
 import warnings
 
-import Bio.SeqIO # for reading fasta
+import blast_checkpoint
+import job_scheduler
+from work_queue import WorkQueue
 
 
 def get_args():
@@ -24,6 +28,54 @@ def get_args():
 	ap.add_argument("--log-dir", type=str, default=".log",
 		metavar="dir",
 		help="log directory [.log]")
+	ap.add_argument("--executor", "-E", type=str, default="slurm",
+		choices=["slurm", "local"],
+		help="how worker jobs are run: 'slurm' submits each job with sbatch, "
+			"'local' runs jobs as local processes [slurm]")
+	ap.add_argument("--concurrency", "-J", type=int,
+		metavar="int",
+		help="maximum number of concurrently running jobs, only used by the "
+			"local executor [--max-n-jobs]")
+	ap.add_argument("--threads-per-job", "-T", type=int,
+		metavar="int",
+		help="number of threads used by each job; for slurm this is passed as "
+			"sbatch -c [worker script default for slurm, 1 for local]")
+	ap.add_argument("--batch-query", "-B", action="store_true",
+		help="in each job, blast all representatives as one query and "
+			"blastdbcmd all hits at once, instead of once per file [no]")
+	ap.add_argument("--retries", type=int, default=0,
+		metavar="int",
+		help="number of times a failed job is retried, only used by the local "
+			"executor [0]")
+	ap.add_argument("--split-strategy", type=str, default="cga",
+		choices=sorted(job_scheduler.STRATEGIES),
+		help="how files are split into jobs of even estimated cost, see "
+			"job_scheduler.py: 'lpt' longest first greedy, 'ffd' first-fit "
+			"decreasing, 'kk' Karmarkar-Karp differencing, 'cga' complete "
+			"greedy refinement of lpt/kk, 'legacy' the previous first-fit "
+			"bisection [cga]")
+	ap.add_argument("--cost", type=str, default="bases",
+		choices=["bases", "seqs"],
+		help="estimated BLAST cost of each file: 'bases' is the number of "
+			"sequences times their length, 'seqs' the number of sequences "
+			"[bases]")
+	ap.add_argument("--work-queue", "-Q", action="store_true",
+		help="instead of splitting files into fixed lists, put all files in a "
+			"queue <output-dir>/work_queue.sqlite, from which --max-n-jobs "
+			"workers claim files one at a time until it is drained; workers "
+			"send heartbeats and reclaim files of dead workers; rerunning "
+			"resumes the queue (exclusive with -B/--batch-query) [no]")
+	ap.add_argument("--force", "-f", action="store_true",
+		help="blast all files, by default files already done are skipped, "
+			"i.e. files with a completion marker consistent with both the "
+			"representative file and the outputs [no]")
+	ap.add_argument("--exclude", "-x", type=str,
+		metavar="txt",
+		help="skip representative files in this list, e.g. those resolved by "
+			"kmer_classifier.py classify --resolved [no]")
+	ap.add_argument("--status", action="store_true",
+		help="only show the number of files done, pending, missing, "
+			"truncated or stale, and list those not done; submit nothing [no]")
 	ap.add_argument("--dry-run", "-N", action="store_true",
 		help="do not submit any jobs or make any changes")
 
@@ -33,93 +85,160 @@ def get_args():
 		warnings.warn("--max-n-jobs got an invalid value: '%d' and is reset to "
 			"1" % args.max_n_jobs)
 		args.max_n_jobs = 1 # fix offending values to the default
+	if args.concurrency is None:
+		args.concurrency = args.max_n_jobs
+	if args.concurrency < 1:
+		ap.error("-J/--concurrency must be positive")
+	if (args.threads_per_job is not None) and (args.threads_per_job < 1):
+		ap.error("-T/--threads-per-job must be positive")
+	if args.retries < 0:
+		ap.error("--retries cannot be negative")
+	if args.work_queue and args.batch_query:
+		ap.error("-Q/--work-queue cannot be used with -B/--batch-query")
 
 	return args
 
 
+# IUPAC nucleotide codes, gaps and stop, in both cases
+FASTA_SEQ_CHARS = b"ACGTURYSWKMBDHVN-.*acgturyswkmbdhvn"
+
+
+def count_fasta(path: str, buffer_size=1 << 20) -> (int, int):
+	"""
+	count records and ungapped bases of a fasta file in a single buffered pass,
+	without parsing records; also checks the format, a file is malformed if it
+	has any content before the first header or any invalid sequence character,
+	e.g. from a truncated or corrupted file
+
+	return: number of records and total number of bases
+	"""
+	n_seqs, n_bases = 0, 0
+	with open(path, "rb", buffering=buffer_size) as fp:
+		for line_no, line in enumerate(fp, 1):
+			if line.startswith(b">"):
+				n_seqs += 1
+				continue
+			# whitespace is ignored, as by Bio.SeqIO
+			line = line.translate(None, b" \t\r\n")
+			if not line:
+				continue
+			if (not n_seqs) or line.translate(None, FASTA_SEQ_CHARS):
+				raise ValueError("malformed fasta '%s' at line %u"
+					% (path, line_no))
+			n_bases += len(line) - line.count(b"-") - line.count(b".")
+	return n_seqs, n_bases
+
+
 class OligoRepUniqStats(object):
-	def __init__(self, files: list, *ka, **kw):
+	def __init__(self, files: list, *ka, threads: int = 8, **kw):
 		super().__init__(*ka, **kw)
 		self.files = files
-		self._stat_file_num_seqs()
+		self._stat_file_num_seqs(threads=threads)
 		return
 
 	@classmethod
 	def scan_oligo_output(cls, path: str, scan_suffix="_unique"):
-		if not os.path.isdir(path):
-			raise IOError("'%s' is not a directory" % path)
-		rep_dir = os.path.join(path, "OLIGO-REPRESENTATIVES")
-		if not os.path.isdir(rep_dir):
-			raise IOError("dir '%s' is missing, may be incomplete oligotyping "
-				"output" % rep_dir)
-		# scan dir for target files
-		files = list()
-		for i in os.scandir(rep_dir):
-			if i.name.endswith(scan_suffix):
-				files.append(i.path)
-
-		new = cls(files=files)
+		new = cls(files=blast_checkpoint.scan_rep_files(path, scan_suffix))
 		return new
 
 	@property
 	def num_seqs(self) -> tuple:
 		return self._num_seqs
 
-	def _stat_file_num_seqs(self):
-		num_seqs = list()
-		for i in self.files:
-			try:
-				# use a formal fasta parser can also help check the file format
-				n = len((list(Bio.SeqIO.parse(i, format="fasta"))))
-			except:
-				print("fail to parse file: %s" % i, file=sys.stderr)
-				sys.exit(-1)
-			num_seqs.append(n)
-		self._num_seqs = tuple(num_seqs)
+	@property
+	def num_bases(self) -> tuple:
+		return self._num_bases
+
+	def get_costs(self, cost="bases") -> tuple:
+		"""
+		estimated BLAST cost of each file
+		"""
+		if cost == "bases":
+			return self.num_bases
+		elif cost == "seqs":
+			return self.num_seqs
+		raise ValueError("unknown cost '%s'" % cost)
+
+	def _stat_file_num_seqs(self, threads: int = 8):
+		stats = list()
+		# reading is I/O bound, threads are enough
+		with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as pool:
+			futures = [pool.submit(count_fasta, i) for i in self.files]
+			for i, f in zip(self.files, futures):
+				try:
+					stats.append(f.result())
+				except (OSError, ValueError) as e:
+					print("fail to parse file: %s (%s)" % (i, e), file=sys.stderr)
+					sys.exit(-1)
+		self._num_seqs = tuple(i[0] for i in stats)
+		self._num_bases = tuple(i[1] for i in stats)
 		return
 
 
-class OligoRepBlastJobSubmit(object):
-	def __init__(self, *ka, oligo_output: str, output_dir: str, log_dir: str,
-			max_n_jobs: int = 1, **kw):
+class WorkerExecutor(abc.ABC):
+	"""
+	interface of backends running the worker script on each job input list;
+	workers write their results to the output directory, the same way
+	regardless of the backend
+	"""
+	default_worker = ["script/worker.oligo_fasta_blastn.sh"]
+	batch_query_worker = ["script/oligo_blastn.py", "batch"]
+	queue_worker = ["script/oligo_blastn.py", "queue"]
+
+	def __init__(self, *ka, output_dir: str, log_dir: str,
+			threads_per_job: typing.Optional[int] = None,
+			worker: typing.Optional[list] = None, **kw):
 		super().__init__(*ka, **kw)
-		self.oligo_output = oligo_output
 		self.output_dir = output_dir
 		self.log_dir = log_dir
-		self.max_n_jobs = max_n_jobs
-		self.fasta_stats = OligoRepUniqStats.scan_oligo_output(oligo_output)
+		self.threads_per_job = threads_per_job
+		# worker script followed by its arguments before the input list
+		self.worker = list(self.default_worker if worker is None else worker)
 		return
 
-	def submit_jobs(self, dry_run=False) -> int:
-		# create output dirs
-		if not dry_run:
-			os.makedirs(self.output_dir, exist_ok=True)
-			os.makedirs(self.log_dir, exist_ok=True)
+	def get_local_worker_cmd(self, worker_input_file: str) -> list:
+		script = self.worker[0]
+		interpreter = [sys.executable] if script.endswith(".py") else ["bash"]
+		return interpreter + self.worker + [worker_input_file]
 
-		fasta_lists = self.split_job_fasta_lists()
-		# submit individual worker jobs
-		worker_input_files = list()
-		for i, flist in enumerate(fasta_lists):
-			# save flist for workers to read
-			flist_file = os.path.join(self.output_dir, "split_%03u.tmp" % i)
-			if not dry_run:
-				with open(flist_file, "w") as fp:
-					for f in flist:
-						print(f, file=fp)
-			worker_input_files.append(flist_file)
+	@staticmethod
+	def get_job_name(worker_input_file: str) -> str:
+		return "oligo_blastn." + os.path.basename(worker_input_file)
+
+	def get_log_file(self, job_name: str) -> str:
+		return os.path.join(self.log_dir, job_name + ".log")
+
+	def get_job_names(self, worker_input_files: list,
+			job_names: typing.Optional[list] = None) -> list:
+		if job_names is None:
+			return [self.get_job_name(f) for f in worker_input_files]
+		return job_names
 
-		# submit worker jobs 
-		return self._submit_slurm_workers(worker_input_files, dry_run=dry_run)
+	@abc.abstractmethod
+	def run(self, worker_input_files: list, *, dry_run=False,
+			job_names: typing.Optional[list] = None) -> int:
+		"""
+		job_names: names of jobs, required if <worker_input_files> are not
+			unique, e.g. workers of the same queue [derived from input files]
+
+		return: 0 on success, non-zero on failure
+		"""
+		pass
 
-	def _submit_slurm_workers(self, worker_input_files: list, *, dry_run=False
-			) -> int:
+
+class SlurmExecutor(WorkerExecutor):
+	def run(self, worker_input_files: list, *, dry_run=False,
+			job_names: typing.Optional[list] = None) -> int:
 		jobids = list()
 
-		for f in worker_input_files:
-			job_name = "oligo_blastn." + os.path.basename(f)
-			log_file = os.path.join(self.log_dir, job_name + ".log")
+		job_names = self.get_job_names(worker_input_files, job_names)
+		for f, job_name in zip(worker_input_files, job_names):
+			log_file = self.get_log_file(job_name)
 			cmd = ["sbatch", "-J", job_name, "-o", log_file,
-				"script/worker.oligo_fasta_blastn.sh", f]
+				"--export=ALL,BLASTN_DIR=%s" % self.output_dir]
+			if self.threads_per_job is not None:
+				cmd.extend(["-c", str(self.threads_per_job)])
+			cmd.extend(self.worker + [f])
 			if not dry_run:
 				sp = subprocess.run(cmd, stdout=subprocess.PIPE)
 				print(sp.stdout.decode("utf-8"), file=sys.stdout, end="")
@@ -148,86 +267,218 @@ class OligoRepBlastJobSubmit(object):
 		subprocess.run(cmd)
 		return
 
-	def split_job_fasta_lists(self) -> list:
-		ret = list()
-		for s in self._split_solve(self.fasta_stats.num_seqs, self.max_n_jobs):
-			ret.append([self.fasta_stats.files[i] for i in s])
+
+class LocalExecutor(WorkerExecutor):
+	"""
+	run worker jobs as local processes, at most <concurrency> at a time; each
+	failed job is retried up to <retries> times
+	"""
+	def __init__(self, *ka, concurrency: int = 1, retries: int = 0, **kw):
+		super().__init__(*ka, **kw)
+		self.concurrency = concurrency
+		self.retries = retries
+		return
+
+	def _run_job(self, worker_input_file: str, job_name: str) -> int:
+		cmd = self.get_local_worker_cmd(worker_input_file)
+		env = dict(os.environ,
+			BLASTN_DIR=self.output_dir,
+			SLURM_CPUS_PER_TASK=str(self.threads_per_job or 1),
+		)
+		ret = -1
+		with open(self.get_log_file(job_name), "w") as log:
+			for attempt in range(self.retries + 1):
+				if attempt:
+					print("retry %u/%u" % (attempt, self.retries), file=log,
+						flush=True)
+				ret = subprocess.run(cmd, env=env, stdout=log,
+					stderr=subprocess.STDOUT).returncode
+				if not ret:
+					break
 		return ret
 
-	@staticmethod
-	def _split_attempt(arr: list, s: int, k: int) -> typing.Optional[list]:
-		"""
-		try to split the <ilist> (list of integers) into <k> number of sublists,
-		s.t. minimizing the max sum among all sublists; intending to split child
-		jobs as even as possible;
+	def run(self, worker_input_files: list, *, dry_run=False,
+			job_names: typing.Optional[list] = None) -> int:
+		if dry_run:
+			for f in worker_input_files:
+				print("running: " + str(self.get_local_worker_cmd(f)),
+					file=sys.stderr)
+			return 0
+
+		n_failed = 0
+		# jobs are subprocesses, threads here only wait for them
+		with concurrent.futures.ThreadPoolExecutor(
+				max_workers=self.concurrency) as pool:
+			futures = {pool.submit(self._run_job, f, n): n
+				for f, n in zip(worker_input_files,
+					self.get_job_names(worker_input_files, job_names))}
+			for future in concurrent.futures.as_completed(futures):
+				job_name = futures[future]
+				ret = future.result()
+				if ret:
+					n_failed += 1
+					print("job %s failed with return code %d, see %s"
+						% (job_name, ret, self.get_log_file(job_name)),
+						file=sys.stderr)
+				else:
+					print("job %s finished" % job_name, file=sys.stderr)
+		return -1 if n_failed else 0
+
+
+class OligoRepBlastJobSubmit(object):
+	def __init__(self, *ka, oligo_output: str, output_dir: str, log_dir: str,
+			max_n_jobs: int = 1, executor: WorkerExecutor = None,
+			split_strategy="cga", cost="bases", work_queue=False, resume=True,
+			exclude: typing.Optional[list] = None, **kw):
+		super().__init__(*ka, **kw)
+		self.oligo_output = oligo_output
+		self.output_dir = output_dir
+		self.log_dir = log_dir
+		self.max_n_jobs = max_n_jobs
+		self.split_strategy = split_strategy
+		self.cost = cost
+		self.work_queue = work_queue
+		if executor is None:
+			executor = SlurmExecutor(output_dir=output_dir, log_dir=log_dir)
+		self.executor = executor
+		files = blast_checkpoint.scan_rep_files(oligo_output)
+		if exclude:
+			exclude = set(os.path.realpath(i) for i in exclude)
+			n_files = len(files)
+			files = [f for f in files if os.path.realpath(f) not in exclude]
+			print("%u/%u representative files excluded" % (n_files - len(files),
+				n_files), file=sys.stderr)
+		self.file_states = blast_checkpoint.check_files(output_dir, files)
+		self.resume = resume
+		if resume:
+			# skip files of which outputs are complete and up to date
+			files = [f for f in files if self.file_states[f] != "done"]
+		self.fasta_stats = OligoRepUniqStats(files)
+		return
+
+	def submit_jobs(self, dry_run=False) -> int:
+		# create output dirs
+		if not dry_run:
+			os.makedirs(self.output_dir, exist_ok=True)
+			os.makedirs(self.log_dir, exist_ok=True)
+
+		blast_checkpoint.report_status(self.file_states)
+		if not self.fasta_stats.files:
+			print("nothing to submit", file=sys.stderr)
+			return 0
+		if self.work_queue:
+			return self.submit_queue_workers(dry_run=dry_run)
+
+		if (not self.resume) and (not dry_run):
+			# the files worker skips files already done, so that retries do
+			# not blast them again; forced files must not look done
+			for f in self.fasta_stats.files:
+				blast_checkpoint.unmark(self.output_dir, f)
+		fasta_lists = self.split_job_fasta_lists()
+		# submit individual worker jobs
+		worker_input_files = list()
+		for i, flist in enumerate(fasta_lists):
+			# save flist for workers to read
+			flist_file = os.path.join(self.output_dir, "split_%03u.tmp" % i)
+			if not dry_run:
+				with open(flist_file, "w") as fp:
+					for f in flist:
+						print(f, file=fp)
+			worker_input_files.append(flist_file)
 
-		arr: an array of integers, representing the size of each atomic job
-		s: the desired max of sublist sums
-		k: the number of sublists
+		# run worker jobs
+		return self.executor.run(worker_input_files, dry_run=dry_run)
 
-		return: a list of lists of indices of elements in ilist; can be None if
-			the desired split given by parameter s and k is not feasible
+	def submit_queue_workers(self, dry_run=False) -> int:
 		"""
-		sub_sums = list()
-		sub_idxs = list()
-
-		for i, v in enumerate(arr):
-			#if v > s:
-			#	# not feasible since a single element is larger than s
-			#	return None
-
-			for j in range(len(sub_sums)):
-				if sub_sums[j] + v <= s:
-					# the sublist can accept the current element
-					sub_sums[j] += v
-					sub_idxs[j].append(i)
-					break
-			else:
-				# if reach here, need to add a new sublist
-				sub_sums.append(v)
-				sub_idxs.append([i])
+		put all files in a work queue, largest first by cost, and run
+		<max_n_jobs> workers that all pull from it
+		"""
+		queue_file = os.path.join(self.output_dir, "work_queue.sqlite")
+		n_workers = min(self.max_n_jobs, len(self.fasta_stats.files))
+		if not dry_run:
+			with WorkQueue(queue_file) as queue:
+				queue.add(self.fasta_stats.files,
+					self.fasta_stats.get_costs(self.cost))
+				# files done or failed in a previous run of the queue, but of
+				# which outputs are not complete any more
+				queue.reset(self.fasta_stats.files)
+				counts = queue.counts()
+			print("work queue %s: %u pending, %u done, %u failed; starting %u "
+				"workers" % (queue_file, counts["pending"], counts["done"],
+					counts["failed"], n_workers), file=sys.stderr)
+		job_names = ["oligo_blastn.queue_%03u" % i for i in range(n_workers)]
+		return self.executor.run([queue_file] * n_workers, dry_run=dry_run,
+			job_names=job_names)
 
-		# check if the number of sublists is within k
-		return sub_idxs if (len(sub_idxs) <= k) else None
+	def split_job_fasta_lists(self) -> list:
+		costs = self.fasta_stats.get_costs(self.cost)
+		splits = job_scheduler.split(costs, self.max_n_jobs,
+			self.split_strategy)
+		# empty splits are not submitted
+		splits = [i for i in splits if i]
+		stats = job_scheduler.schedule_stats(costs, splits)
+		print("split %u files into %u jobs by %s (%s): makespan %u, lower "
+			"bound %u, imbalance %.1f%%" % (len(costs), len(splits), self.cost,
+				self.split_strategy, stats["makespan"], stats["lower_bound"],
+				stats["imbalance"] * 100), file=sys.stderr)
+		ret = list()
+		for s in splits:
+			ret.append([self.fasta_stats.files[i] for i in s])
+		return ret
 
-	@staticmethod
-	def _split_solve(arr: list, k: int) -> list:
-		if not arr:
-			raise ValueError("arr cannot be empty")
-		if k < 1:
-			raise ValueError("k must be positive, got '%d'" % k)
-		if k == 1:
-			# no need to go further if split into 1 split...
-			return [list(range(len(arr)))]
-
-		# lower bound of searching range
-		ran_l = min(arr)
-		# higher bound of searching range
-		ran_h = sum(arr)
-
-		# using a binary-search-like approach
-		solution = None
-		while ran_l <= ran_h:
-			s = (ran_l + ran_h) // 2
-			attempt = OligoRepBlastJobSubmit._split_attempt(arr, s, k)
-			if attempt is not None:
-				solution = attempt
-				ran_h = s - 1
-			else:
-				ran_l = s + 1
 
-		return solution
+def load_file_list(f) -> list:
+	with open(f, "r") as fp:
+		ret = [i for i in fp.read().splitlines() if i]
+	return ret
 
 
 def main():
 	args = get_args()
+	if args.status:
+		file_states = blast_checkpoint.check_files(args.output_dir,
+			blast_checkpoint.scan_rep_files(args.oligo_output))
+		blast_checkpoint.report_status(file_states, file=sys.stdout,
+			list_files=True)
+		return
+	if args.work_queue:
+		worker = WorkerExecutor.queue_worker
+	elif args.batch_query:
+		worker = WorkerExecutor.batch_query_worker
+	else:
+		worker = None
+	if args.executor == "local":
+		executor = LocalExecutor(
+			output_dir=args.output_dir,
+			log_dir=args.log_dir,
+			threads_per_job=args.threads_per_job,
+			worker=worker,
+			concurrency=args.concurrency,
+			retries=args.retries,
+		)
+	else:
+		executor = SlurmExecutor(
+			output_dir=args.output_dir,
+			log_dir=args.log_dir,
+			threads_per_job=args.threads_per_job,
+			worker=worker,
+		)
 	o = OligoRepBlastJobSubmit(
 		oligo_output=args.oligo_output,
 		output_dir=args.output_dir,
 		log_dir=args.log_dir,
 		max_n_jobs=args.max_n_jobs,
+		executor=executor,
+		split_strategy=args.split_strategy,
+		cost=args.cost,
+		work_queue=args.work_queue,
+		resume=not args.force,
+		exclude=None if args.exclude is None
+			else load_file_list(args.exclude),
 	)
-	o.submit_jobs(dry_run=args.dry_run)
+	if o.submit_jobs(dry_run=args.dry_run):
+		sys.exit(1)
 	return
 
 
@@ -11,15 +11,21 @@ import os
 import re
 import sys
 
+from acc_tax_cache import AccTaxCache, strip_accession_version
+from blastn_store import BlastHitStore
+
 
 def get_args():
 	ap = argparse.ArgumentParser()
 	ap.add_argument("dirname", type=str,
-		help="directory name that contains all blastdbcmd taxonomy tables")
+		help="directory name that contains all blastdbcmd taxonomy tables, or "
+			"blastn hit tables if -c/--tax-cache is set; or a .npz store built "
+			"by blastn_store.py, which is read at once")
 	ag = ap.add_mutually_exclusive_group()
 	ag.add_argument("-x", "--scan-ext", type=str, metavar="str",
 		help="scan for all files with this extension in <dirname> to process "
-			"(exclusive with -l/--file-list) [blastdbcmd]")
+			"(exclusive with -l/--file-list) [blastdbcmd, or blastn if "
+			"-c/--tax-cache is set]")
 	ag.add_argument("-l", "--file-list", type=str, metavar="file",
 		help="provide a list of files in <dirname> instead of scanning by "
 			"extension (exclusive with -x/--scan-ext)")
@@ -29,6 +35,46 @@ def get_args():
 	ap.add_argument("-k", "--key-field", type=int, default=2,
 		metavar="int",
 		help="the taxnomy value field number (0-based) in input files [0]")
+	ap.add_argument("-c", "--tax-cache", type=str,
+		metavar="sqlite",
+		help="read taxonomy of the blastn hits from this accession taxonomy "
+			"cache (see acc_tax_cache.py) instead of per-oligo blastdbcmd "
+			"tables; -k/--key-field then refers to the blastdbcmd fields "
+			"(accession, taxid, scientific name) [no]")
+	ap.add_argument("-K", "--kmer-assignments", type=str,
+		metavar="table",
+		help="per-sequence assignments of kmer_classifier.py classify -o; "
+			"oligos without BLAST output, e.g. excluded from BLAST by "
+			"submit.oligo_fasta_blastn.py --exclude, are counted from their "
+			"assigned sequences instead, one vote per sequence [no]")
+	ap.add_argument("--min-kmer-frac", type=float, default=0.9,
+		metavar="float",
+		help="only count sequences of -K/--kmer-assignments assigned with at "
+			"least this fraction of k-mers, same as kmer_classifier.py "
+			"classify [0.9]")
+	ag = ap.add_argument_group("hit quality options",
+		description="these join blastn hits with their taxonomy; if <dirname> "
+			"is a directory, it is read the same way as by blastn_store.py")
+	ag.add_argument("--min-pident", type=float,
+		metavar="float",
+		help="only count hits of at least this percent identity [no]")
+	ag.add_argument("--min-bitscore", type=float,
+		metavar="float",
+		help="only count hits of at least this bitscore [no]")
+	ag.add_argument("--max-evalue", type=float,
+		metavar="float",
+		help="only count hits of at most this evalue [no]")
+	ag.add_argument("--best-hit-only", action="store_true",
+		help="only count the hits of the highest bitscore of each query "
+			"sequence, ties are all counted [no]")
+	ag.add_argument("--pident-window", type=float,
+		metavar="float",
+		help="only count hits within this percent identity below the best hit "
+			"of the same query sequence [no]")
+	ag.add_argument("--weight", type=str, default="count",
+		choices=["count", "bitscore"],
+		help="vote of each hit for its taxon: 'count' counts every hit as 1, "
+			"'bitscore' weights hits by their bitscore [count]")
 	ap.add_argument("-n", "--num-legend-taxons", type=int, default=20,
 		metavar="int",
 		help="number of taxons to show in legend, increase this number too much"
@@ -43,9 +89,20 @@ def get_args():
 	# parse and refine arsg
 	args = ap.parse_args()
 	if (args.scan_ext is None) and (args.file_list is None):
-		args.scan_ext = "blastdbcmd"
+		args.scan_ext = "blastn" if args.tax_cache else "blastdbcmd"
+	if (args.tax_cache is not None) and (not os.path.isfile(args.tax_cache)):
+		ap.error("tax cache '%s' does not exist" % args.tax_cache)
 	if args.table == "-":
 		args.table = sys.stdout
+	args.store = os.path.isfile(args.dirname) \
+		and args.dirname.endswith(".npz")
+	args.use_hits = args.store or (args.min_pident is not None) \
+		or (args.min_bitscore is not None) or (args.max_evalue is not None) \
+		or args.best_hit_only or (args.pident_window is not None) \
+		or (args.weight != "count")
+	if args.use_hits and (args.file_list is not None):
+		ap.error("-l/--file-list cannot be used with hit quality options or a "
+			".npz store")
 
 	return args
 
@@ -85,8 +142,13 @@ def _iter_file_by_file_list(dirname, file_list: str) -> iter:
 	return
 
 
+def read_oligo_hit_accs(fname, *, delimiter="\t") -> list:
+	with open(fname, "r") as fp:
+		return [i.split(delimiter)[1] for i in fp.read().splitlines() if i]
+
+
 def read_oligo_tax_count_in_dir(dirname, *, scan_ext=None, file_list=None,
-		key_field=0, **kw) -> dict:
+		key_field=0, tax_cache: AccTaxCache = None, **kw) -> dict:
 	if (scan_ext is None) and (file_list is None):
 		raise ValueError("must provide either scan_ext or file_list")
 	if (scan_ext is not None) and (file_list is not None):
@@ -97,25 +159,143 @@ def read_oligo_tax_count_in_dir(dirname, *, scan_ext=None, file_list=None,
 		file_iter = _iter_file_by_file_list(dirname, file_list)
 
 	ret = dict()
+	oligo_accs = dict()
 	for i in file_iter:
-		oligo = int(re.search(r"^(\d+)", i.name).group(1))
-		ret[oligo] = read_oligo_tax_count(i.path, key_field, **kw)
+		m = re.search(r"^(\d+)", i.name)
+		if m is None:
+			# e.g. batch.* query files of oligo_blastn.py batch mode
+			continue
+		if tax_cache is None:
+			ret[int(m.group(1))] = read_oligo_tax_count(i.path, key_field, **kw)
+		else:
+			oligo_accs[int(m.group(1))] = read_oligo_hit_accs(i.path, **kw)
+	if tax_cache is not None:
+		ret = _count_oligo_tax_from_cache(oligo_accs, tax_cache, key_field)
+	return ret
+
+
+def _count_oligo_tax_from_cache(oligo_accs: dict, tax_cache: AccTaxCache,
+		key_field: int) -> dict:
+	# one cache query for the hits of all oligos
+	keys = set(strip_accession_version(a) for v in oligo_accs.values()
+		for a in v)
+	acc_tax = tax_cache.get_many(keys)
+	n_missing = len(keys) - len(acc_tax)
+	print("accession taxonomy cache: %u unique hit accessions, %u found, "
+		"%u missing" % (len(keys), len(acc_tax), n_missing), file=sys.stderr)
+	ret = dict()
+	for oligo, accs in oligo_accs.items():
+		tax = list()
+		for a in accs:
+			v = acc_tax.get(strip_accession_version(a))
+			# missing accessions are skipped, the same as by blastdbcmd
+			if v is not None:
+				tax.append(v[key_field])
+		ret[oligo] = collections.Counter(tax)
 	return ret
 
 
-def write_output_table(f, oligo_tax: dict, *, delimiter="\t") -> None:
-	# get unique taxons from Counter's keys
-	# get sorted as in list
-	oligos = sorted(oligo_tax.keys())
-	uniq_tax = sorted(set(itertools.chain(*oligo_tax.values())))
-	total_counts = {k: v.total() for k, v in oligo_tax.items()}
+def read_kmer_oligo_tax_count(fname, *, min_kmer_frac=0.9) -> dict:
+	"""
+	count the taxa of the sequences assigned by kmer_classifier.py classify,
+	by the oligo of their representative file; oligos without any assigned
+	sequence are omitted
+	"""
+	ret = dict()
+	with open(fname, "r") as fp:
+		for line in fp:
+			fields = line.rstrip("\r\n").split("\t")
+			if len(fields) < 4:
+				continue
+			m = re.search(r"^(\d+)", os.path.basename(fields[0]))
+			if (m is None) or (fields[2] == "-") \
+					or (float(fields[3]) < min_kmer_frac):
+				continue
+			ret.setdefault(int(m.group(1)), collections.Counter()).update(
+				[fields[2]])
+	return ret
+
+
+def filter_store_hits(store: BlastHitStore, *, min_pident=None,
+		min_bitscore=None, max_evalue=None) -> BlastHitStore:
+	mask = numpy.ones(store.n_hits, dtype=bool)
+	if min_pident is not None:
+		mask &= store.hits["pident"] >= min_pident
+	if min_bitscore is not None:
+		mask &= store.hits["bitscore"] >= min_bitscore
+	if max_evalue is not None:
+		mask &= store.hits["evalue"] <= max_evalue
+	return store.filter(mask)
+
+
+def _group_max(group: numpy.ndarray, n_groups: int,
+		values: numpy.ndarray) -> numpy.ndarray:
+	ret = numpy.full(n_groups, -numpy.inf)
+	numpy.maximum.at(ret, group, values)
+	return ret
+
+
+def select_store_hits(store: BlastHitStore, *, best_hit_only=False,
+		pident_window=None) -> BlastHitStore:
+	"""
+	select hits relative to the best hit of the same query sequence, i.e. the
+	same (oligo, qseqid)
+	"""
+	if (not best_hit_only) and (pident_window is None):
+		return store
+	hits = store.hits
+	_, group = numpy.unique(numpy.stack([hits["oligo"], hits["qseqid"]]),
+		axis=1, return_inverse=True)
+	group = group.reshape(-1)
+	n_groups = (group.max() + 1) if len(group) else 0
+	mask = numpy.ones(len(hits), dtype=bool)
+	if best_hit_only:
+		top = _group_max(group, n_groups, hits["bitscore"])
+		mask &= hits["bitscore"] >= top[group]
+	if pident_window is not None:
+		top = _group_max(group, n_groups, hits["pident"])
+		mask &= hits["pident"] >= top[group] - pident_window
+	return store.filter(mask)
+
+
+def read_oligo_tax_count_from_store(store: BlastHitStore, key_field, *,
+		weight="count") -> dict:
+	"""
+	count hits of each oligo by taxon in the same way as reading the per-oligo
+	blastdbcmd tables; with weight='bitscore', each hit counts as its bitscore
+	"""
+	codes, labels = store.hit_labels(key_field)
+	known = codes >= 0
+	oligo, codes = store.hits["oligo"][known], codes[known]
+	# sum up votes of distinct (oligo, label) pairs at once
+	pairs, inverse = numpy.unique(numpy.stack([oligo, codes]), axis=1,
+		return_inverse=True)
+	if weight == "count":
+		votes = numpy.bincount(inverse.reshape(-1), minlength=pairs.shape[1])
+	elif weight == "bitscore":
+		votes = numpy.bincount(inverse.reshape(-1),
+			weights=store.hits["bitscore"][known].astype(float),
+			minlength=pairs.shape[1])
+	else:
+		raise ValueError("unknown weight '%s'" % weight)
+	ret = {o: collections.Counter() for o in store.oligos.tolist()}
+	for o, c, n in zip(pairs[0].tolist(), pairs[1].tolist(), votes.tolist()):
+		ret[o][str(labels[c])] = n
+	return ret
+
+
+def write_output_table(f, u_oligo: list, u_tax: list, bs_mat: numpy.ndarray,
+		*, delimiter="\t") -> None:
+	"""
+	write the matrix of get_oligo_tax_bootstrap_matrix() with taxa as rows and
+	oligos as columns, in a single write
+	"""
+	lines = [delimiter.join([""] + ["OLIGO_%03u" % i for i in u_oligo])]
+	# tolist() gives python floats, formatted the same as str(float)
+	for t, vals in zip(u_tax, bs_mat.T.tolist()):
+		lines.append(delimiter.join([t] + [str(i) for i in vals]))
 	with get_fp(f, "w") as fp:
-		header_line = delimiter.join([""] + ["OLIGO_%03u" % i for i in oligos])
-		print(header_line, file=fp)
-		for t in uniq_tax:
-			vals = [oligo_tax[i][t] / (total_counts[i] or 1) for i in oligos]
-			line = delimiter.join([t] + [str(i) for i in vals])
-			print(line, file=fp)
+		fp.write("\n".join(lines) + "\n")
 	return
 
 
@@ -157,21 +337,32 @@ def setup_layout(figure, n_oligo):
 
 
 def get_oligo_tax_bootstrap_matrix(oligo_tax: dict):
+	"""
+	fraction of hits of each oligo assigned to each taxon, built once for both
+	the table and the plot
+
+	return: sorted oligos, sorted taxa and the oligo x taxon matrix
+	"""
 	# get unique oligos list
 	u_oligo = sorted(oligo_tax.keys())
 
-	# get unique taxons list
-	tax_iter = itertools.chain(*[v.keys() for v in oligo_tax.values()])
-	u_tax = sorted(set(tax_iter))
+	# flatten the non-zero (oligo, taxon, count) entries, then factorize taxa
+	rows, taxa, counts = list(), list(), list()
+	for i, o in enumerate(u_oligo):
+		rows.extend([i] * len(oligo_tax[o]))
+		taxa.extend(oligo_tax[o].keys())
+		counts.extend(oligo_tax[o].values())
+	u_tax, cols = numpy.unique(numpy.array(taxa, dtype=str),
+		return_inverse=True)
 
 	# get oligo tax bootstrap matrix
 	bs_mat = numpy.zeros((len(u_oligo), len(u_tax)), dtype=float)
-	for i, o in enumerate(u_oligo):
-		bs_total = oligo_tax[o].total()
-		for j, t in enumerate(u_tax):
-			bs_mat[i, j] = oligo_tax[o][t] / (bs_total or 1.0)
+	numpy.add.at(bs_mat, (numpy.array(rows, dtype=int), cols.reshape(-1)),
+		numpy.array(counts, dtype=float))
+	bs_total = bs_mat.sum(axis=1, keepdims=True)
+	bs_mat /= numpy.where(bs_total > 0, bs_total, 1.0)
 
-	return u_oligo, u_tax, bs_mat
+	return u_oligo, u_tax.tolist(), bs_mat
 
 
 class LegendColors(list):
@@ -217,12 +408,11 @@ class LegendColors(list):
 		return itertools.cycle(super().__iter__())
 
 
-def plot_oligo_tax_stackbar(png, oligo_tax: dict, num_legend_taxons: int = 20):
+def plot_oligo_tax_stackbar(png, u_oligo: list, u_tax: list,
+		bs_mat: numpy.ndarray, num_legend_taxons: int = 20):
 	if png is None:
 		return
 
-	u_oligo, u_tax, bs_mat = get_oligo_tax_bootstrap_matrix(oligo_tax)
-
 	n_oligo, n_tax = len(u_oligo), len(u_tax)
 	assert bs_mat.shape == (n_oligo, n_tax)
 
@@ -275,13 +465,36 @@ def plot_oligo_tax_stackbar(png, oligo_tax: dict, num_legend_taxons: int = 20):
 def main():
 	args = get_args()
 	# load data
-	oligo_tax = read_oligo_tax_count_in_dir(args.dirname,
-		scan_ext=args.scan_ext, file_list=args.file_list,
-		key_field=args.key_field, delimiter=args.delimiter)
+	tax_cache = None if args.tax_cache is None else AccTaxCache(args.tax_cache)
+	if args.use_hits:
+		if args.store:
+			store = BlastHitStore.load(args.dirname)
+		else:
+			store = BlastHitStore.build(args.dirname, tax_cache=tax_cache)
+		store = filter_store_hits(store, min_pident=args.min_pident,
+			min_bitscore=args.min_bitscore, max_evalue=args.max_evalue)
+		store = select_store_hits(store, best_hit_only=args.best_hit_only,
+			pident_window=args.pident_window)
+		oligo_tax = read_oligo_tax_count_from_store(store, args.key_field,
+			weight=args.weight)
+	else:
+		oligo_tax = read_oligo_tax_count_in_dir(args.dirname,
+			scan_ext=args.scan_ext, file_list=args.file_list,
+			key_field=args.key_field, tax_cache=tax_cache,
+			delimiter=args.delimiter)
+	if tax_cache is not None:
+		tax_cache.close()
+	if args.kmer_assignments is not None:
+		# BLAST output takes precedence over the k-mer assignments
+		for oligo, tax in read_kmer_oligo_tax_count(args.kmer_assignments,
+				min_kmer_frac=args.min_kmer_frac).items():
+			oligo_tax.setdefault(oligo, tax)
+	u_oligo, u_tax, bs_mat = get_oligo_tax_bootstrap_matrix(oligo_tax)
 	# table output
-	write_output_table(args.table, oligo_tax, delimiter=args.delimiter)
+	write_output_table(args.table, u_oligo, u_tax, bs_mat,
+		delimiter=args.delimiter)
 	# plot output
-	plot_oligo_tax_stackbar(args.plot, oligo_tax,
+	plot_oligo_tax_stackbar(args.plot, u_oligo, u_tax, bs_mat,
 		num_legend_taxons=args.num_legend_taxons)
 	return
 
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+import argparse
+import sys
+
+import numpy
+
+from aln_io import get_fp, AlignmentCache, WeightedAlignment
+
+
+# characters counted by oligotyping's entropy-analysis
+VALID_CHARS = b"ATCG-"
+
+
+def get_args() -> argparse.Namespace:
+	ap = argparse.ArgumentParser(description="count-aware replacement of "
+		"oligotyping's entropy-analysis, computing per-position Shannon entropy "
+		"from unique sequences weighted by their counts")
+	ap.add_argument("fasta", type=str,
+		help="aligned fasta; unique sequences if --count-table is set, "
+			"otherwise redundant reads with '<sample>_<read>' headers")
+	ap.add_argument("--count-table", "-c", type=str,
+		metavar="count_table",
+		help="mothur count_table of the unique sequences in <fasta> [no]")
+	ap.add_argument("--output", "-o", type=str,
+		metavar="txt",
+		help="output 2-column position-entropy table, in the same format as "
+			"entropy-analysis [<fasta>-ENTROPY]")
+	ap.add_argument("--cache", action="store_true",
+		help="read the alignment from its binary cache <fasta>.alncache.*, "
+			"which is (re)built if missing or outdated; later stages can then "
+			"reuse the cache instead of parsing the fasta again [no]")
+	ap.add_argument("--block-cells", type=int, default=1 << 24,
+		metavar="int",
+		help="number of alignment cells encoded per vectorized block, limits "
+			"the peak memory usage [16777216]")
+
+	# parse and refine args
+	args = ap.parse_args()
+	if args.output is None:
+		args.output = args.fasta + "-ENTROPY"
+	elif args.output == "-":
+		args.output = sys.stdout
+
+	return args
+
+
+def get_char_code_table(valid_chars: bytes = VALID_CHARS) -> numpy.ndarray:
+	"""
+	map each byte to its index in <valid_chars>, all other bytes to
+	len(valid_chars)
+	"""
+	table = numpy.full(256, len(valid_chars), dtype=numpy.uint8)
+	for i, c in enumerate(valid_chars):
+		table[c] = i
+	return table
+
+
+def weighted_char_counts(matrix: numpy.ndarray, weights: numpy.ndarray, *,
+		valid_chars: bytes = VALID_CHARS, block_cells=1 << 24) -> numpy.ndarray:
+	"""
+	sum of weights of each valid character at each alignment column; columns
+	are processed in blocks of about <block_cells> cells to limit the peak
+	memory usage, and each block reads only its own columns from a
+	column-major (e.g. memory-mapped cache) matrix
+
+	return: array of shape (len(valid_chars) + 1, ncol), the last row holds
+		weights of all other characters
+	"""
+	nrow, ncol = matrix.shape
+	nchar = len(valid_chars) + 1
+	code_table = get_char_code_table(valid_chars)
+	weights = numpy.asarray(weights, dtype=float)
+	block_ncol = max(1, block_cells // max(nrow, 1))
+	ret = numpy.zeros((nchar, ncol), dtype=float)
+	for start in range(0, ncol, block_ncol):
+		block = numpy.asarray(matrix[:, start:start + block_ncol])
+		bcol = block.shape[1]
+		# flat (char, column) bin index of every cell
+		idx = code_table[block].astype(numpy.intp) * bcol \
+			+ numpy.arange(bcol, dtype=numpy.intp)
+		ret[:, start:start + bcol] = numpy.bincount(idx.ravel(),
+			weights=numpy.repeat(weights, bcol), minlength=nchar * bcol) \
+			.reshape(nchar, bcol)
+	return ret
+
+
+def column_entropy(matrix: numpy.ndarray, weights: numpy.ndarray, *,
+		block_cells=1 << 24) -> numpy.ndarray:
+	char_counts = weighted_char_counts(matrix, weights,
+		block_cells=block_cells)
+	total = char_counts.sum(axis=0)
+	# same as oligotyping, a tiny pseudo-frequency is added to avoid log(0)
+	p = char_counts[:-1] / numpy.where(total > 0, total, 1) \
+		+ 0.0000000000000000001
+	return -(p * numpy.log(p)).sum(axis=0)
+
+
+def save_entropy(f, entropy: numpy.ndarray) -> None:
+	with get_fp(f, "w") as fp:
+		fp.write("".join(["%d\t%.4f\n" % (i, e) for i, e in enumerate(entropy)]))
+	return
+
+
+def main():
+	args = get_args()
+	if args.cache:
+		aln = AlignmentCache.load_or_build(args.fasta, args.count_table)
+	else:
+		aln = WeightedAlignment.load(args.fasta, args.count_table)
+	entropy = column_entropy(aln.matrix, aln.weights,
+		block_cells=args.block_cells)
+	save_entropy(args.output, entropy)
+	return
+
+
+if __name__ == "__main__":
+	main()
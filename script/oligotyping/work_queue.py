@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+
+import argparse
+import contextlib
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+
+
+def get_args() -> argparse.Namespace:
+	ap = argparse.ArgumentParser(description="show the state of a BLAST work "
+		"queue created by submit.oligo_fasta_blastn.py --work-queue")
+	ap.add_argument("queue", type=str,
+		help="work queue database")
+	ap.add_argument("--list", "-l", type=str,
+		choices=["pending", "claimed", "done", "failed"],
+		help="also list items in this state")
+
+	# parse and refine args
+	args = ap.parse_args()
+
+	return args
+
+
+def default_worker_id() -> str:
+	return "%s:%u" % (socket.gethostname(), os.getpid())
+
+
+class WorkQueue(object):
+	"""
+	sqlite-backed queue of work items, shared by concurrent workers on the
+	same or different hosts; workers claim items atomically, in descending order
+	of cost, and keep sending heartbeats while processing; claims without a
+	heartbeat for <stale_timeout> seconds are assumed to be of dead workers and
+	returned to the queue
+	"""
+	states = ("pending", "claimed", "done", "failed")
+
+	def __init__(self, path: str, *ka, stale_timeout: float = 600,
+			max_attempts: int = 3, **kw):
+		super().__init__(*ka, **kw)
+		self.path = path
+		self.stale_timeout = stale_timeout
+		self.max_attempts = max_attempts
+		self.conn = self._connect()
+		with self.conn:
+			self.conn.execute("CREATE TABLE IF NOT EXISTS tasks ("
+				"id INTEGER PRIMARY KEY, item TEXT UNIQUE, cost INTEGER, "
+				"state TEXT, worker TEXT, heartbeat REAL, attempts INTEGER)")
+		return
+
+	def _connect(self) -> sqlite3.Connection:
+		# transactions are managed explicitly, see _transaction()
+		return sqlite3.connect(self.path, timeout=600, isolation_level=None)
+
+	def close(self) -> None:
+		self.conn.close()
+		return
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *ka):
+		self.close()
+		return
+
+	@contextlib.contextmanager
+	def _transaction(self, conn=None):
+		# BEGIN IMMEDIATE takes the write lock, so that concurrent claims
+		# cannot pick the same item
+		conn = self.conn if conn is None else conn
+		conn.execute("BEGIN IMMEDIATE")
+		try:
+			yield conn
+		except BaseException:
+			conn.execute("ROLLBACK")
+			raise
+		else:
+			conn.execute("COMMIT")
+		return
+
+	def add(self, items: list, costs: list = None) -> None:
+		"""
+		add items to the queue, items already in the queue are ignored
+		"""
+		costs = [0] * len(items) if costs is None else costs
+		with self._transaction() as conn:
+			conn.executemany("INSERT OR IGNORE INTO tasks (item, cost, state, "
+				"attempts) VALUES (?, ?, 'pending', 0)", zip(items, costs))
+		return
+
+	def _reclaim_stale(self, conn) -> None:
+		conn.execute("UPDATE tasks SET state = CASE WHEN attempts < ? THEN "
+			"'pending' ELSE 'failed' END, worker = NULL WHERE state = 'claimed' "
+			"AND heartbeat < ?", (self.max_attempts,
+				time.time() - self.stale_timeout))
+		return
+
+	def claim(self, worker: str):
+		"""
+		return: (task id, item) of the claimed item, or None if no item is
+			pending
+		"""
+		with self._transaction() as conn:
+			self._reclaim_stale(conn)
+			row = conn.execute("SELECT id, item FROM tasks WHERE state = "
+				"'pending' ORDER BY cost DESC, id LIMIT 1").fetchone()
+			if row is not None:
+				conn.execute("UPDATE tasks SET state = 'claimed', worker = ?, "
+					"heartbeat = ?, attempts = attempts + 1 WHERE id = ?",
+					(worker, time.time(), row[0]))
+		return row
+
+	def heartbeat(self, task_id: int, worker: str, conn=None) -> bool:
+		"""
+		return: False if the claim has been lost, e.g. reclaimed as stale
+		"""
+		conn = self.conn if conn is None else conn
+		with self._transaction(conn):
+			cur = conn.execute("UPDATE tasks SET heartbeat = ? WHERE id = ? AND "
+				"worker = ? AND state = 'claimed'", (time.time(), task_id,
+					worker))
+		return cur.rowcount > 0
+
+	def complete(self, task_id: int, worker: str) -> None:
+		with self._transaction() as conn:
+			conn.execute("UPDATE tasks SET state = 'done' WHERE id = ? AND "
+				"worker = ?", (task_id, worker))
+		return
+
+	def fail(self, task_id: int, worker: str) -> None:
+		"""
+		return the item to the queue, or mark it failed after <max_attempts>
+		"""
+		with self._transaction() as conn:
+			conn.execute("UPDATE tasks SET state = CASE WHEN attempts < ? THEN "
+				"'pending' ELSE 'failed' END, worker = NULL WHERE id = ? AND "
+				"worker = ?", (self.max_attempts, task_id, worker))
+		return
+
+	def reset(self, items: list) -> None:
+		"""
+		return items to the queue regardless of their state, as new
+		"""
+		with self._transaction() as conn:
+			conn.executemany("UPDATE tasks SET state = 'pending', worker = NULL, "
+				"attempts = 0 WHERE item = ?", [(i,) for i in items])
+		return
+
+	def counts(self) -> dict:
+		ret = dict.fromkeys(self.states, 0)
+		for state, n in self.conn.execute("SELECT state, COUNT(*) FROM tasks "
+				"GROUP BY state"):
+			ret[state] = n
+		return ret
+
+	def items(self, state: str) -> list:
+		return [i for i, in self.conn.execute("SELECT item FROM tasks WHERE "
+			"state = ? ORDER BY id", (state,))]
+
+	@contextlib.contextmanager
+	def heartbeat_thread(self, task_id: int, worker: str,
+			interval: float = 60):
+		"""
+		keep sending heartbeats of the claim in a background thread until the
+		context exits
+		"""
+		stop = threading.Event()
+
+		def beat():
+			# sqlite connections cannot be shared between threads
+			conn = self._connect()
+			try:
+				while not stop.wait(interval):
+					self.heartbeat(task_id, worker, conn)
+			finally:
+				conn.close()
+			return
+
+		thread = threading.Thread(target=beat, daemon=True)
+		thread.start()
+		try:
+			yield
+		finally:
+			stop.set()
+			thread.join()
+		return
+
+	def iter_claims(self, worker: str, *, poll_interval: float = 30) -> iter:
+		"""
+		yield (task id, item) claimed one at a time until the queue is drained;
+		while other workers still hold claims, wait for them to finish or to
+		become stale, so that items of dead workers are picked up
+		"""
+		while True:
+			claim = self.claim(worker)
+			if claim is not None:
+				yield claim
+			elif self.counts()["claimed"]:
+				time.sleep(poll_interval)
+			else:
+				break
+		return
+
+
+def main():
+	args = get_args()
+	if not os.path.isfile(args.queue):
+		print("'%s' does not exist" % args.queue, file=sys.stderr)
+		sys.exit(1)
+	with WorkQueue(args.queue) as queue:
+		counts = queue.counts()
+		print(("\t").join(queue.states))
+		print(("\t").join([str(counts[i]) for i in queue.states]))
+		if args.list:
+			for i in queue.items(args.list):
+				print(i)
+	return
+
+
+if __name__ == "__main__":
+	main()
@@ -5,39 +5,8 @@
 
 input_list=$1; shift;
 
-blastn_dir="blastn"
-blast_db="$HOME/scratch/DATABASE/BLAST/nt"
-python_env_prefix="$HOME/.local/env/python-3.10.10-venv-generic"
-blastx_prefix="$HOME/opt/ncbi/blast+-2.13.0"
-
-for fasta_full in $(cat $input_list); do
-
-	fasta="$(basename $fasta_full)"; shift;
-
-	. $python_env_prefix/bin/activate
-	# remove gaps in input fasta
-	seqmagick convert --ungap --input-format fasta \
-		$fasta_full \
-		$blastn_dir/$fasta.fna
-	deactivate
-
-	# blastn
-	$blastx_prefix/bin/blastn \
-		-query $blastn_dir/$fasta.fna \
-		-out $blastn_dir/$fasta.fna.blastn \
-		-outfmt "6 qseqid sacc pident evalue bitscore" \
-		-db $blast_db \
-		-max_target_seqs 20 \
-		-perc_identity 99 \
-		-num_threads $SLURM_CPUS_PER_TASK
-
-	# blastdbcmd
-	cut -f2 -d '	' $blastn_dir/$fasta.fna.blastn > $blastn_dir/$fasta.fna.blastn.hit_accs
-	$blastx_prefix/bin/blastdbcmd \
-		-db $blast_db \
-		-dbtype nucl \
-		-entry_batch $blastn_dir/$fasta.fna.blastn.hit_accs \
-		-out $blastn_dir/$fasta.fna.blastn.blastdbcmd \
-		-outfmt "%a	%T	%S"
-
-done
+# all per-file work (ungap, blastn, taxonomy lookup of hits and completion
+# markers) is done in one python process; paths can be overridden by the
+# environment variables BLASTN_DIR, BLAST_DB, BLASTX_PREFIX and
+# BLAST_TAX_CACHE, see oligo_blastn.py
+exec python3 script/oligo_blastn.py files $input_list